@@ -14,11 +14,14 @@
 """Basic test setup stuff.
 """
 
-from os import listdir
-import codecs
+import json
 import os.path
-import re
-from z3c.testsetup.util import get_package
+from z3c.testsetup.index import get_index
+from z3c.testsetup.scan import (
+    ThreadPoolExecutor, filter_files, list_entries, walk_files)
+from z3c.testsetup.util import (
+    get_package, get_file_markers, get_line_matcher, read_bytes, read_text,
+    decode_text)
 
 
 class BasicTestSetup(object):
@@ -34,13 +37,41 @@ class BasicTestSetup(object):
     regexp_list = []
     additional_options = {}
 
-    param_list = ['filter_func', 'extensions']
+    # Glob patterns of file and directory names we never look into.
+    exclude = ['__pycache__', '*.egg-info']
+
+    # Number of threads checking files concurrently. Zero means all
+    # files are checked one after another.
+    scan_workers = 0
+
+    # If set, only the first lines or bytes of files are searched for
+    # markers and regular expressions.
+    header_lines = None
+    header_bytes = None
+
+    param_list = ['filter_func', 'extensions', 'exclude', 'cache_dir',
+                  'scan_workers', 'header_lines', 'header_bytes']
+
+    # A `z3c.testsetup.scan.PackageScan` shared with other setups, if
+    # any. TestGetters set this when run by a TestCollector.
+    scan = None
 
     def __init__(self, package, regexp_list=None, filter_func=None,
-                 extensions=None, **kw):
+                 extensions=None, exclude=None, cache_dir=None,
+                 scan_workers=None, header_lines=None, header_bytes=None,
+                 **kw):
         self.package = get_package(package)
+        self.index = get_index(cache_dir)
         self.filter_func = filter_func or self.isTestFile
         self.extensions = extensions or self.extensions
+        if exclude is not None:
+            self.exclude = exclude
+        if scan_workers is not None:
+            self.scan_workers = scan_workers
+        if header_lines is not None:
+            self.header_lines = header_lines
+        if header_bytes is not None:
+            self.header_bytes = header_bytes
         if regexp_list is not None:
             self.regexp_list = regexp_list
         self.additional_options = kw
@@ -53,14 +84,18 @@ class BasicTestSetup(object):
         """
         pass
 
+    @property
+    def matcher(self):
+        """Return the `LineMatcher` for our regular expressions.
+
+        Matchers are compiled once per list of regular expressions.
+        """
+        return get_line_matcher(self.regexp_list)
+
     @property
     def regexs(self):
         """Return compiled regexs (cached version, if possible)"""
-        cached = getattr(self, '_regexs', None)
-        if cached is not None:
-            return cached
-        self._regexs = [re.compile(regex) for regex in self.regexp_list]
-        return self._regexs
+        return self.matcher.regexs
 
     def setUp(self, test):
         pass
@@ -68,25 +103,92 @@ class BasicTestSetup(object):
     def tearDown(self, test):
         pass
 
+    def readFile(self, filepath):
+        """Get the contents of a file as text.
+
+        Files are assumed to be UTF-8 encoded. Incompatible characters
+        are ignored. If we share a package scan with other setups, the
+        file is read only once for all of them.
+
+        If `header_lines` or `header_bytes` is set, we get only the
+        beginning of the file.
+        """
+        if self.scan is not None:
+            return self.scan.read(
+                filepath, self.header_bytes, self.header_lines)
+        return read_text(filepath, self.header_bytes, self.header_lines)
+
+    def readBytes(self, filepath):
+        """Get the contents of a file as bytes.
+
+        Works like `readFile` but does not decode the file.
+        """
+        if self.scan is not None:
+            return self.scan.readBytes(
+                filepath, self.header_bytes, self.header_lines)
+        return read_bytes(filepath, self.header_bytes, self.header_lines)
+
+    def getIndexKey(self, name):
+        """Get the key to store results of method `name` under in the
+        discovery index.
+        """
+        return '%s %s %s' % (name, json.dumps(list(self.regexp_list)),
+                             self.getHeaderScope())
+
+    def getHeaderScope(self):
+        """Get a string telling which part of files we look at.
+        """
+        return json.dumps([self.header_bytes, self.header_lines])
+
+    def getMarkers(self, filepath):
+        """Get all marker strings of a file as a `FileMarkers` record.
+
+        The file is parsed only once for all markers it contains.
+        """
+        if self.index is not None:
+            return self.index.getMarkers(
+                filepath, self._parseMarkers, self.getHeaderScope())
+        return self._parseMarkers(filepath)
+
+    def _parseMarkers(self, filepath):
+        if self.scan is not None:
+            return self.scan.markers(
+                filepath, self.header_bytes, self.header_lines)
+        return get_file_markers(filepath, max_bytes=self.header_bytes,
+                                max_lines=self.header_lines)
+
+    def getMarker(self, marker, filepath):
+        """Get the value of marker string `marker` in a file.
+
+        Returns ``None`` if the file contains no such marker.
+        """
+        return self.getMarkers(filepath).get(marker)
+
     def fileContains(self, filename):
         """Does a file contain lines matching every of the regular
         expressions?
         """
-        found_list = []
-        with codecs.open(filename, "rb", "utf-8", "ignore") as fd:
-            content = fd.read()
-        return self.textContains(content)
+        if self.index is not None:
+            return self.index.getResult(
+                filename, self.getIndexKey('fileContains'),
+                self._fileContains)
+        return self._fileContains(filename)
+
+    def _fileContains(self, filepath):
+        raw = self.readBytes(filepath)
+        if not self.matcher.acceptsBytes(raw):
+            # Rejected without decoding the file.
+            return False
+        if self.scan is not None:
+            # Decoded only once for all setups sharing the scan.
+            return self.textContains(self.readFile(filepath))
+        return self.textContains(decode_text(raw))
 
     def textContains(self, text):
-        lines = text.split('\n')
-        for regexp in self.regexs:
-            found = [True for line in lines if regexp.match(line)]
-            if len(found):
-                # Yeah, found a match, continue to the next regex.
-                continue
-            else:
-                return False
-        return True
+        """Does a text contain lines matching every of the regular
+        expressions?
+        """
+        return self.matcher.matches(text)
 
     def isTestFile(self, filepath):
         """Return ``True`` if a file matches our expectations for a
@@ -114,16 +216,19 @@ class BasicTestSetup(object):
         """
         if dirpath is None:
             dirpath = os.path.dirname(self.package.__file__)
-        dirlist = []
-        for filename in listdir(dirpath):
-            abs_path = os.path.join(dirpath, filename)
-            if not os.path.isdir(abs_path):
-                if self.filter_func(abs_path):
-                    dirlist.append(abs_path)
-                continue
-            # Search subdirectories...
-            if not self.isTestDirectory(abs_path):
-                continue
-            subdir_files = self.getDocTestFiles(dirpath=abs_path, **kw)
-            dirlist.extend(subdir_files)
-        return dirlist
+        listdir = list_entries
+        if self.scan is not None:
+            listdir = self.scan.listdir
+        if self.scan_workers and ThreadPoolExecutor is not None:
+            # Check files in worker threads while walking on.
+            paths = walk_files(dirpath, self.isTestDirectory, None,
+                               exclude=self.exclude, listdir=listdir)
+            result = list(filter_files(paths, self.filter_func,
+                                       self.scan_workers))
+        else:
+            result = list(walk_files(dirpath, self.isTestDirectory,
+                                     self.filter_func, exclude=self.exclude,
+                                     listdir=listdir))
+        if self.index is not None:
+            self.index.flush()
+        return result
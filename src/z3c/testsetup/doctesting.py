@@ -15,13 +15,16 @@
 """
 import doctest
 import unittest
+from functools import partial
 import os.path
-from os import listdir
 from six import string_types
 from zope.testing import cleanup
 from z3c.testsetup.base import BasicTestSetup
-from z3c.testsetup.util import (get_package, get_marker_from_file, warn,
-                                get_attribute)
+from z3c.testsetup.lazy import LazyDocFileSuite
+from z3c.testsetup.parsecache import CachingDocTestParser, get_parse_cache
+from z3c.testsetup.results import cache_results, get_result_cache
+from z3c.testsetup.util import (get_package, warn, get_attribute,
+                                get_lazy_attribute, LazyAttribute)
 
 
 class DocTestSetup(BasicTestSetup):
@@ -37,9 +40,20 @@ class DocTestSetup(BasicTestSetup):
 
     checker = None
 
+    # Read and parse doctest files only when their tests are run.
+    lazy = False
+
+    # Restore ZCML layers from snapshots of earlier runs.
+    zcml_snapshots = False
+
+    # Report doctests that passed before and did not change as passed
+    # without running them.
+    cache_results = False
+
     def __init__(self, package, setup=None, teardown=None, globs=None,
                  optionflags=None, encoding=None, checker=None,
-                 allow_teardown=False, **kw):
+                 allow_teardown=False, lazy=None, zcml_snapshots=None,
+                 cache_results=None, **kw):
         BasicTestSetup.__init__(self, package, **kw)
         self.setUp = setup or self.setUp
         self.tearDown = teardown or self.tearDown
@@ -50,6 +64,66 @@ class DocTestSetup(BasicTestSetup):
         if optionflags is not None:
             self.optionflags = optionflags
         self.allow_teardown = allow_teardown
+        if lazy is not None:
+            self.lazy = lazy
+        if zcml_snapshots is not None:
+            self.zcml_snapshots = zcml_snapshots
+        if cache_results is not None:
+            self.cache_results = cache_results
+        self.cache_dir = kw.get('cache_dir')
+        self.parse_cache = get_parse_cache(self.cache_dir)
+        self.result_cache = None
+        if self.cache_results:
+            self.result_cache = get_result_cache(self.cache_dir)
+            if self.result_cache is None:
+                warn("No cache dir or no `sqlite3` available. "
+                     "Test results are not cached.")
+
+    def makeDocFileSuite(self, suite_creator, path, **kw):
+        """Create a doctest suite for file `path` with `suite_creator`.
+
+        In lazy mode, the suite is created when its tests are needed.
+        If we have a parse cache, doctest files are parsed only if
+        they changed since they were cached.
+        """
+        if self.parse_cache is not None and 'parser' not in kw:
+            kw['parser'] = CachingDocTestParser(self.parse_cache)
+        if self.lazy:
+            return LazyDocFileSuite(suite_creator, path, **kw)
+        return suite_creator(path, **kw)
+
+    def cacheResults(self, suite, setup=None, teardown=None):
+        """Get `suite` with tests that passed before reported as passed
+        without running them, if results are cached.
+
+        See `z3c.testsetup.results`. Call this after setting the layer
+        of `suite`.
+        """
+        if self.result_cache is None:
+            return suite
+        return cache_results(
+            suite, self.result_cache, setup, teardown, checker=self.checker,
+            optionflags=self.optionflags, globs=self.globs)
+
+    def getAttribute(self, name):
+        """Get the object denoted by dotted `name`.
+
+        In lazy mode, we get a proxy importing the object at first use.
+        """
+        if self.lazy:
+            return get_lazy_attribute(name)
+        return get_attribute(name)
+
+
+def create_layer_suite(layer, suite_creator, functional_suite_creator,
+                       functional_layer_class, *args, **kw):
+    """Create a doctest suite for a layer not imported yet.
+
+    Layers of `functional_layer_class` get a functional suite.
+    """
+    if isinstance(layer.resolve(), functional_layer_class):
+        suite_creator = functional_suite_creator
+    return suite_creator(*args, **kw)
 
 
 class SimpleDocTestSetup(DocTestSetup):
@@ -62,9 +136,10 @@ class SimpleDocTestSetup(DocTestSetup):
         docfiles = self.getDocTestFiles(package=self.package)
         suite = unittest.TestSuite()
         for name in docfiles:
-            layerdef = get_marker_from_file('layer', name)
+            markers = self.getMarkers(name)
+            layerdef = markers.get('layer')
             if layerdef is not None:
-                layerdef = get_attribute(layerdef)
+                layerdef = self.getAttribute(layerdef)
 
             zcml_layer = self.getZCMLLayer(name, 'zcml-layer')
             if zcml_layer is not None:
@@ -75,13 +150,13 @@ class SimpleDocTestSetup(DocTestSetup):
             if functional_zcml_layer is not None:
                 layerdef = functional_zcml_layer
 
-            setup = get_marker_from_file('setup', name) or self.setUp
+            setup = markers.get('setup') or self.setUp
             if setup is not None and isinstance(setup, string_types):
-                setup = get_attribute(setup)
+                setup = self.getAttribute(setup)
 
-            teardown = get_marker_from_file('teardown', name) or self.tearDown
+            teardown = markers.get('teardown') or self.tearDown
             if teardown is not None and isinstance(teardown, string_types):
-                teardown = get_attribute(teardown)
+                teardown = self.getAttribute(teardown)
 
             if os.path.isabs(name):
                 # We get absolute pathnames, but we need relative ones...
@@ -109,14 +184,20 @@ Please include `zope.app.testing` in your project setup to run this testfile.
                 try:
                     from zope.app.testing.functional import (
                         ZCMLLayer, FunctionalDocFileSuite)
-                    if isinstance(layerdef, ZCMLLayer):
+                    if isinstance(layerdef, LazyAttribute):
+                        # Decide when the suite is created.
+                        suite_creator = partial(
+                            create_layer_suite, layerdef, suite_creator,
+                            FunctionalDocFileSuite, ZCMLLayer)
+                    elif isinstance(layerdef, ZCMLLayer):
                         suite_creator = FunctionalDocFileSuite
                 except ImportError:
                     # If zope.app.testing is not available, the layer
                     # cannot be a ZCML layer.
                     pass
 
-            test = suite_creator(
+            test = self.makeDocFileSuite(
+                suite_creator,
                 name,
                 package=self.package,
                 setUp=setup,
@@ -128,19 +209,29 @@ Please include `zope.app.testing` in your project setup to run this testfile.
                 )
             if layerdef is not None:
                 test.layer = layerdef
-            suite.addTest(test)
+            suite.addTest(self.cacheResults(test, setup, teardown))
         return suite
 
+    def getZCMLLayerArgs(self):
+        """Get keyword arguments for `get_zcml_layer` about the kind of
+        ZCML layer to create.
+        """
+        if not self.zcml_snapshots:
+            return {}
+        from z3c.testsetup.functional.layer import SnapshotZCMLLayer
+        return dict(factory=SnapshotZCMLLayer, cache_dir=self.cache_dir)
+
     def getZCMLLayer(self, filepath, marker):
         """Create a ZCML layer out of a test marker.
         """
-        zcml_file = get_marker_from_file(marker, filepath)
+        zcml_file = self.getMarker(marker, filepath)
         if zcml_file is None:
             return
         try:
             # Late import. Some environments don't have
             # ``zope.app.testing`` available.
-            from z3c.testsetup.functional.layer import DefaultZCMLLayer
+            from z3c.testsetup.functional.layer import (
+                DefaultZCMLLayer, get_zcml_layer)
         except ImportError:
             warn("""You specified `%s` in
     %s
@@ -148,12 +239,14 @@ but there seems to be no `zope.app.testing` package available.
 Please include `zope.app.testing` in your project setup to run this testfile.
 """ % (marker, filepath))
 
-        layer = DefaultZCMLLayer(
-            os.path.join(os.path.dirname(filepath), zcml_file),
+        zcml_path = os.path.join(os.path.dirname(filepath), zcml_file)
+        layer = get_zcml_layer(
+            zcml_path,
             DefaultZCMLLayer.__module__,
-            '%s [%s]' % (DefaultZCMLLayer.__name__,
-                         os.path.join(os.path.dirname(filepath), zcml_file)),
-            allow_teardown=self.allow_teardown)
+            '%s [%s]' % (DefaultZCMLLayer.__name__, zcml_path),
+            marker,
+            allow_teardown=self.allow_teardown,
+            **self.getZCMLLayerArgs())
         return layer
 
     def isTestFile(self, filepath):
@@ -165,29 +258,10 @@ Please include `zope.app.testing` in your project setup to run this testfile.
         if os.path.basename(filepath).startswith('.'):
             # Ignore *nix hidden files
             return False
-        if get_marker_from_file('doctest', filepath) is None:
+        if self.getMarker('doctest', filepath) is None:
             return False
         return True
 
-    def getDocTestFiles(self, dirpath=None, **kw):
-        """Find all doctest files filtered by filter_func.
-        """
-        if dirpath is None:
-            dirpath = os.path.dirname(self.package.__file__)
-        dirlist = []
-        for filename in listdir(dirpath):
-            abs_path = os.path.join(dirpath, filename)
-            if not os.path.isdir(abs_path):
-                if self.filter_func(abs_path):
-                    dirlist.append(abs_path)
-                continue
-            # Search subdirectories...
-            if not self.isTestDirectory(abs_path):
-                continue
-            subdir_files = self.getDocTestFiles(dirpath=abs_path, **kw)
-            dirlist.extend(subdir_files)
-        return dirlist
-
 
 class UnitDocTestSetup(DocTestSetup):
     """A unit test setup for packages.
@@ -210,7 +284,7 @@ class UnitDocTestSetup(DocTestSetup):
                    doctest.REPORT_NDIFF)
 
     regexp_list = [
-        '^\s*:(T|t)est-(L|l)ayer:\s*(unit)\s*',
+        r'^\s*:(T|t)est-(L|l)ayer:\s*(unit)\s*',
         ]
 
     globs = dict()
@@ -225,13 +299,14 @@ class UnitDocTestSetup(DocTestSetup):
         docfiles = self.getDocTestFiles(package=self.package)
         suite = unittest.TestSuite()
         for name in docfiles:
-            layerdef = get_marker_from_file('Test-Layerdef', name)
+            layerdef = self.getMarker('Test-Layerdef', name)
             if os.path.isabs(name):
                 # We get absolute pathnames, but we need relative ones...
                 common_prefix = os.path.commonprefix([self.package.__file__,
                                                       name])
                 name = name[len(common_prefix):]
-            test = doctest.DocFileSuite(
+            test = self.makeDocFileSuite(
+                doctest.DocFileSuite,
                 name,
                 package=self.package,
                 setUp=self.setUp,
@@ -243,5 +318,5 @@ class UnitDocTestSetup(DocTestSetup):
                 )
             if layerdef is not None:
                 test.layer = layerdef
-            suite.addTest(test)
+            suite.addTest(self.cacheResults(test, self.setUp, self.tearDown))
         return suite
@@ -22,7 +22,8 @@ from zope.app.testing.functional import (
     HTTPCaller, getRootFolder, sync, ZCMLLayer, FunctionalDocFileSuite,
     FunctionalTestSetup)
 from z3c.testsetup.doctesting import DocTestSetup
-from z3c.testsetup.util import get_package, get_marker_from_file
+from z3c.testsetup.functional.layer import get_zcml_layer
+from z3c.testsetup.util import get_package
 
 
 class FunctionalDocTestSetup(DocTestSetup):
@@ -39,8 +40,9 @@ class FunctionalDocTestSetup(DocTestSetup):
     """
     ftesting_zcml = os.path.join(os.path.dirname(__file__),
                                  'ftesting.zcml')
-    layer = ZCMLLayer(ftesting_zcml, __name__,
-                      'FunctionalLayer')
+    layer = get_zcml_layer(ftesting_zcml, __name__, 'FunctionalLayer',
+                           ('functional', 'FunctionalLayer'),
+                           factory=ZCMLLayer, dedupe_content=False)
 
     globs = dict(http=HTTPCaller(),
                  getRootFolder=getRootFolder,
@@ -51,7 +53,7 @@ class FunctionalDocTestSetup(DocTestSetup):
                    doctest.REPORT_NDIFF)
 
     regexp_list = [
-        '^\s*:(T|t)est-(L|l)ayer:\s*(functional)\s*',
+        r'^\s*:(T|t)est-(L|l)ayer:\s*(functional)\s*',
         ]
 
     checker = None
@@ -62,23 +64,27 @@ class FunctionalDocTestSetup(DocTestSetup):
         DocTestSetup.__init__(self, package, **kw)
         self.allow_teardown = allow_teardown
         self.checker = checker
+        layer_args = dict(factory=ZCMLLayer, dedupe_content=False)
+        layer_args.update(self.getZCMLLayerArgs())
         # Setup a new layer if specified in params...
         if zcml_config is not None and layer is None:
             if not os.path.isfile(zcml_config):
                 zcml_config = os.path.join(
                     os.path.dirname(self.package.__file__),
                     zcml_config)
-            self.layer = ZCMLLayer(zcml_config, self.package.__name__,
-                                   layer_name,
-                                   allow_teardown=self.allow_teardown)
+            self.layer = get_zcml_layer(
+                zcml_config, self.package.__name__, layer_name,
+                ('functional', layer_name), allow_teardown=self.allow_teardown,
+                **layer_args)
         elif layer is None:
             # Look for ftesting.zcml in pkg-root...
             pkg_ftesting_zcml = os.path.join(
                 os.path.dirname(self.package.__file__), 'ftesting.zcml')
             if os.path.isfile(pkg_ftesting_zcml):
-                self.layer = ZCMLLayer(pkg_ftesting_zcml,
-                                       self.package.__name__, layer_name,
-                                       allow_teardown=self.allow_teardown)
+                self.layer = get_zcml_layer(
+                    pkg_ftesting_zcml, self.package.__name__, layer_name,
+                    ('functional', layer_name),
+                    allow_teardown=self.allow_teardown, **layer_args)
         # Passing a ready-for-use layer overrides layer specified by
         # zcml_config...
         if layer is not None:
@@ -93,14 +99,15 @@ class FunctionalDocTestSetup(DocTestSetup):
 
     def suiteFromFile(self, name):
         suite = unittest.TestSuite()
-        layer = get_marker_from_file('Test-Layerdef', name)
+        layer = self.getMarker('Test-Layerdef', name)
         if os.path.isabs(name):
             # We get absolute pathnames, but we need relative ones...
             common_prefix = os.path.commonprefix([self.package.__file__, name])
             name = name[len(common_prefix):]
         if sys.version_info[:2] > (2, 4):
             self.additional_options.update(encoding=self.encoding)
-        test = FunctionalDocFileSuite(
+        test = self.makeDocFileSuite(
+            FunctionalDocFileSuite,
             name, package=self.package,
             setUp=self.setUp, tearDown=self.tearDown,
             globs=self.globs,
@@ -111,7 +118,7 @@ class FunctionalDocTestSetup(DocTestSetup):
         test.layer = self.layer
         if layer is not None:
             test.layer = layer
-        suite.addTest(test)
+        suite.addTest(self.cacheResults(test, self.setUp, self.tearDown))
         return suite
 
     def getTestSuite(self):
@@ -12,12 +12,159 @@
 #
 ##############################################################################
 """Default layers.
+
+ZCML layers are set up by the testrunner once per layer object. To
+avoid setting up the same configuration over and over, layers are
+taken from a process-wide registry by `get_zcml_layer`.
+
+`SnapshotZCMLLayer` restores registrations recorded in earlier runs
+instead of executing its ZCML (see `z3c.testsetup.snapshot`).
 """
+import hashlib
 import os
+import re
+from contextlib import contextmanager
 from zope.app.testing.functional import ZCMLLayer
+from z3c.testsetup.snapshot import (
+    SnapshotRecorder, get_snapshot_dir, get_snapshot_key, load_snapshot,
+    remove_snapshot, restore_snapshot, save_snapshot)
 
 
 class DefaultZCMLLayer(ZCMLLayer, object):
     def __init__(self, filepath, modname, layername, **kw):
         super(DefaultZCMLLayer, self).__init__(
             filepath, modname, layername, **kw)
+
+
+@contextmanager
+def zcml_replaced(replacement):
+    """Call `replacement` instead of executing ZCML while in context.
+
+    Functional setups execute their ZCML with the `config` function of
+    ``zope.app.appsetup``, as imported by ``zope.app.debug``. If that
+    is not there, ZCML is executed as usual and nothing is replaced.
+    If `replacement` returns ``False``, the ZCML is executed after
+    all.
+    """
+    try:
+        from zope.app.debug import debug
+    except ImportError:
+        debug = None
+    if getattr(debug, 'config', None) is None:
+        yield False
+        return
+    orig_config = debug.config
+
+    def config(*args, **kw):
+        if replacement() is False:
+            return orig_config(*args, **kw)
+    debug.config = config
+    try:
+        yield True
+    finally:
+        debug.config = orig_config
+
+
+class SnapshotZCMLLayer(DefaultZCMLLayer):
+    """A ZCML layer restoring its registrations from a snapshot.
+
+    The first setup executes the ZCML and stores a snapshot of the
+    registrations made in the cache dir. Later setups, also in other
+    processes, restore the snapshot instead. Snapshots that are stale
+    or cannot be restored are replaced by a new one, executing the ZCML
+    again. Without a cache dir, this is a plain `DefaultZCMLLayer`.
+    """
+
+    def __init__(self, filepath, modname, layername, cache_dir=None, **kw):
+        super(SnapshotZCMLLayer, self).__init__(
+            filepath, modname, layername, **kw)
+        self.snapshot_dir = get_snapshot_dir(cache_dir)
+
+    def setUp(self):
+        if self.snapshot_dir is None:
+            return super(SnapshotZCMLLayer, self).setUp()
+        key = get_snapshot_key(self.config_file)
+        data = load_snapshot(self.snapshot_dir, key)
+        recorder = SnapshotRecorder()
+        if data is not None:
+            failed = []
+
+            def restore():
+                if restore_snapshot(data):
+                    return True
+                # Execute the ZCML instead and take a new snapshot.
+                failed.append(True)
+                remove_snapshot(self.snapshot_dir, key)
+                recorder.start()
+                return False
+            with zcml_replaced(restore) as replaced:
+                if replaced:
+                    result = super(SnapshotZCMLLayer, self).setUp()
+                    if failed:
+                        self.saveSnapshot(recorder, key)
+                    return result
+        recorder.start()
+        result = super(SnapshotZCMLLayer, self).setUp()
+        self.saveSnapshot(recorder, key)
+        return result
+
+    def saveSnapshot(self, recorder, key):
+        data = recorder.take()
+        if data is not None:
+            save_snapshot(self.snapshot_dir, key, data)
+
+
+# Attributes in ZCML files that might refer to things relative to the
+# location of the file.
+zcml_relative_regex = re.compile(
+    br"""\b(file|files|template|directory|path|image|icon)\s*=|"""
+    br"""=\s*["']\.""")
+
+zcml_layers = {}
+
+
+def get_zcml_key(filepath):
+    """Get a key telling ZCML files with the same effect apart.
+
+    Files without references to things relative to their location
+    mean the same wherever they are. They are identified by a hash of
+    their content. Other files are identified by their real path.
+    """
+    realpath = os.path.realpath(filepath)
+    try:
+        with open(realpath, 'rb') as fd:
+            content = fd.read()
+    except (IOError, OSError):
+        return realpath
+    if zcml_relative_regex.search(content):
+        return realpath
+    return 'sha1:' + hashlib.sha1(content).hexdigest()
+
+
+def get_zcml_layer(filepath, modname, layername, kind,
+                   allow_teardown=False, factory=DefaultZCMLLayer,
+                   dedupe_content=True, **kw):
+    """Get a ZCML layer for the ZCML file `filepath`.
+
+    Layers are created by `factory` with the other parameters once per
+    ZCML file (see `get_zcml_key`), `allow_teardown`, `factory` and
+    `kind`, a hashable telling the purpose of the layer. Later calls
+    with the same values get the layer created before, including the
+    name it was created with.
+
+    If `dedupe_content` is false, ZCML files are told apart by their
+    real path only, so that each layer keeps its own `config_file`.
+
+    Other keyword arguments are passed to `factory`.
+    """
+    if dedupe_content:
+        zcml_key = get_zcml_key(filepath)
+    else:
+        zcml_key = os.path.realpath(filepath)
+    key = (zcml_key, allow_teardown, kind, factory)
+    layer = zcml_layers.get(key)
+    if layer is None:
+        layer = factory(filepath, modname, layername,
+                        allow_teardown=allow_teardown, **kw)
+        zcml_layers[key] = layer
+    return layer
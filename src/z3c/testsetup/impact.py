@@ -0,0 +1,515 @@
+##############################################################################
+#
+# Copyright (c) 2009 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Test impact analysis.
+
+With `recorded_impact` in effect, a lightweight tracer notes the
+source files each test runs code of or imports. Files are recorded per
+doctest file or test module in an `ImpactDB`, an SQLite database in
+the cache dir. Only the first call of each function is seen, so this
+is much cheaper than measuring coverage. Imports are seen even if the
+module was imported before, so modules only used for their data, like
+constants, count as well.
+
+Given a set of changed files, `select_affected_tests` then drops the
+tests of all doctest files and test modules not touching any of them.
+Tests never recorded are always kept.
+
+On Python 3.12 and newer, `sys.monitoring` is used for tracing, else
+`sys.settrace`. Code run in other threads than the one running the
+tests is not seen.
+"""
+import ast
+import os
+import subprocess
+import sys
+import sysconfig
+import time
+import types
+import unittest
+from contextlib import contextmanager
+from six.moves import builtins
+try:
+    import sqlite3
+except ImportError:
+    # Some Python builds come without SQLite support.
+    sqlite3 = None
+from z3c.testsetup.lazy import LazySuite
+from z3c.testsetup.ordering import get_test_path
+from z3c.testsetup.parallel import (
+    WorkerResult, testrunner_runner, worker_exit_hooks)
+from z3c.testsetup.util import get_cache_dir, warn
+
+IMPACT_FILENAME = 'impact.sqlite'
+
+# `sys.monitoring` tool ids we try to use. 0 to 2 and 5 are taken by
+# debuggers, coverage tools, profilers and optimizers.
+MONITORING_TOOL_IDS = (3, 4)
+
+# Files of Python itself and installed distributions are not recorded.
+IGNORED_PREFIXES = tuple(set([
+    os.path.join(os.path.realpath(path), '')
+    for name, path in sysconfig.get_paths().items()
+    if name in ('stdlib', 'platstdlib', 'purelib', 'platlib')]))
+
+
+def get_module_file(module):
+    """Get the source file of `module` or ``None``.
+    """
+    path = getattr(module, '__file__', None)
+    if path and path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    return path
+
+
+class FileTracer(object):
+    """Find the files code is run from between `start()` and `stop()`.
+
+    Modules imported are seen as well, even if they were imported
+    before and no code of theirs is run, like modules of constants.
+    """
+
+    def __init__(self):
+        self.files = set()
+        self._tool_id = None
+        self._old_trace = None
+        self._old_import = None
+
+    def start(self):
+        self.files = set()
+        self._old_import = builtins.__import__
+        builtins.__import__ = self._import
+        if self._startMonitoring():
+            return
+        self._old_trace = sys.gettrace()
+        sys.settrace(self._trace)
+
+    def _import(self, name, globals=None, locals=None, fromlist=(),
+                level=0):
+        result = self._old_import(name, globals, locals, fromlist, level)
+        try:
+            module = result
+            if not fromlist:
+                # We get the top level package of dotted names.
+                module = sys.modules.get(name, result)
+            modules = [module]
+            for attr in fromlist or ():
+                value = getattr(module, attr, None)
+                if isinstance(value, types.ModuleType):
+                    modules.append(value)
+            for module in modules:
+                path = get_module_file(module)
+                if path is not None:
+                    self.files.add(path)
+        except Exception:
+            # Never break an import for the sake of tracing.
+            pass
+        return result
+
+    def _startMonitoring(self):
+        monitoring = getattr(sys, 'monitoring', None)
+        if monitoring is None:
+            return False
+        for tool_id in MONITORING_TOOL_IDS:
+            try:
+                monitoring.use_tool_id(tool_id, 'z3c.testsetup')
+            except ValueError:
+                continue
+            monitoring.register_callback(
+                tool_id, monitoring.events.PY_START, self._onStart)
+            monitoring.set_events(tool_id, monitoring.events.PY_START)
+            # Code seen by an earlier trace has its events disabled.
+            monitoring.restart_events()
+            self._tool_id = tool_id
+            return True
+        return False
+
+    def _onStart(self, code, offset):
+        self.files.add(code.co_filename)
+        return sys.monitoring.DISABLE
+
+    def _trace(self, frame, event, arg):
+        self.files.add(frame.f_code.co_filename)
+        if self._old_trace is not None:
+            # Keep other tracers (and debuggers) working.
+            return self._old_trace(frame, event, arg)
+        # No tracing of single lines.
+        return None
+
+    def stop(self):
+        """Stop tracing and get the files seen.
+        """
+        if self._old_import is not None:
+            builtins.__import__ = self._old_import
+            self._old_import = None
+        if self._tool_id is not None:
+            monitoring = sys.monitoring
+            monitoring.set_events(self._tool_id, 0)
+            monitoring.register_callback(
+                self._tool_id, monitoring.events.PY_START, None)
+            monitoring.free_tool_id(self._tool_id)
+            self._tool_id = None
+        else:
+            sys.settrace(self._old_trace)
+            self._old_trace = None
+        # We were seen stopping.
+        self.files.discard(sys._getframe().f_code.co_filename)
+        return self.files
+
+
+class ImpactDB(object):
+    """The source files touched by the tests of doctest files and test
+    modules.
+
+    Records are kept in memory until written to disk by `flush()`.
+    Files recorded for a doctest file or test module are added to the
+    ones recorded before. Forked processes start without the records
+    of their parent.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._records = {}
+        self._realpaths = {}
+        self._pid = os.getpid()
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS impact ("
+            "key TEXT, path TEXT, PRIMARY KEY (key, path))")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS traced ("
+            "key TEXT PRIMARY KEY, recorded REAL)")
+        return conn
+
+    def _realpath(self, path):
+        if path not in self._realpaths:
+            realpath = None
+            if not path.startswith('<'):
+                realpath = os.path.realpath(path)
+                if realpath.startswith(IGNORED_PREFIXES):
+                    realpath = None
+            self._realpaths[path] = realpath
+        return self._realpaths[path]
+
+    def add(self, key, files):
+        """Record `files` as touched by the tests of file `key`.
+        """
+        if self._pid != os.getpid():
+            # The parent process writes its records itself.
+            self._records = {}
+            self._pid = os.getpid()
+        key = os.path.realpath(key)
+        paths = self._records.setdefault(key, set([key]))
+        for path in files:
+            path = self._realpath(path)
+            if path is not None:
+                paths.add(path)
+
+    def flush(self):
+        """Write new records to disk.
+        """
+        if not self._records or self._pid != os.getpid():
+            return
+        records, self._records = self._records, {}
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                for key, paths in records.items():
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO impact VALUES (?, ?)",
+                        [(key, path) for path in paths])
+                    conn.execute(
+                        "INSERT OR REPLACE INTO traced VALUES (?, ?)",
+                        (key, now))
+        finally:
+            conn.close()
+
+    def load(self):
+        """Get the recorded files by key and the time keys were last
+        recorded.
+        """
+        impacts = {}
+        recorded = {}
+        if not os.path.exists(self.path):
+            return impacts, recorded
+        conn = self._connect()
+        try:
+            for key, path in conn.execute("SELECT key, path FROM impact"):
+                impacts.setdefault(key, set()).add(path)
+            for key, when in conn.execute("SELECT key, recorded FROM traced"):
+                recorded[key] = when
+        finally:
+            conn.close()
+        return impacts, recorded
+
+    def getAffected(self, changed=None):
+        """Get the keys of recorded tests touching `changed` files and
+        all keys recorded.
+
+        If `changed` is ``None``, files modified since the tests of a
+        key were last recorded count as changed.
+        """
+        impacts, recorded = self.load()
+        if changed is not None:
+            changed = set([os.path.realpath(x) for x in changed])
+            affected = set([key for key, paths in impacts.items()
+                            if not changed.isdisjoint(paths)])
+            return affected, set(recorded)
+        mtimes = {}
+        affected = set()
+        for key, paths in impacts.items():
+            for path in paths:
+                if path not in mtimes:
+                    try:
+                        mtimes[path] = os.stat(path).st_mtime
+                    except OSError:
+                        # Removed files are changed files.
+                        mtimes[path] = None
+                if mtimes[path] is None or (
+                        mtimes[path] > recorded.get(key, 0)):
+                    affected.add(key)
+                    break
+        return affected, set(recorded)
+
+
+impact_dbs = {}
+
+
+def get_impact_db(cache_dir=None):
+    """Get the `ImpactDB` stored in `cache_dir`.
+
+    If no `cache_dir` is given, the one set in the environment is
+    used. Returns ``None`` if there is no cache dir at all.
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is None or sqlite3 is None:
+        return None
+    path = os.path.abspath(os.path.join(cache_dir, IMPACT_FILENAME))
+    if path not in impact_dbs:
+        impact_dbs[path] = ImpactDB(path)
+    return impact_dbs[path]
+
+
+def get_imported_files(module):
+    """Get the files of the modules imported by the source of `module`.
+
+    Test modules import most of what they need before their tests are
+    traced.
+    """
+    path = get_module_file(module)
+    try:
+        with open(path) as fd:
+            tree = ast.parse(fd.read(), path)
+    except (IOError, OSError, TypeError, SyntaxError, ValueError):
+        return set()
+    package = getattr(module, '__package__', None) or ''
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update([x.name for x in node.names])
+        elif isinstance(node, ast.ImportFrom):
+            base = node.module or ''
+            if node.level:
+                parts = package.split('.')
+                parts = parts[:len(parts) - node.level + 1]
+                base = '.'.join([x for x in parts + [base] if x])
+            names.add(base)
+            names.update(['%s.%s' % (base, x.name) for x in node.names])
+    files = set()
+    for name in names:
+        path = get_module_file(sys.modules.get(name))
+        if path is not None:
+            files.add(path)
+    return files
+
+
+def get_test_module(test):
+    """Get the module defining `test`, if it is imported.
+    """
+    dt_test = getattr(test, '_dt_test', None)
+    if dt_test is not None:
+        return sys.modules.get(dt_test.globs.get('__name__'))
+    return sys.modules.get(getattr(test.__class__, '__module__', None))
+
+
+class ImpactRecorder(object):
+    """Trace tests and record the files they touch in `db`.
+
+    For tests defined in modules, the modules imported by the test
+    module count as touched as well.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.tracer = FileTracer()
+        self._test = None
+        self._imported_files = {}
+
+    def getImportedFiles(self, test, key):
+        module = get_test_module(test)
+        path = get_module_file(module)
+        if path is None or os.path.realpath(path) != os.path.realpath(key):
+            return set()
+        if path not in self._imported_files:
+            self._imported_files[path] = get_imported_files(module)
+        return self._imported_files[path]
+
+    def startTest(self, test):
+        if self._test is not None:
+            # A test running tests. The outer one gets all files.
+            return
+        self._test = test
+        self.tracer.start()
+
+    def stopTest(self, test):
+        if test is not self._test:
+            return
+        self._test = None
+        files = self.tracer.stop()
+        key = get_test_path(test)
+        if key is not None:
+            self.db.add(key, files | self.getImportedFiles(test, key))
+
+
+def patch_result_class(cls, orig_start, orig_stop, recorder):
+    # Make results of class `cls` tell `recorder` about tests.
+
+    def startTest(result, test):
+        orig_start(result, test)
+        recorder.startTest(test)
+
+    def stopTest(result, test):
+        recorder.stopTest(test)
+        orig_stop(result, test)
+    cls.startTest = startTest
+    cls.stopTest = stopTest
+
+
+@contextmanager
+def recorded_impact(cache_dir=None):
+    """Record the files touched by tests run while in context.
+    """
+    db = get_impact_db(cache_dir)
+    if db is None:
+        warn("No cache dir or no `sqlite3` available. "
+             "Test impact is not recorded.")
+        yield None
+        return
+    recorder = ImpactRecorder(db)
+    # Results of the testrunner and of its workers.
+    classes = [WorkerResult]
+    if testrunner_runner is not None:
+        classes.append(testrunner_runner.TestResult)
+    originals = [(cls, cls.__dict__['startTest'], cls.__dict__['stopTest'])
+                 for cls in classes]
+    for cls, orig_start, orig_stop in originals:
+        patch_result_class(cls, orig_start, orig_stop, recorder)
+    worker_exit_hooks.append(db.flush)
+    try:
+        yield db
+    finally:
+        for cls, orig_start, orig_stop in originals:
+            cls.startTest = orig_start
+            cls.stopTest = orig_stop
+        worker_exit_hooks.remove(db.flush)
+        db.flush()
+
+
+def _git(args, cwd):
+    with open(os.devnull, 'w') as devnull:
+        output = subprocess.check_output(
+            ['git'] + args, cwd=cwd, stderr=devnull)
+    return output.decode('utf-8').splitlines()
+
+
+def get_git_changes(path):
+    """Get the files changed in the git checkout containing `path`.
+
+    These are the files differing from ``HEAD`` and untracked files.
+    Returns ``None`` if we cannot tell.
+    """
+    try:
+        toplevel = _git(['rev-parse', '--show-toplevel'], path)[0]
+        names = _git(['diff', '--name-only', 'HEAD'], toplevel)
+        names += _git(['ls-files', '--others', '--exclude-standard'],
+                      toplevel)
+    except (OSError, IndexError, subprocess.CalledProcessError):
+        return None
+    return set([os.path.join(toplevel, name) for name in names if name])
+
+
+def select_affected_tests(suite, changed_files, cache_dir=None, path=None):
+    """Get the tests of `suite` affected by `changed_files`.
+
+    `changed_files` is a list of paths, ``'git'`` for the files changed
+    in the git checkout containing `path`, or ``'mtime'`` for files
+    modified since they were recorded. If no impact was recorded or
+    changes cannot be told, we get `suite` as it is.
+    """
+    db = get_impact_db(cache_dir)
+    if db is None:
+        warn("No cache dir or no `sqlite3` available. "
+             "All tests are run.")
+        return suite
+    if changed_files == 'git':
+        changed_files = get_git_changes(path or os.getcwd())
+        if changed_files is None:
+            warn("Cannot tell changed files from git. All tests are run.")
+            return suite
+    elif changed_files == 'mtime':
+        changed_files = None
+    affected, known = db.getAffected(changed_files)
+    if not known:
+        return suite
+
+    def is_affected(test):
+        key = get_test_path(test)
+        if key is None:
+            return True
+        key = os.path.realpath(key)
+        return key in affected or key not in known
+    return filter_suite(suite, is_affected) or unittest.TestSuite()
+
+
+def filter_suite(suite, keep):
+    """Get the tests of `suite` for which `keep(test)` is true.
+
+    Suites of single files are kept or dropped as a whole, without
+    loading lazy ones. Returns ``None`` if no tests are left.
+    """
+    if not isinstance(suite, unittest.TestSuite) or (
+            isinstance(suite, LazySuite) and
+            get_test_path(suite) is not None):
+        if keep(suite):
+            return suite
+        return None
+    if isinstance(suite, LazySuite) and not suite.isIterable():
+        return suite
+    tests = []
+    for test in suite:
+        test = filter_suite(test, keep)
+        if test is not None:
+            tests.append(test)
+    if not tests:
+        return None
+    result = unittest.TestSuite(tests)
+    for name in ('layer', 'level'):
+        if getattr(suite, name, None) is not None:
+            setattr(result, name, getattr(suite, name))
+    return result
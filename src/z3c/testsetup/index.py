@@ -0,0 +1,184 @@
+##############################################################################
+#
+# Copyright (c) 2008-2009 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""A persistent index of test discovery results.
+
+Test discovery means opening and parsing every candidate file of a
+package, even if nothing changed since the last run. A
+`DiscoveryIndex` remembers the marker strings and classification
+results of every file it has seen in an SQLite database. Entries are
+valid as long as size and modification time of the file stay the same,
+so on the next run only changed files are read again.
+
+The index is optional. Test setups use it if they get a ``cache_dir``
+or if the environment variable ``Z3C_TESTSETUP_CACHE_DIR`` is set.
+"""
+import atexit
+import json
+import os
+try:
+    import sqlite3
+except ImportError:
+    # Some Python builds come without SQLite support.
+    sqlite3 = None
+from z3c.testsetup.util import FileMarkers, get_cache_dir, get_stat_key, warn
+
+INDEX_FILENAME = 'discovery.sqlite'
+
+
+class IndexEntry(object):
+    """The things we know about a file.
+    """
+    __slots__ = ('stat_key', 'markers', 'results')
+
+    def __init__(self, stat_key, markers=None, results=None):
+        self.stat_key = stat_key
+        # Markers found in a file by scope.
+        self.markers = markers or {}
+        self.results = results or {}
+
+
+class DiscoveryIndex(object):
+    """A persistent index of discovery results.
+
+    The whole index is loaded into memory when created. Changes are
+    written back to disk by `flush()`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        self._dirty = set()
+        self._checked = set()
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._load()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, "
+            "markers TEXT, results TEXT)")
+        return conn
+
+    def _load(self):
+        conn = self._connect()
+        try:
+            for path, size, mtime, markers, results in conn.execute(
+                    "SELECT path, size, mtime, markers, results FROM files"):
+                self._entries[path] = IndexEntry(
+                    (size, mtime), json.loads(markers), json.loads(results))
+        finally:
+            conn.close()
+
+    def flush(self):
+        """Write changed entries to disk.
+
+        Files are checked for changes again after a flush.
+        """
+        self._checked.clear()
+        if not self._dirty:
+            return
+        rows = []
+        for path in self._dirty:
+            entry = self._entries[path]
+            rows.append((path, entry.stat_key[0], entry.stat_key[1],
+                         json.dumps(entry.markers),
+                         json.dumps(entry.results)))
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                    rows)
+        finally:
+            conn.close()
+        self._dirty.clear()
+
+    def getEntry(self, filepath):
+        """Get the index entry for `filepath`.
+
+        If the file changed since the entry was written, we get a
+        fresh, empty one.
+        """
+        entry = self._entries.get(filepath)
+        if entry is not None and filepath in self._checked:
+            return entry
+        stat_key = get_stat_key(os.stat(filepath))
+        if entry is None or entry.stat_key != stat_key:
+            entry = IndexEntry(stat_key)
+            self._entries[filepath] = entry
+            self._dirty.add(filepath)
+        self._checked.add(filepath)
+        return entry
+
+    def getMarkers(self, filepath, parse, scope=''):
+        """Get the `FileMarkers` of `filepath`.
+
+        `parse` is called with the filepath to get the markers if
+        they are not in the index. Markers found in different parts of
+        a file are kept apart by `scope`.
+        """
+        entry = self.getEntry(filepath)
+        if scope not in entry.markers:
+            markers = parse(filepath)
+            entry.markers[scope] = dict(markers.items())
+            self._dirty.add(filepath)
+            return markers
+        return FileMarkers(filepath, entry.markers[scope])
+
+    def getResult(self, filepath, key, compute, keep=None):
+        """Get a result stored under `key` for `filepath`.
+
+        `compute` is called with the filepath to get the result if it
+        is not in the index. Results must be serializable as JSON.
+        Results for which `keep` returns false are not stored.
+        """
+        entry = self.getEntry(filepath)
+        if key not in entry.results:
+            result = compute(filepath)
+            if keep is not None and not keep(result):
+                return result
+            entry.results[key] = result
+            self._dirty.add(filepath)
+        return entry.results[key]
+
+
+indexes = {}
+
+
+def get_index(cache_dir=None):
+    """Get the `DiscoveryIndex` stored in `cache_dir`.
+
+    If no `cache_dir` is given, the one set in the environment is
+    used. Returns ``None`` if there is no cache dir at all.
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is None:
+        return None
+    if sqlite3 is None:
+        warn("No `sqlite3` available. Discovery results are not cached.")
+        return None
+    path = os.path.abspath(os.path.join(cache_dir, INDEX_FILENAME))
+    if path not in indexes:
+        indexes[path] = DiscoveryIndex(path)
+    return indexes[path]
+
+
+def flush_indexes():
+    for index in indexes.values():
+        index.flush()
+
+atexit.register(flush_indexes)
@@ -0,0 +1,392 @@
+##############################################################################
+#
+# Copyright (c) 2008-2009 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Lazy test suites.
+
+Building a test suite normally means importing every test module and
+loading all of its tests, even if the testrunner is told to run only a
+few of them. The suites defined here defer this work until tests are
+really needed.
+
+For modules where the test ids can be told from the source alone, a
+`LazyModuleSuite` delivers placeholder tests with the right ids. The
+module is imported only when one of them is run. For other modules, it
+is imported when the testrunner iterates into the suite.
+
+A `LazyDocFileSuite` does the same for doctest files: they are read
+and parsed only when their test is run.
+"""
+import ast
+import doctest
+import os
+import sys
+import unittest
+from functools import partial
+from six.moves import builtins
+
+# Names of things in a module that make test ids unpredictable.
+_UNSAFE_NAMES = ('load_tests', )
+
+# Attributes of test classes known to be missing if test names could
+# be found statically. Testrunners look them up to group tests.
+_STATIC_ATTRS = ('layer', 'level')
+
+
+def _get_base_name(node):
+    """Get the dotted name of a base class expression or ``None``.
+    """
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        parent = _get_base_name(node.value)
+        if parent is None:
+            return None
+        return parent + '.' + node.attr
+    return None
+
+
+def _is_unsafe_import(module_name, name):
+    # Imported TestCase classes are collected by the test loader as
+    # well. Any class might be one, so we only trust the classes of
+    # `unittest` that are no tests themselves.
+    if not name[:1].isupper():
+        return False
+    if module_name == 'unittest':
+        obj = getattr(unittest, name, None)
+        if isinstance(obj, type) and (
+                obj is unittest.TestCase or
+                not issubclass(obj, unittest.TestCase)):
+            return False
+    return True
+
+
+def _is_unsafe_assignment(node, name):
+    # ``Checks = base.SharedChecks`` makes a test class as well.
+    if not name[:1].isupper() or node.value is None:
+        return False
+    try:
+        ast.literal_eval(node.value)
+    except (ValueError, TypeError, SyntaxError):
+        return True
+    return False
+
+
+def _get_assigned_names(node):
+    names = []
+    targets = getattr(node, 'targets', None) or [getattr(node, 'target')]
+    for target in targets:
+        for sub in ast.walk(target):
+            if isinstance(sub, ast.Name):
+                names.append(sub.id)
+    return names
+
+
+def get_static_test_names(source, filename='<unknown>'):
+    """Get the names of the tests a module defines from its `source`.
+
+    Returns a list of ``(class_name, [method_name, ...])`` tuples in
+    the order `unittest.TestLoader.loadTestsFromModule` delivers
+    them. Returns ``None`` if this cannot be told for sure without
+    importing the module, for instance because test classes derive
+    from classes defined elsewhere or the module defines
+    ``load_tests``.
+    """
+    try:
+        tree = ast.parse(source, filename)
+    except (SyntaxError, ValueError, TypeError):
+        return None
+    # Local classes: name -> (is_testcase, set of test method names)
+    classes = {}
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)) and (
+                node.name in _UNSAFE_NAMES):
+            return None
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            module_name = getattr(node, 'module', None)
+            for alias in node.names:
+                if alias.name == '*':
+                    return None
+                for name in (alias.asname, alias.name.split('.')[-1]):
+                    if name and _is_unsafe_import(module_name, name):
+                        return None
+            continue
+        if isinstance(node, (ast.Assign, getattr(ast, 'AnnAssign', ()))):
+            for name in _get_assigned_names(node):
+                if name in classes or name in _UNSAFE_NAMES or (
+                        _is_unsafe_assignment(node, name)):
+                    return None
+            continue
+        if isinstance(node, (ast.FunctionDef,
+                             getattr(ast, 'AsyncFunctionDef', ()))):
+            continue
+        if not isinstance(node, ast.ClassDef):
+            for sub in ast.walk(node):
+                if isinstance(sub, ast.ClassDef):
+                    # Conditionally defined classes.
+                    return None
+            continue
+        if getattr(node, 'keywords', None):
+            # Metaclasses and the like.
+            return None
+        is_testcase = False
+        methods = set()
+        for base in node.bases:
+            base_name = _get_base_name(base)
+            if base_name is None:
+                return None
+            if base_name in classes:
+                base_is_testcase, base_methods = classes[base_name]
+                is_testcase = is_testcase or base_is_testcase
+                methods.update(base_methods)
+            elif base_name in ('TestCase', 'unittest.TestCase'):
+                is_testcase = True
+            elif '.' in base_name or not hasattr(builtins, base_name):
+                # Some class from elsewhere. Might be a TestCase.
+                return None
+        for item in node.body:
+            if isinstance(item, (ast.FunctionDef,
+                                 getattr(ast, 'AsyncFunctionDef', ()))):
+                if item.name.startswith('test'):
+                    methods.add(item.name)
+            elif isinstance(item, (ast.Assign,
+                                   getattr(ast, 'AnnAssign', ()))):
+                for name in _get_assigned_names(item):
+                    if name.startswith('test') or name == 'runTest' or (
+                            name in _STATIC_ATTRS):
+                        # Tests or layers we cannot be sure about.
+                        return None
+        for item in node.body:
+            if getattr(item, 'name', None) == 'runTest' and not methods:
+                methods.add('runTest')
+        classes[node.name] = (is_testcase, methods)
+    result = []
+    for name in sorted(classes):
+        is_testcase, methods = classes[name]
+        if is_testcase and methods:
+            result.append((name, sorted(methods)))
+    return result
+
+
+def get_test_descriptions(module_name, class_name, method_names):
+    """Get ``(id, str)`` tuples of tests in a class not imported yet.
+
+    The descriptions are made by `unittest` itself from a stand-in
+    class, so they look exactly like the ones of the real tests.
+    """
+    attrs = dict([(x, lambda self: None) for x in method_names])
+    attrs['__module__'] = module_name
+    cls = type(str(class_name), (unittest.TestCase, ), attrs)
+    cls.__qualname__ = class_name
+    result = []
+    for method_name in method_names:
+        test = cls(method_name)
+        result.append((test.id(), str(test)))
+    return result
+
+
+class LazyTest(object):
+    """A placeholder for a test in a module not imported yet.
+
+    The real test is looked up when the placeholder is run or anything
+    but its id is asked for.
+    """
+    failureException = AssertionError
+
+    def __init__(self, suite, test_id, description):
+        self._suite = suite
+        self._id = test_id
+        self._description = description
+
+    def id(self):
+        return self._id
+
+    def __str__(self):
+        return self._description
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self._id)
+
+    def countTestCases(self):
+        return 1
+
+    def shortDescription(self):
+        return None
+
+    def getTest(self):
+        return self._suite.getTest(self._id)
+
+    def __call__(self, result):
+        return self.run(result)
+
+    def run(self, result):
+        try:
+            test = self.getTest()
+        except Exception:
+            result.startTest(self)
+            result.addError(self, sys.exc_info())
+            result.stopTest(self)
+            return result
+        return test(result)
+
+    def debug(self):
+        self.getTest().debug()
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in _STATIC_ATTRS:
+            raise AttributeError(name)
+        return getattr(self.getTest(), name)
+
+
+class LazySuite(unittest.TestSuite):
+    """A suite loading its tests when needed.
+
+    `load_tests` is called without arguments to get the real tests.
+    If `lazy_tests` is given, it is a list of `LazyTest` placeholders
+    delivered when iterating over the suite before the real tests are
+    loaded. Otherwise the real tests are loaded as soon as the suite
+    is iterated over.
+    """
+
+    def __init__(self, load_tests, lazy_tests=None):
+        unittest.TestSuite.__init__(self)
+        self._load_tests = load_tests
+        self._loaded = False
+        self._lazy_tests = lazy_tests
+
+    def isIterable(self):
+        """Can we iterate over this suite without loading tests?
+        """
+        return self._loaded or self._lazy_tests is not None
+
+    def loadTests(self):
+        """Get the real tests.
+        """
+        return self._load_tests()
+
+    def load(self):
+        """Load the real tests.
+        """
+        if self._loaded:
+            return
+        tests = self.loadTests()
+        self._loaded = True
+        self.addTest(tests)
+
+    def getTest(self, test_id):
+        """Get the real test with id `test_id`.
+        """
+        self.load()
+        for test in iter_tests(self._tests):
+            if test.id() == test_id:
+                return test
+        raise LookupError("No test %s found in %r" % (test_id, self))
+
+    def __iter__(self):
+        if self._lazy_tests is not None and not self._loaded:
+            return iter(self._lazy_tests)
+        self.load()
+        return unittest.TestSuite.__iter__(self)
+
+    def countTestCases(self):
+        if self._lazy_tests is not None and not self._loaded:
+            return len(self._lazy_tests)
+        self.load()
+        return unittest.TestSuite.countTestCases(self)
+
+    def run(self, result, *args, **kw):
+        self.load()
+        return unittest.TestSuite.run(self, result, *args, **kw)
+
+    def debug(self):
+        self.load()
+        return unittest.TestSuite.debug(self)
+
+
+def load_module_tests(module_info):
+    """Get the tests of the module `module_info` stands for.
+    """
+    module = module_info.getModule()
+    return unittest.defaultTestLoader.loadTestsFromModule(module)
+
+
+class LazyModuleSuite(LazySuite):
+    """The tests of a module, loaded when needed.
+
+    `module_info` is a martian `ModuleInfo` of the test module.
+    """
+
+    def __init__(self, module_info):
+        LazySuite.__init__(self, partial(load_module_tests, module_info))
+        self.module_info = module_info
+        try:
+            with open(module_info.path, 'rb') as fd:
+                source = fd.read()
+        except (IOError, OSError):
+            return
+        names = get_static_test_names(source, module_info.path)
+        if names is None:
+            return
+        self._lazy_tests = []
+        for class_name, method_names in names:
+            for test_id, description in get_test_descriptions(
+                    module_info.dotted_name, class_name, method_names):
+                self._lazy_tests.append(LazyTest(self, test_id, description))
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__,
+                            self.module_info.dotted_name)
+
+
+class LazyDocFileSuite(LazySuite):
+    """A doctest file suite, created when needed.
+
+    `suite_creator` is `doctest.DocFileSuite` or a compatible
+    function like `FunctionalDocFileSuite`. It is called with `path`
+    and the keyword arguments when the tests are needed. Until then,
+    the doctest file is neither read nor parsed.
+    """
+
+    def __init__(self, suite_creator, path, **kw):
+        self.suite_creator = suite_creator
+        self.path = path
+        self.kw = kw
+        LazySuite.__init__(self, partial(suite_creator, path, **kw))
+        # The path of the doctest file, if we can tell.
+        self.filename = None
+        filename = path
+        if kw.get('module_relative', True):
+            if kw.get('package') is None:
+                # Relative to the module creating the suite. We cannot
+                # tell which one that is.
+                return
+            filename = doctest._module_relative_path(
+                doctest._normalize_module(kw['package']), path)
+        self.filename = filename
+        # Let doctest tell how its tests are called.
+        case = doctest.DocFileCase(doctest.DocTest(
+            [], {}, os.path.basename(path), filename, 0, None))
+        self._lazy_tests = [LazyTest(self, case.id(), str(case))]
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.path)
+
+
+def iter_tests(tests):
+    """Iterate over the single tests in `tests`, descending into suites.
+    """
+    for test in tests:
+        if isinstance(test, unittest.TestSuite):
+            for sub in iter_tests(test):
+                yield sub
+        elif test is not None:
+            yield test
@@ -0,0 +1,375 @@
+##############################################################################
+#
+# Copyright (c) 2008-2009 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Ordering of test suites by layer.
+
+TestCollectors nest the suites of their getters one after another, so
+tests of one layer end up scattered all over the suite. `order_by_layer`
+regroups the tests of a suite by layer:
+
+- Unit tests (tests without a layer) come first.
+
+- Layers sharing base layers are kept together, so bases are set up
+  only once.
+
+- Groups of layers that are cheap to set up come before expensive
+  ones, if setup costs were recorded.
+
+- Layers that cannot be torn down (like ZCML layers with
+  ``allow_teardown=False``) come last, as running any other layer
+  after them means spawning a new process.
+
+Layers are not imported to order them: lazy layer proxies are ordered
+by their name.
+
+The testrunner regroups tests by layer and runs layers in an order of
+its own, though. `ordered_layers` makes it run layers in the order
+described above, which `z3c.testsetup.testrunner.run` does when
+given ``order_layers=True``.
+
+Within each layer, tests can be ordered by a priority. `RunPriority`
+puts tests that failed last time and tests whose files changed since
+they were last run first. The testrunner decides about the order of
+layers itself, so failing tests come first in their layer only.
+"""
+import json
+import os
+import sys
+import tempfile
+import unittest
+from contextlib import contextmanager
+from six import string_types
+try:
+    from zope.testrunner import runner as testrunner_runner
+except ImportError:
+    testrunner_runner = None
+from z3c.testsetup.lazy import (
+    LazyDocFileSuite, LazyModuleSuite, LazySuite, LazyTest)
+from z3c.testsetup.util import LazyAttribute, get_cache_dir
+
+UNIT_LAYER_NAME = 'zope.testrunner.layer.UnitTests'
+
+LAYER_COSTS_FILENAME = 'layer-costs.json'
+
+
+def get_layer_name(layer):
+    """Get the name a testrunner knows `layer` by.
+    """
+    if layer is None:
+        return UNIT_LAYER_NAME
+    if isinstance(layer, string_types):
+        return layer
+    return '%s.%s' % (layer.__module__, layer.__name__)
+
+
+def get_layer_chain(layer):
+    """Get the names of the bases of `layer` and `layer` itself.
+
+    The most basic layers come first. Layers not imported yet have no
+    known bases.
+    """
+    if layer is None or isinstance(layer, (string_types, LazyAttribute)):
+        return (get_layer_name(layer), )
+    chain = []
+
+    def gather(layer):
+        for base in getattr(layer, '__bases__', ()):
+            if base is not object:
+                gather(base)
+        name = get_layer_name(layer)
+        if name not in chain:
+            chain.append(name)
+
+    gather(layer)
+    return tuple(chain)
+
+
+def allows_teardown(layer):
+    """Can `layer` and all its bases be torn down?
+
+    Layers not imported yet are expected to allow teardown.
+    """
+    if layer is None or isinstance(layer, (string_types, LazyAttribute)):
+        return True
+    if getattr(layer, 'allow_teardown', True) is False:
+        return False
+    for base in getattr(layer, '__bases__', ()):
+        if base is not object and not allows_teardown(base):
+            return False
+    return True
+
+
+def iter_layered_tests(suite, layer=None, level=None):
+    """Iterate over ``(test, layer, level)`` for the tests in `suite`.
+
+    Like in the testrunner, the layer and level set closest to a test
+    win. Lazy suites are not descended into if this would load their
+    tests.
+    """
+    layer = getattr(suite, 'layer', layer)
+    level = getattr(suite, 'level', level)
+    if isinstance(suite, LazySuite) and not suite.isIterable():
+        yield suite, layer, level
+        return
+    if isinstance(suite, unittest.TestSuite):
+        for test in suite:
+            for item in iter_layered_tests(test, layer, level):
+                yield item
+        return
+    yield suite, layer, level
+
+
+def load_layer_costs(cache_dir=None):
+    """Get the recorded setup costs of layers by layer name.
+
+    Costs are read from the cache dir. If there is none or no costs
+    were recorded, we get an empty dict.
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is None:
+        return {}
+    try:
+        with open(os.path.join(cache_dir, LAYER_COSTS_FILENAME)) as fd:
+            costs = json.load(fd)
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(costs, dict):
+        return {}
+    return costs
+
+
+def save_layer_costs(costs, cache_dir=None):
+    """Store the setup costs of layers in the cache dir.
+
+    `costs` maps layer names to setup costs in seconds. Costs of other
+    layers recorded before are kept.
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is None or not costs:
+        return
+    merged = load_layer_costs(cache_dir)
+    merged.update(costs)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(merged, tmp_file, indent=1, sort_keys=True)
+        getattr(os, 'replace', os.rename)(
+            tmp_path, os.path.join(cache_dir, LAYER_COSTS_FILENAME))
+    except (IOError, OSError):
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def get_test_path(test):
+    """Get the path of the file defining `test`.
+
+    Lazy tests and suites are not loaded for this. Tests wrapping
+    others tell the path as `test_path`. Returns ``None`` if we cannot
+    tell.
+    """
+    path = getattr(test, '__dict__', {}).get('test_path')
+    if path is not None:
+        return path
+    if isinstance(test, LazyTest):
+        test = test._suite
+    if isinstance(test, LazyModuleSuite):
+        return test.module_info.path
+    if isinstance(test, LazyDocFileSuite):
+        return test.filename
+    if isinstance(test, unittest.TestSuite):
+        return None
+    dt_test = getattr(test, '_dt_test', None)
+    if dt_test is not None:
+        return dt_test.filename
+    module = sys.modules.get(type(test).__module__)
+    path = getattr(module, '__file__', None)
+    if path and path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    return path
+
+
+class RunPriority(object):
+    """Rank tests by how likely they fail.
+
+    Tests that failed or errored last time (if `failed_first` is set)
+    rank before tests whose file changed since they were last run (if
+    `changed_first` is set), which rank before all others. Lower ranks
+    come first.
+
+    `outcomes` maps test ids to the last outcome recorded,
+    `last_runs` test ids to the time they were last run, as recorded
+    by `z3c.testsetup.timings.TimingDB`. Tests never run before count
+    as changed, unless nothing was recorded at all.
+    """
+
+    def __init__(self, outcomes, last_runs, failed_first=True,
+                 changed_first=True):
+        self.failed = set([test_id for test_id, outcome in outcomes.items()
+                           if outcome in ('failure', 'error')])
+        self.last_runs = last_runs
+        self.failed_first = failed_first
+        self.changed_first = changed_first and bool(last_runs)
+        self._mtimes = {}
+
+    def getTestIds(self, test):
+        """Get the ids of the tests in `test`.
+
+        For suites we cannot look into, these are the recorded ids
+        starting with the name of their module.
+        """
+        if isinstance(test, LazyModuleSuite):
+            prefix = test.module_info.dotted_name + '.'
+            return [test_id for test_id in self.last_runs
+                    if test_id.startswith(prefix)]
+        if isinstance(test, unittest.TestSuite):
+            return []
+        return [test.id()]
+
+    def getMTime(self, path):
+        if path not in self._mtimes:
+            try:
+                self._mtimes[path] = os.stat(path).st_mtime
+            except (OSError, TypeError):
+                self._mtimes[path] = None
+        return self._mtimes[path]
+
+    def isChanged(self, test, test_ids):
+        mtime = self.getMTime(get_test_path(test))
+        if mtime is None:
+            return False
+        if not test_ids:
+            return True
+        return min([self.last_runs.get(test_id, 0)
+                    for test_id in test_ids]) < mtime
+
+    def __call__(self, test):
+        test_ids = self.getTestIds(test)
+        if self.failed_first and self.failed.intersection(test_ids):
+            return 0
+        if self.changed_first and self.isChanged(test, test_ids):
+            return 1
+        return 2
+
+
+def order_runner_layers(layers, costs=None):
+    """Order the ``(layer_name, layer, tests)`` of a testrunner like
+    `order_by_layer` orders suites.
+
+    The testrunner orders layers by name, bases first. This order is
+    kept within each family of layers.
+    """
+    costs = costs or {}
+    families = {}
+    family_order = []
+    for item in layers:
+        layer_name, layer = item[:2]
+        family_key = (layer_name != UNIT_LAYER_NAME,
+                      not allows_teardown(layer),
+                      get_layer_chain(layer)[0])
+        if family_key not in families:
+            families[family_key] = []
+            family_order.append(family_key)
+        families[family_key].append(item)
+
+    def family_sort_key(family_key):
+        unit_last, no_teardown, root = family_key
+        cost = sum([costs.get(x[0], 0) or 0 for x in families[family_key]])
+        return (unit_last, no_teardown, cost, family_order.index(family_key))
+
+    result = []
+    for family_key in sorted(family_order, key=family_sort_key):
+        result.extend(families[family_key])
+    return result
+
+
+@contextmanager
+def ordered_layers(costs=None):
+    """Make the testrunner run layers in the order of
+    `order_runner_layers` while in context.
+
+    Otherwise layers that cannot be torn down might be run before
+    others, which then have to be run in a subprocess.
+    """
+    if testrunner_runner is None:
+        yield
+        return
+    orig_ordered_layers = testrunner_runner.Runner.ordered_layers
+
+    def ordered_layers(runner):
+        layers = list(orig_ordered_layers(runner))
+        head = []
+        if ((runner.options.processes or 1) > 1 and
+                not runner.options.resume_layer):
+            # The fake layer spreading layers over subprocesses.
+            head, layers = layers[:1], layers[1:]
+        return iter(head + order_runner_layers(layers, costs))
+    testrunner_runner.Runner.ordered_layers = ordered_layers
+    try:
+        yield
+    finally:
+        testrunner_runner.Runner.ordered_layers = orig_ordered_layers
+
+
+def order_by_layer(suite, costs=None, priority=None):
+    """Get a suite with the tests of `suite` grouped by layer.
+
+    `costs` maps layer names to setup costs in seconds. If `priority`
+    is given, tests of a layer are ordered by ``priority(test)``,
+    lowest first. Tests of equal priority keep their order.
+    """
+    costs = costs or {}
+    groups = {}
+    layers = {}
+    keys = []
+    for test, layer, level in iter_layered_tests(suite):
+        key = (get_layer_name(layer), level)
+        if key not in groups:
+            groups[key] = []
+            layers[key] = layer
+            keys.append(key)
+        groups[key].append(test)
+    # Layers sharing the same most basic layer form a family.
+    families = {}
+    family_order = []
+    for key in keys:
+        layer = layers[key]
+        chain = get_layer_chain(layer)
+        family_key = (key[0] != UNIT_LAYER_NAME, not allows_teardown(layer),
+                      chain[0])
+        if family_key not in families:
+            families[family_key] = []
+            family_order.append(family_key)
+        families[family_key].append((chain, key))
+
+    def family_sort_key(family_key):
+        unit_last, no_teardown, root = family_key
+        cost = sum([costs.get(key[0], 0) or 0
+                    for chain, key in families[family_key]])
+        return (unit_last, no_teardown, cost, family_order.index(family_key))
+
+    result = unittest.TestSuite()
+    for family_key in sorted(family_order, key=family_sort_key):
+        for chain, key in sorted(families[family_key],
+                                 key=lambda x: (x[0], str(x[1][1]))):
+            tests = groups[key]
+            if priority is not None:
+                tests = sorted(tests, key=priority)
+            group = unittest.TestSuite(tests)
+            if layers[key] is not None:
+                group.layer = layers[key]
+            if key[1] is not None:
+                group.level = key[1]
+            result.addTest(group)
+    return result
@@ -0,0 +1,327 @@
+##############################################################################
+#
+# Copyright (c) 2009 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Running the tests of a layer in forked worker processes.
+
+Setting up a layer is often much more expensive than running its
+tests. With `forked_layers` in effect, the testrunner sets up each
+layer once as usual. Then a number of worker processes is forked,
+which inherit the set up layer and run the tests of the layer between
+them, one at a time as they become free. Outcomes are sent back and
+reported by the testrunner as if the tests ran in the main process.
+
+This needs `os.fork` and the `zope.testrunner` internals. Where either
+is missing, tests run serially as before.
+"""
+import os
+import select
+import sys
+import time
+import traceback
+import unittest
+from contextlib import contextmanager
+from multiprocessing import Pipe
+try:
+    from zope.testrunner import runner as testrunner_runner
+    from zope.testrunner.exceptions import DocTestFailureException
+except ImportError:
+    testrunner_runner = None
+    DocTestFailureException = AssertionError
+
+# CPU time of this process.
+process_time = getattr(time, 'process_time', None) or time.clock
+
+# Functions called when a worker process is done. Forked workers exit
+# without running `atexit` functions.
+worker_exit_hooks = []
+
+
+def run_worker_exit_hooks():
+    for hook in worker_exit_hooks:
+        try:
+            hook()
+        except Exception:
+            traceback.print_exc()
+
+
+class RemoteFailure(DocTestFailureException):
+    """A failure or error reported by a worker process.
+
+    The only argument is the formatted traceback. The testrunner
+    prints it as is, like the output of failed doctests.
+    """
+
+
+def format_exc_info(output, exc_info):
+    """Format `exc_info` the way testrunner `output` would.
+    """
+    format_traceback = getattr(output, 'format_traceback', None)
+    if format_traceback is not None:
+        return format_traceback(exc_info)
+    return ''.join(traceback.format_exception(*exc_info))
+
+
+class WorkerResult(unittest.TestResult):
+    """Collect the outcomes of a test run in a worker.
+
+    Outcomes are recorded as ``(method_name, argument)`` events to be
+    replayed by `replay_events` in the main process. The CPU time
+    taken comes as ``('cpu', seconds)`` first. `layers` are the
+    layers whose `testSetUp` and `testTearDown` are called around each
+    test.
+    """
+
+    def __init__(self, output, layers=()):
+        unittest.TestResult.__init__(self)
+        self.output = output
+        self.layers = list(layers)
+        self.events = []
+        self.duration = 0.0
+
+    def startTest(self, test):
+        for layer in self.layers:
+            if hasattr(layer, 'testSetUp'):
+                layer.testSetUp()
+        unittest.TestResult.startTest(self, test)
+        self._start_time = time.time()
+        self._cpu_start = process_time()
+
+    def stopTest(self, test):
+        self.duration = time.time() - self._start_time
+        self.events.insert(0, ('cpu', process_time() - self._cpu_start))
+        for layer in reversed(self.layers):
+            if hasattr(layer, 'testTearDown'):
+                layer.testTearDown()
+        unittest.TestResult.stopTest(self, test)
+
+    def addSuccess(self, test):
+        self.events.append(('addSuccess', None))
+
+    def addFailure(self, test, exc_info):
+        self.events.append(
+            ('addFailure', format_exc_info(self.output, exc_info)))
+
+    def addError(self, test, exc_info):
+        self.events.append(
+            ('addError', format_exc_info(self.output, exc_info)))
+
+    def addSkip(self, test, reason):
+        self.events.append(('addSkip', reason))
+
+    def addExpectedFailure(self, test, exc_info):
+        self.events.append(
+            ('addExpectedFailure', format_exc_info(self.output, exc_info)))
+
+    def addUnexpectedSuccess(self, test):
+        self.events.append(('addUnexpectedSuccess', None))
+
+    def addSubTest(self, test, subtest, exc_info):
+        if exc_info is None:
+            return
+        method = 'addError'
+        if issubclass(exc_info[0], test.failureException):
+            method = 'addFailure'
+        self.events.append((method, '%s\n%s' % (
+            subtest, format_exc_info(self.output, exc_info))))
+
+
+def replay_events(result, test, duration, events):
+    """Report outcomes recorded by a `WorkerResult` to `result`.
+    """
+    result.startTest(test)
+    # Make the testrunner result report the time taken in the worker.
+    result._start_time = time.time() - duration
+    output = result.options.output
+    for method, arg in events:
+        if method == 'cpu':
+            if hasattr(output, 'set_cpu_time'):
+                output.set_cpu_time(arg)
+        elif method in ('addSuccess', 'addUnexpectedSuccess'):
+            getattr(result, method)(test)
+        elif method == 'addSkip':
+            result.addSkip(test, arg)
+        else:
+            getattr(result, method)(
+                test, (RemoteFailure, RemoteFailure(arg), None))
+    result.stopTest(test)
+
+
+def _run_worker(conn, tests, output, layers):
+    # Run tests by index as told by the main process until told to
+    # stop.
+    result = WorkerResult(output, layers)
+    while True:
+        index = conn.recv()
+        if index is None:
+            break
+        result.events = []
+        result.duration = 0.0
+        tests[index](result)
+        conn.send((index, result.duration, result.events))
+    conn.close()
+
+
+class ForkedPool(object):
+    """A pool of forked processes running `tests` by index.
+    """
+
+    def __init__(self, tests, workers, output=None, layers=()):
+        self.tests = tests
+        self.workers = workers
+        self.output = output
+        self.layers = layers
+        # conn -> (pid, index of the running test)
+        self.running = {}
+        self._pending = iter(range(len(tests)))
+
+    def fork(self):
+        parent_conn, child_conn = Pipe()
+        pid = os.fork()
+        if pid == 0:
+            parent_conn.close()
+            status = 0
+            try:
+                _run_worker(child_conn, self.tests, self.output, self.layers)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                run_worker_exit_hooks()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                # Never return into the testrunner of the main process.
+                os._exit(status)
+        child_conn.close()
+        self.running[parent_conn] = (pid, None)
+        self.feed(parent_conn)
+
+    def feed(self, conn):
+        """Give the worker at `conn` its next test or stop it.
+        """
+        pid = self.running[conn][0]
+        index = next(self._pending, None)
+        if index is None:
+            self.close(conn)
+            return
+        self.running[conn] = (pid, index)
+        conn.send(index)
+
+    def close(self, conn):
+        pid = self.running.pop(conn)[0]
+        try:
+            conn.send(None)
+        except (IOError, OSError):
+            pass
+        conn.close()
+        os.waitpid(pid, 0)
+
+    def stop(self):
+        """Stop handing out tests.
+        """
+        self._pending = iter(())
+
+    def results(self):
+        """Iterate over ``(index, duration, events)`` of finished tests.
+
+        If a worker dies, its test is reported as an error.
+        """
+        for num in range(min(self.workers, len(self.tests))):
+            self.fork()
+        while self.running:
+            ready, _, _ = select.select(list(self.running), [], [])
+            for conn in ready:
+                pid, index = self.running[conn]
+                try:
+                    message = conn.recv()
+                except (EOFError, IOError, OSError):
+                    del self.running[conn]
+                    conn.close()
+                    os.waitpid(pid, 0)
+                    yield index, 0.0, [('addError', (
+                        'Worker process %s died while running the '
+                        'test.\n' % pid))]
+                    continue
+                yield message
+                self.feed(conn)
+
+
+def can_fork(options, tests, workers):
+    """Can we run `tests` in forked workers with `options`?
+    """
+    return (workers is not None and workers > 1 and len(tests) > 1 and
+            hasattr(os, 'fork') and testrunner_runner is not None and
+            not options.post_mortem and (options.repeat or 1) == 1 and
+            not options.report_refcounts)
+
+
+def run_tests_forked(workers, options, tests, name, failures, errors,
+                     skipped, import_errors):
+    """Run the `tests` of layer `name` in `workers` forked processes.
+
+    Called by the testrunner in place of its `run_tests` after the
+    layer was set up. Reports tests and their outcomes like it.
+    """
+    output = options.output
+    if options.verbose > 0 or options.progress:
+        output.info('  Running:')
+    result = testrunner_runner.TestResult(options, tests, layer_name=name)
+    # Per-test layer hooks are run by the workers.
+    layers, result.layers = result.layers, []
+    # Flush, so that workers do not write buffered output again.
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pool = ForkedPool(tests, workers, output, layers)
+    start = time.time()
+    for index, duration, events in pool.results():
+        replay_events(result, tests[index], duration, events)
+        if result.shouldStop:
+            pool.stop()
+    seconds = time.time() - start
+    output.stop_tests()
+    failures.extend(result.failures)
+    n_failures = len(result.failures)
+    failures.extend([(s, None) for s in result.unexpectedSuccesses])
+    n_failures += len(result.unexpectedSuccesses)
+    skipped.extend(result.skipped)
+    errors.extend(result.errors)
+    output.summary(n_tests=result.testsRun,
+                   n_failures=n_failures,
+                   n_errors=len(result.errors) + len(import_errors),
+                   n_seconds=seconds,
+                   n_skipped=len(result.skipped))
+    return result.testsRun
+
+
+@contextmanager
+def forked_layers(workers):
+    """Make the testrunner run tests of each layer in `workers`
+    forked processes while in context.
+    """
+    if testrunner_runner is None or not workers or workers < 2:
+        yield
+        return
+    orig_run_tests = testrunner_runner.run_tests
+
+    def run_tests(options, tests, name, failures, errors, skipped,
+                  import_errors):
+        tests = list(tests)
+        if not can_fork(options, tests, workers):
+            return orig_run_tests(options, tests, name, failures, errors,
+                                  skipped, import_errors)
+        return run_tests_forked(workers, options, tests, name, failures,
+                                errors, skipped, import_errors)
+    testrunner_runner.run_tests = run_tests
+    try:
+        yield
+    finally:
+        testrunner_runner.run_tests = orig_run_tests
@@ -0,0 +1,209 @@
+##############################################################################
+#
+# Copyright (c) 2008-2009 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""A persistent cache of parsed doctests.
+
+Parsing a doctest file into examples happens again on every test run,
+although doctest files seldom change. A `DocTestParseCache` stores the
+examples of each doctest text in a directory, keyed by a hash of the
+text and the Python version. `CachingDocTestParser` is a
+`doctest.DocTestParser` using such a cache. It can be passed as
+``parser`` to `doctest.DocFileSuite` and friends.
+
+The cache directory is bounded in size. If it grows too big, the
+entries used least recently are removed.
+
+Like the discovery index, the cache is used if test setups get a
+``cache_dir`` or the environment variable ``Z3C_TESTSETUP_CACHE_DIR``
+is set.
+"""
+import doctest
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+from six import text_type
+from z3c.testsetup.util import get_cache_dir
+
+PARSE_CACHE_DIRNAME = 'doctests'
+
+# Bump this if the format of cache entries changes.
+PARSE_CACHE_VERSION = 1
+
+# Default size limit of the cache directory in bytes.
+PARSE_CACHE_MAX_BYTES = 50 * 1024 * 1024
+
+
+def get_parse_key(text, name):
+    """Get the cache key of doctest `text` called `name`.
+    """
+    digest = hashlib.sha1()
+    digest.update(repr((PARSE_CACHE_VERSION, sys.version, marshal.version,
+                        name)).encode('utf-8'))
+    if isinstance(text, text_type):
+        text = text.encode('utf-8', 'backslashreplace')
+    digest.update(text)
+    return digest.hexdigest()
+
+
+def dump_examples(examples):
+    """Turn `doctest.Example` objects into marshallable data.
+
+    Option flags are stored by name, as their numbers depend on the
+    order they were registered in.
+    """
+    names = dict([(v, k) for k, v in doctest.OPTIONFLAGS_BY_NAME.items()])
+    result = []
+    for example in examples:
+        options = [(names[flag], value)
+                   for flag, value in example.options.items()]
+        result.append((example.source, example.want, example.exc_msg,
+                       example.lineno, example.indent, options))
+    return result
+
+
+def load_examples(data):
+    """Turn data made by `dump_examples` into `doctest.Example` objects.
+
+    Returns ``None`` if an option flag is not registered (anymore).
+    """
+    result = []
+    for source, want, exc_msg, lineno, indent, options in data:
+        try:
+            options = dict([(doctest.OPTIONFLAGS_BY_NAME[name], value)
+                            for name, value in options])
+        except KeyError:
+            return None
+        result.append(doctest.Example(
+            source, want, exc_msg=exc_msg, lineno=lineno, indent=indent,
+            options=options))
+    return result
+
+
+class DocTestParseCache(object):
+    """A directory of parsed doctests.
+
+    Each entry lives in a file of its own, named by its key. Reading an
+    entry touches its file, so that the modification times tell which
+    entries were used least recently.
+    """
+
+    def __init__(self, path, max_bytes=PARSE_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        # Size of all entries, computed when first needed.
+        self._size = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def get(self, key):
+        """Get the data stored under `key` or ``None``.
+        """
+        filepath = os.path.join(self.path, key)
+        try:
+            with open(filepath, 'rb') as fd:
+                data = marshal.load(fd)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        try:
+            os.utime(filepath, None)
+        except OSError:
+            pass
+        return data
+
+    def set(self, key, data):
+        """Store marshallable `data` under `key`.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                marshal.dump(data, tmp_file)
+            size = os.path.getsize(tmp_path)
+            # Atomically replace older entries, also on Windows.
+            getattr(os, 'replace', os.rename)(
+                tmp_path, os.path.join(self.path, key))
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return
+        if self._size is None:
+            self.evict()
+            return
+        self._size += size
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache is small
+        enough.
+        """
+        entries = []
+        total = 0
+        for filename in os.listdir(self.path):
+            if filename.startswith('.'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, filename))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+            total += stat.st_size
+        entries.sort()
+        for mtime, size, filename in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(os.path.join(self.path, filename))
+            except OSError:
+                continue
+            total -= size
+        self._size = total
+
+
+class CachingDocTestParser(doctest.DocTestParser):
+    """A doctest parser remembering the examples it found in a
+    `DocTestParseCache`.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get_examples(self, string, name='<string>'):
+        key = get_parse_key(string, name)
+        data = self.cache.get(key)
+        if data is not None:
+            examples = load_examples(data)
+            if examples is not None:
+                return examples
+        examples = doctest.DocTestParser.get_examples(self, string, name)
+        self.cache.set(key, dump_examples(examples))
+        return examples
+
+
+parse_caches = {}
+
+
+def get_parse_cache(cache_dir=None):
+    """Get the `DocTestParseCache` stored in `cache_dir`.
+
+    If no `cache_dir` is given, the one set in the environment is
+    used. Returns ``None`` if there is no cache dir at all.
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is None:
+        return None
+    path = os.path.abspath(os.path.join(cache_dir, PARSE_CACHE_DIRNAME))
+    if path not in parse_caches:
+        parse_caches[path] = DocTestParseCache(path)
+    return parse_caches[path]
@@ -0,0 +1,453 @@
+##############################################################################
+#
+# Copyright (c) 2009 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Caching the results of passing doctests.
+
+Many doctests are deterministic: as long as neither the doctest file
+nor the code it runs changes, they pass again. With result caching
+enabled, a `ResultCache` in the cache dir remembers the doctests that
+passed. For each it keeps
+
+- a key made of the contents of the doctest file, the names of its
+  setup, teardown, layer and checker, its option flags and its globs,
+  and
+
+- the state of all files the test ran code from or imported, the files
+  defining its setup, teardown, layer and checker, and the ZCML files
+  of its layer.
+
+When tests are collected again and key and files are unchanged, the
+test is replaced by a `CachedPassTest` reporting a pass without
+running anything. Cached tests belong to no layer, so layers left
+without other tests are not set up at all.
+
+Tests that are run are wrapped by a `RecordingTest` storing or
+dropping their cache entry depending on the outcome.
+"""
+import hashlib
+import inspect
+import json
+import os
+import re
+import sys
+import unittest
+from six import string_types
+try:
+    import sqlite3
+except ImportError:
+    # Some Python builds come without SQLite support.
+    sqlite3 = None
+from z3c.testsetup.impact import FileTracer
+from z3c.testsetup.lazy import LazySuite, iter_tests
+from z3c.testsetup.ordering import get_test_path
+from z3c.testsetup.util import LazyAttribute, get_cache_dir, get_stat_key
+
+RESULTS_FILENAME = 'results.sqlite'
+
+# Change this if the meaning of keys changes.
+RESULTS_VERSION = 2
+
+
+# Hashes of file contents by ``(path, stat_key)``.
+file_hashes = {}
+
+
+def get_file_state(path):
+    """Get ``[size, mtime, sha1]`` of file `path` or ``None`` if there
+    is no such file.
+    """
+    try:
+        stat_key = get_stat_key(os.stat(path))
+    except (OSError, TypeError):
+        return None
+    if (path, stat_key) not in file_hashes:
+        try:
+            with open(path, 'rb') as fd:
+                digest = hashlib.sha1(fd.read()).hexdigest()
+        except (IOError, OSError):
+            return None
+        file_hashes[(path, stat_key)] = digest
+    return [stat_key[0], stat_key[1], file_hashes[(path, stat_key)]]
+
+
+def is_unchanged(path, state):
+    """Is file `path` still in `state` as got from `get_file_state`?
+    """
+    try:
+        stat_key = get_stat_key(os.stat(path))
+    except OSError:
+        return False
+    if list(stat_key) == list(state[:2]):
+        return True
+    current = get_file_state(path)
+    return current is not None and current[2] == state[2]
+
+
+def get_target_name(target):
+    """Get the dotted name of a setup, teardown or layer `target`.
+    """
+    if target is None:
+        return ''
+    if isinstance(target, LazyAttribute):
+        return target._name
+    if isinstance(target, string_types):
+        return target
+    name = getattr(target, '__qualname__', None)
+    if name is None:
+        name = getattr(target, '__name__', repr(target))
+        im_class = getattr(target, 'im_class', None)
+        if im_class is not None:
+            name = '%s.%s' % (im_class.__name__, name)
+    return '%s.%s' % (getattr(target, '__module__', ''), name)
+
+
+def get_glob_repr(value):
+    """Get a representation of glob `value` that is the same in every
+    run.
+    """
+    if inspect.isclass(value) or inspect.isroutine(value):
+        return get_target_name(value)
+    # Addresses change with every run.
+    return re.sub(r' at 0x[0-9a-fA-F]+', '', repr(value))
+
+
+def get_result_key(path, targets, optionflags=0, globs=None):
+    """Get the key of the doctest file `path` run with `targets`.
+
+    `targets` are the setup, teardown, layer and checker class of the
+    test. `optionflags` and `globs` are the ones the test is run with.
+    """
+    state = get_file_state(path)
+    if state is None:
+        return None
+    parts = [str(RESULTS_VERSION), state[2]]
+    parts.extend([get_target_name(x) for x in targets])
+    parts.append(str(optionflags or 0))
+    for name, value in sorted((globs or {}).items()):
+        parts.append('%s=%s' % (name, get_glob_repr(value)))
+    return hashlib.sha1('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+def _get_source_path(obj):
+    module = sys.modules.get(getattr(obj, '__module__', None) or '')
+    path = getattr(module, '__file__', None)
+    if path is None and inspect.isclass(obj):
+        # The module might be gone from `sys.modules`. Ask the code
+        # of the class.
+        for value in vars(obj).values():
+            code = getattr(getattr(value, '__func__', value), '__code__',
+                           None)
+            if code is not None:
+                return code.co_filename
+    if path and path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    return path
+
+
+def get_target_files(targets):
+    """Get the files defining `targets`.
+
+    Lazy targets are resolved. For layers, the files defining their
+    bases and their ZCML files count as well.
+    """
+    from z3c.testsetup.snapshot import iter_zcml_files
+    paths = set()
+    for target in targets:
+        if target is None or isinstance(target, string_types):
+            continue
+        if isinstance(target, LazyAttribute):
+            target = target.resolve()
+        objects = [target]
+        if inspect.isclass(target):
+            objects = inspect.getmro(target)
+        elif getattr(target, '__self__', None) is not None:
+            objects.extend(inspect.getmro(type(target.__self__)))
+        for obj in objects:
+            path = _get_source_path(obj)
+            if path is not None:
+                paths.add(path)
+        config_file = getattr(target, 'config_file', None)
+        if isinstance(config_file, string_types):
+            paths.update(iter_zcml_files(config_file))
+    return paths
+
+
+class ResultCache(object):
+    """The doctests that passed, stored in an SQLite database.
+
+    Entries are written to disk at once, so workers of the testrunner
+    can record them as well.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "name TEXT PRIMARY KEY, key TEXT, files TEXT)")
+        return conn
+
+    def _execute(self, statement, args):
+        conn = self._connect()
+        try:
+            with conn:
+                return conn.execute(statement, args).fetchall()
+        finally:
+            conn.close()
+
+    def get(self, name):
+        """Get ``(key, files)`` of test `name` or ``None``.
+        """
+        if not os.path.exists(self.path):
+            return None
+        rows = self._execute(
+            "SELECT key, files FROM results WHERE name = ?", (name, ))
+        if not rows:
+            return None
+        return rows[0][0], json.loads(rows[0][1])
+
+    def set(self, name, key, paths):
+        """Note that test `name` passed with `key`, running code from
+        the files in `paths`.
+        """
+        files = {}
+        for path in paths:
+            state = get_file_state(path)
+            if state is not None:
+                files[path] = state
+        self._execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                      (name, key, json.dumps(files, sort_keys=True)))
+
+    def drop(self, name):
+        if os.path.exists(self.path):
+            self._execute("DELETE FROM results WHERE name = ?", (name, ))
+
+    def isPassed(self, name, key):
+        """Did test `name` pass with `key` before, with all files it
+        depends on unchanged?
+        """
+        entry = self.get(name)
+        if entry is None or entry[0] != key:
+            return False
+        for path, state in entry[1].items():
+            if not is_unchanged(path, state):
+                return False
+        return True
+
+
+result_caches = {}
+
+
+def get_result_cache(cache_dir=None):
+    """Get the `ResultCache` stored in `cache_dir`.
+
+    If no `cache_dir` is given, the one set in the environment is
+    used. Returns ``None`` if there is no cache dir at all.
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is None or sqlite3 is None:
+        return None
+    path = os.path.abspath(os.path.join(cache_dir, RESULTS_FILENAME))
+    if path not in result_caches:
+        result_caches[path] = ResultCache(path)
+    return result_caches[path]
+
+
+def get_cache_name(path, test):
+    # Doctest ids are not unique across packages.
+    return '%s:%s' % (path, test.id())
+
+
+class CachedPassTest(object):
+    """A test that passed before, reported as passed without running.
+    """
+    failureException = AssertionError
+
+    def __init__(self, test_id, description, path):
+        self._id = test_id
+        self._description = description
+        # The file defining the test, see `get_test_path`.
+        self.test_path = path
+
+    def id(self):
+        return self._id
+
+    def __str__(self):
+        return '%s (cached)' % self._description
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self._id)
+
+    def countTestCases(self):
+        return 1
+
+    def shortDescription(self):
+        return None
+
+    def __call__(self, result):
+        return self.run(result)
+
+    def run(self, result):
+        result.startTest(self)
+        result.addSuccess(self)
+        result.stopTest(self)
+        return result
+
+    def debug(self):
+        pass
+
+
+class OutcomeResult(object):
+    """A proxy for test result `result`, noting the outcome of a test.
+    """
+
+    def __init__(self, result):
+        self._result = result
+        self.passed = None
+
+    def __getattr__(self, name):
+        return getattr(self._result, name)
+
+    def addSuccess(self, test):
+        if self.passed is None:
+            self.passed = True
+        return self._result.addSuccess(test)
+
+    def _failed(self, method, *args):
+        self.passed = False
+        return getattr(self._result, method)(*args)
+
+    def addFailure(self, test, exc_info):
+        return self._failed('addFailure', test, exc_info)
+
+    def addError(self, test, exc_info):
+        return self._failed('addError', test, exc_info)
+
+    def addSkip(self, test, reason):
+        return self._failed('addSkip', test, reason)
+
+    def addExpectedFailure(self, test, exc_info):
+        return self._failed('addExpectedFailure', test, exc_info)
+
+    def addUnexpectedSuccess(self, test):
+        return self._failed('addUnexpectedSuccess', test)
+
+    def addSubTest(self, test, subtest, exc_info):
+        if exc_info is not None:
+            self.passed = False
+        return self._result.addSubTest(test, subtest, exc_info)
+
+
+class RecordingTest(object):
+    """Test `test` recording whether it passed in `cache`.
+    """
+
+    def __init__(self, test, cache, path, key, targets):
+        self._test = test
+        self._cache = cache
+        self._key = key
+        self._targets = targets
+        # The file defining the test, see `get_test_path`.
+        self.test_path = path
+
+    def id(self):
+        return self._test.id()
+
+    def __str__(self):
+        return str(self._test)
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self._test)
+
+    def countTestCases(self):
+        return self._test.countTestCases()
+
+    def shortDescription(self):
+        return self._test.shortDescription()
+
+    def __call__(self, result):
+        return self.run(result)
+
+    def run(self, result):
+        outcome = OutcomeResult(result)
+        tracer = FileTracer()
+        tracer.start()
+        try:
+            self._test(outcome)
+        finally:
+            files = tracer.stop()
+        name = get_cache_name(self.test_path, self._test)
+        if outcome.passed:
+            paths = set([self.test_path])
+            paths.update([x for x in files if not x.startswith('<')])
+            paths.update(get_target_files(self._targets))
+            self._cache.set(name, self._key, paths)
+        else:
+            self._cache.drop(name)
+        return result
+
+    def debug(self):
+        self._test.debug()
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self._test, name)
+
+
+def cache_results(suite, cache, setup=None, teardown=None, checker=None,
+                  optionflags=0, globs=None):
+    """Get `suite` with tests that passed before replaced by
+    `CachedPassTest` placeholders.
+
+    The placeholders are taken out of the layer of `suite`. Other tests
+    record their outcome in `cache` when they are run. `checker`,
+    `optionflags` and `globs` are the ones the tests of `suite` were
+    created with.
+    """
+    if isinstance(suite, LazySuite) and not suite.isIterable():
+        # We would have to load the tests to tell their ids.
+        return suite
+    layer = getattr(suite, 'layer', None)
+    checker_class = None
+    if checker is not None:
+        checker_class = type(checker)
+    targets = (setup, teardown, layer, checker_class)
+    cached = []
+    others = []
+    for test in iter_tests(suite):
+        path = get_test_path(test)
+        key = None
+        if path is not None:
+            path = os.path.realpath(path)
+            key = get_result_key(path, targets, optionflags, globs)
+        if key is None:
+            others.append(test)
+        elif cache.isPassed(get_cache_name(path, test), key):
+            cached.append(CachedPassTest(test.id(), str(test), path))
+        else:
+            others.append(RecordingTest(test, cache, path, key, targets))
+    result = unittest.TestSuite(cached)
+    if others:
+        rest = unittest.TestSuite(others)
+        for name in ('layer', 'level'):
+            if getattr(suite, name, None) is not None:
+                setattr(rest, name, getattr(suite, name))
+        result.addTest(rest)
+    return result
+
@@ -0,0 +1,215 @@
+##############################################################################
+#
+# Copyright (c) 2008-2009 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Shared package scans.
+
+A package scan remembers the directory listings and file contents
+seen while looking for tests in a package. TestCollectors hand one
+scan to all the test setups they run, so that the package tree is
+walked and every candidate file is read only once, regardless of the
+number of setups looking at it.
+"""
+import fnmatch
+import os
+import os.path
+import re
+from collections import deque
+from z3c.testsetup.util import get_file_markers, read_bytes, decode_text
+try:
+    from os import scandir
+except ImportError:
+    # Python < 3.5
+    scandir = None
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2 without the `futures` backport.
+    ThreadPoolExecutor = None
+
+
+def list_entries(dirpath):
+    """Get the entries of directory `dirpath`.
+
+    Returns a list of ``(abs_path, is_dir)`` tuples in directory order.
+    Where available, the file type is taken from the directory entry
+    itself, so that only symlinks have to be stat'ed.
+    """
+    entries = []
+    if scandir is None:
+        for filename in os.listdir(dirpath):
+            abs_path = os.path.join(dirpath, filename)
+            entries.append((abs_path, os.path.isdir(abs_path)))
+        return entries
+    for entry in scandir(dirpath):
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            # Broken symlinks and the like.
+            is_dir = False
+        entries.append((entry.path, is_dir))
+    return entries
+
+
+_exclude_regexs = {}
+
+
+def get_exclude_regex(patterns):
+    """Get a compiled regex matching any of the glob `patterns`.
+
+    Returns ``None`` if there are no patterns.
+    """
+    patterns = tuple(patterns or ())
+    if not patterns:
+        return None
+    if patterns not in _exclude_regexs:
+        _exclude_regexs[patterns] = re.compile(
+            '|'.join([fnmatch.translate(x) for x in patterns]))
+    return _exclude_regexs[patterns]
+
+
+def walk_files(dirpath, dir_filter, file_filter, exclude=(),
+               listdir=list_entries):
+    """Iterate over files below `dirpath` accepted by `file_filter`.
+
+    If `file_filter` is ``None``, all files are accepted.
+
+    Directories are descended into if `dir_filter` accepts them. Files
+    and directories whose basename matches any of the glob patterns in
+    `exclude` are skipped before anything else is done with them. Each
+    directory is visited only once, even if it can be reached through
+    several symlinks, which also protects us from symlink loops.
+
+    The files come in the order a depth-first walk through the
+    directory listings delivers them.
+    """
+    excluded = get_exclude_regex(exclude)
+    seen = set()
+
+    def visit(path):
+        # Have we seen this directory before?
+        stat = os.stat(path)
+        key = (stat.st_dev, stat.st_ino)
+        if key in seen:
+            return False
+        seen.add(key)
+        return True
+
+    visit(dirpath)
+    stack = [iter(listdir(dirpath))]
+    while stack:
+        for abs_path, is_dir in stack[-1]:
+            if excluded is not None and excluded.match(
+                    os.path.basename(abs_path)):
+                continue
+            if not is_dir:
+                if file_filter is None or file_filter(abs_path):
+                    yield abs_path
+                continue
+            if not dir_filter(abs_path) or not visit(abs_path):
+                continue
+            # Search the subdirectory before going on with this one.
+            stack.append(iter(listdir(abs_path)))
+            break
+        else:
+            stack.pop()
+
+
+def filter_files(paths, file_filter, workers, max_pending=None):
+    """Iterate over the `paths` accepted by `file_filter`.
+
+    Up to `workers` threads call `file_filter` at the same time, with
+    at most `max_pending` paths (by default four per worker) handed to
+    them but not yet yielded. Reading files is mostly waiting for the
+    filesystem, so this pays off on cold caches and network
+    filesystems. Paths are yielded in the order they came in.
+    """
+    if max_pending is None:
+        max_pending = workers * 4
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for path in paths:
+            pending.append((path, executor.submit(file_filter, path)))
+            if len(pending) < max_pending:
+                continue
+            path, future = pending.popleft()
+            if future.result():
+                yield path
+        while pending:
+            path, future = pending.popleft()
+            if future.result():
+                yield path
+
+
+class PackageScan(object):
+    """A cache of directory listings and file contents.
+
+    Setups ask the scan for directory listings and file contents
+    instead of going to the filesystem themselves. Everything is
+    looked up lazily on first request, so directories pruned by all
+    setups are never listed and files rejected by their name are
+    never read.
+    """
+
+    def __init__(self):
+        self._listings = {}
+        self._bytes = {}
+        self._texts = {}
+        self._markers = {}
+
+    def listdir(self, dirpath):
+        """Get the entries of directory `dirpath`.
+
+        Returns a list of ``(abs_path, is_dir)`` tuples in directory
+        order.
+        """
+        entries = self._listings.get(dirpath)
+        if entries is None:
+            entries = list_entries(dirpath)
+            self._listings[dirpath] = entries
+        return entries
+
+    def readBytes(self, filepath, max_bytes=None, max_lines=None):
+        """Get the contents of `filepath` as bytes.
+
+        See `z3c.testsetup.util.read_bytes` for `max_bytes` and
+        `max_lines`.
+        """
+        key = (filepath, max_bytes, max_lines)
+        raw = self._bytes.get(key)
+        if raw is None:
+            raw = read_bytes(filepath, max_bytes, max_lines)
+            self._bytes[key] = raw
+        return raw
+
+    def read(self, filepath, max_bytes=None, max_lines=None):
+        """Get the contents of `filepath` as text.
+
+        The text is decoded only once and only when asked for.
+        """
+        key = (filepath, max_bytes, max_lines)
+        text = self._texts.get(key)
+        if text is None:
+            text = decode_text(self.readBytes(filepath, max_bytes, max_lines))
+            self._texts[key] = text
+        return text
+
+    def markers(self, filepath, max_bytes=None, max_lines=None):
+        """Get the markerstrings of `filepath` as `FileMarkers` record.
+        """
+        key = (filepath, max_bytes, max_lines)
+        markers = self._markers.get(key)
+        if markers is None:
+            markers = get_file_markers(filepath, self.readBytes, max_bytes,
+                                       max_lines)
+            self._markers[key] = markers
+        return markers
@@ -0,0 +1,455 @@
+##############################################################################
+#
+# Copyright (c) 2009 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Running all layers in a pool of worker processes.
+
+With `scheduled_layers` in effect, the testrunner does not run the
+layers one after another itself. Instead, the tests of each layer are
+cut into units: the whole layer or, for layers taking long, chunks of
+its tests. Units are handed to a pool of worker processes forked before
+any layer is set up.
+
+Units are scheduled longest first, using the recorded durations of
+tests and setup costs of layers, which keeps workers equally busy
+until the end. A free worker gets the longest unit of a layer it has
+set up already, if there is one, so layers are set up as rarely as
+possible. Workers set up and tear down layers as the testrunner does.
+A worker that cannot tear down a layer it no longer needs is replaced
+by a fresh one, as is a worker using more memory than allowed.
+
+Workers report the outcomes of each unit when it is done. They are
+reported by the testrunner like the ones of a layer run in a
+subprocess.
+"""
+import os
+import select
+import sys
+import time
+import traceback
+from contextlib import contextmanager
+from multiprocessing import Pipe
+from six import StringIO
+from z3c.testsetup.ordering import UNIT_LAYER_NAME
+from z3c.testsetup.parallel import (
+    RemoteFailure, WorkerResult, format_exc_info, replay_events,
+    run_worker_exit_hooks, testrunner_runner)
+
+# Estimated duration in seconds of tests without recorded durations.
+DEFAULT_TEST_DURATION = 0.1
+
+# Estimated setup cost in seconds of layers without recorded costs.
+DEFAULT_LAYER_COST = 1.0
+
+# Units per worker we aim for when cutting layers into chunks.
+UNITS_PER_WORKER = 4
+
+
+class Unit(object):
+    """Tests of a layer to be run by one worker.
+
+    `indexes` point into the list of tests of the layer.
+    """
+
+    def __init__(self, layer_name, indexes, cost):
+        self.layer_name = layer_name
+        self.indexes = indexes
+        self.cost = cost
+
+    def __repr__(self):
+        return '<Unit %s (%s tests)>' % (self.layer_name, len(self.indexes))
+
+
+def make_units(layer_tests, workers, durations=None, layer_costs=None):
+    """Cut the tests of layers into units.
+
+    `layer_tests` is a list of ``(layer_name, tests)``. `durations` maps
+    test ids to recorded durations, `layer_costs` layer names to setup
+    costs, both in seconds. Layers are cut into chunks of about equal
+    duration if their tests take long compared to the whole run and
+    to setting up the layer. Returns the units, longest first.
+    """
+    durations = durations or {}
+    layer_costs = layer_costs or {}
+    estimates = []
+    total = 0.0
+    for layer_name, tests in layer_tests:
+        times = [durations.get(test.id(), DEFAULT_TEST_DURATION)
+                 for test in tests]
+        estimates.append((layer_name, times))
+        total += sum(times)
+    target = total / (workers * UNITS_PER_WORKER) if workers else total
+    units = []
+    for layer_name, times in estimates:
+        setup_cost = layer_costs.get(layer_name)
+        if setup_cost is None:
+            setup_cost = DEFAULT_LAYER_COST
+            if layer_name == UNIT_LAYER_NAME:
+                setup_cost = 0.0
+        num_chunks = 1
+        if target > 0:
+            num_chunks = int(sum(times) / max(target, setup_cost))
+        num_chunks = max(1, min(num_chunks, workers, len(times)))
+        chunk_size = sum(times) / num_chunks
+        chunks = []
+        indexes = []
+        cost = 0.0
+        for index, seconds in enumerate(times):
+            indexes.append(index)
+            cost += seconds
+            if cost >= chunk_size and len(chunks) < num_chunks - 1:
+                chunks.append((indexes, cost))
+                indexes = []
+                cost = 0.0
+        if indexes:
+            chunks.append((indexes, cost))
+        for indexes, cost in chunks:
+            units.append(Unit(layer_name, indexes, cost + setup_cost))
+    units.sort(key=lambda x: -x.cost)
+    return units
+
+
+def get_memory_usage():
+    """Get the resident memory of this process in bytes or ``None``.
+    """
+    try:
+        with open('/proc/self/statm') as fd:
+            pages = int(fd.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return usage
+    return usage * 1024
+
+
+def get_layers(layer):
+    """Get `layer` and its bases, most basic first.
+    """
+    gathered = []
+    testrunner_runner.gather_layers(layer, gathered)
+    return testrunner_runner.order_by_bases(gathered)
+
+
+def run_unit(options, layer, tests, indexes, setup_layers):
+    """Set up `layer` and run the `tests` at `indexes`.
+
+    Returns a message for the main process.
+    """
+    layers = get_layers(layer)
+    errors = []
+    try:
+        testrunner_runner.tear_down_unneeded(
+            options, dict.fromkeys(layers, 1), setup_layers, errors)
+    except testrunner_runner.CanNotTearDown:
+        return ('restart', None)
+    try:
+        testrunner_runner.setup_layer(options, layer, setup_layers)
+    except Exception:
+        return ('setup-error', format_exc_info(options.output,
+                                               sys.exc_info()))
+    result = WorkerResult(options.output, layers)
+    outcomes = []
+    for index in indexes:
+        result.events = []
+        result.duration = 0.0
+        tests[index](result)
+        outcomes.append((index, result.duration, result.events))
+        if result.shouldStop:
+            break
+    return ('done', outcomes)
+
+
+def _run_worker(conn, options, layers, units, max_memory):
+    # Run units as told by the main process until told to stop.
+    try:
+        _run_units(conn, options, layers, units, max_memory)
+    finally:
+        # Timings of layer setups are recorded here.
+        if hasattr(options.output, 'flush_timings'):
+            options.output.flush_timings()
+
+
+def _run_units(conn, options, layers, units, max_memory):
+    setup_layers = {}
+    while True:
+        unit_no = conn.recv()
+        if unit_no is None:
+            break
+        unit = units[unit_no]
+        layer, tests = layers[unit.layer_name]
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = captured = StringIO()
+        try:
+            kind, data = run_unit(options, layer, tests, unit.indexes,
+                                  setup_layers)
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        retire = kind != 'done' or (
+            max_memory is not None and
+            (get_memory_usage() or 0) > max_memory)
+        conn.send((kind, unit_no, data, captured.getvalue(), retire))
+        if retire:
+            return
+    sys.stdout = sys.stderr = StringIO()
+    testrunner_runner.tear_down_unneeded(
+        options, (), setup_layers, [], optional=True)
+
+
+class Worker(object):
+    """A forked worker process as seen from the main process.
+    """
+
+    def __init__(self, pid, conn):
+        self.pid = pid
+        self.conn = conn
+        self.layer_name = None
+        self.unit_no = None
+
+
+class WorkerPool(object):
+    """Up to `workers` processes running `units`.
+
+    `layers` maps layer names to ``(layer, tests)``.
+    """
+
+    # Seconds to wait for workers at most before calling `idle`.
+    poll_interval = None
+
+    def __init__(self, options, layers, units, workers, max_memory=None):
+        self.options = options
+        self.layers = layers
+        self.units = units
+        self.workers = workers
+        self.max_memory = max_memory
+        self.pending = list(range(len(units)))
+        self.running = {}
+
+    def fork(self):
+        parent_conn, child_conn = Pipe()
+        pid = os.fork()
+        if pid == 0:
+            parent_conn.close()
+            status = 0
+            try:
+                _run_worker(child_conn, self.options, self.layers,
+                            self.units, self.max_memory)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                run_worker_exit_hooks()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                # Never return into the testrunner of the main process.
+                os._exit(status)
+        child_conn.close()
+        worker = Worker(pid, parent_conn)
+        self.running[parent_conn] = worker
+        return worker
+
+    def has_pending(self):
+        return bool(self.pending)
+
+    def next_unit(self, worker):
+        """Pick the next unit for `worker`, preferring units of the
+        layer it has set up. Returns ``None`` if there is none left.
+        """
+        if not self.pending:
+            return None
+        for pos, unit_no in enumerate(self.pending):
+            if self.units[unit_no].layer_name == worker.layer_name:
+                return self.pending.pop(pos)
+        return self.pending.pop(0)
+
+    def feed(self, worker):
+        """Give `worker` its next unit or stop it.
+        """
+        unit_no = self.next_unit(worker)
+        if unit_no is None:
+            self.close(worker)
+            return
+        worker.unit_no = unit_no
+        worker.conn.send(unit_no)
+
+    def put_back(self, unit_no):
+        """Hand out `unit_no` again.
+        """
+        self.pending.insert(0, unit_no)
+
+    def idle(self):
+        """Called whenever waiting for workers is over, at least every
+        `poll_interval` seconds.
+        """
+
+    def close(self, worker):
+        del self.running[worker.conn]
+        try:
+            worker.conn.send(None)
+        except (IOError, OSError):
+            pass
+        worker.conn.close()
+        os.waitpid(worker.pid, 0)
+
+    def stop(self):
+        """Stop handing out units.
+        """
+        self.pending = []
+
+    def results(self):
+        """Iterate over ``(unit, kind, data, output)`` of finished units.
+
+        `kind` is ``'done'`` with the outcomes of tests in `data`, or
+        ``'setup-error'`` with the formatted traceback. If a worker
+        dies, its unit is reported as ``'died'``.
+        """
+        while self.has_pending() or self.running:
+            while self.has_pending() and len(self.running) < self.workers:
+                self.feed(self.fork())
+            if not self.running:
+                break
+            ready, _, _ = select.select(list(self.running), [], [],
+                                        self.poll_interval)
+            self.idle()
+            for conn in ready:
+                worker = self.running[conn]
+                try:
+                    kind, unit_no, data, output, retire = conn.recv()
+                except (EOFError, IOError, OSError):
+                    del self.running[conn]
+                    conn.close()
+                    os.waitpid(worker.pid, 0)
+                    yield self.units[worker.unit_no], 'died', None, ''
+                    continue
+                if kind == 'restart':
+                    # The worker could not tear down its layers. Run
+                    # the unit in a fresh one.
+                    self.put_back(unit_no)
+                else:
+                    worker.layer_name = self.units[unit_no].layer_name
+                    yield self.units[unit_no], kind, data, output
+                if retire:
+                    self.close(worker)
+                else:
+                    self.feed(worker)
+
+
+def report_unit(runner, unit, kind, data, output_text):
+    """Report the outcome of `unit` like the testrunner would.
+    """
+    options = runner.options
+    output = options.output
+    layer, tests = runner._scheduled_layers[unit.layer_name]
+    unit_tests = [tests[index] for index in unit.indexes]
+    output.info("Running %s tests:" % unit.layer_name)
+    sys.stdout.write(output_text)
+    if kind == 'setup-error':
+        output.error(data)
+        runner.errors.append((
+            testrunner_runner.SetUpLayerFailure(layer),
+            (RemoteFailure, RemoteFailure(data), None)))
+        return None
+    if kind == 'died':
+        data = [(index, 0.0, [('addError', 'Worker process died.\n')])
+                for index in unit.indexes]
+    result = testrunner_runner.TestResult(
+        options, unit_tests, layer_name=unit.layer_name)
+    result.layers = []
+    start = time.time()
+    for index, duration, events in data:
+        replay_events(result, tests[index], duration, events)
+    output.stop_tests()
+    runner.failures.extend(result.failures)
+    runner.failures.extend([(s, None) for s in result.unexpectedSuccesses])
+    runner.skipped.extend(result.skipped)
+    runner.errors.extend(result.errors)
+    output.summary(n_tests=result.testsRun,
+                   n_failures=(len(result.failures) +
+                               len(result.unexpectedSuccesses)),
+                   n_errors=len(result.errors),
+                   n_seconds=sum([x[1] for x in data]) or (
+                       time.time() - start),
+                   n_skipped=len(result.skipped))
+    runner.ran += result.testsRun
+    return result
+
+
+def run_scheduled(runner, workers, durations=None, layer_costs=None,
+                  max_memory=None):
+    """Run the tests registered with testrunner `runner` in a pool of
+    `workers` processes.
+
+    Used in place of `Runner.run_tests`.
+    """
+    layer_tests = []
+    runner._scheduled_layers = {}
+    for layer_name, layer, tests in runner.ordered_layers():
+        tests = list(tests)
+        if not tests:
+            continue
+        runner._scheduled_layers[layer_name] = (layer, tests)
+        layer_tests.append((layer_name, tests))
+    units = make_units(layer_tests, workers, durations, layer_costs)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pool = WorkerPool(runner.options, runner._scheduled_layers, units,
+                      workers, max_memory)
+    for unit, kind, data, output_text in pool.results():
+        result = report_unit(runner, unit, kind, data, output_text)
+        if runner.options.stop_on_error and (runner.failures or
+                                             runner.errors):
+            pool.stop()
+        elif result is not None and result.shouldStop:
+            pool.stop()
+    del runner._scheduled_layers
+    runner.failed = bool(runner.import_errors or runner.failures or
+                         runner.errors)
+
+
+def can_schedule(options, workers):
+    """Can we run tests with `options` in a pool of `workers`?
+    """
+    return (workers is not None and workers > 1 and hasattr(os, 'fork') and
+            testrunner_runner is not None and not options.post_mortem and
+            not options.resume_layer and (options.repeat or 1) == 1 and
+            not options.report_refcounts)
+
+
+@contextmanager
+def scheduled_layers(workers, durations=None, layer_costs=None,
+                     max_memory=None):
+    """Make the testrunner run all layers in a pool of `workers`
+    processes while in context.
+
+    `max_memory` is the resident memory in bytes above which workers
+    are replaced after their current unit.
+    """
+    if testrunner_runner is None or not workers or workers < 2:
+        yield
+        return
+    orig_run_tests = testrunner_runner.Runner.run_tests
+
+    def run_tests(runner):
+        if not can_schedule(runner.options, workers):
+            return orig_run_tests(runner)
+        return run_scheduled(runner, workers, durations, layer_costs,
+                             max_memory)
+    testrunner_runner.Runner.run_tests = run_tests
+    try:
+        yield
+    finally:
+        testrunner_runner.Runner.run_tests = orig_run_tests
@@ -0,0 +1,255 @@
+##############################################################################
+#
+# Copyright (c) 2009 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Running a shard of all tests.
+
+To spread a test run over several machines, each one runs the
+testrunner with ``--shard=i/N``, `i` counting from 1 to `N`. With
+`sharded_layers` in effect, the testrunner runs only the tests of
+shard `i` of `N`.
+
+The tests are partitioned by `make_shards`:
+
+- A layer goes to one shard as a whole, so it is set up on one machine
+  only. Only layers taking longer than a whole shard are cut into
+  chunks of tests. Layers that cannot be torn down are never cut, as
+  the testrunner runs them in a subprocess knowing nothing of shards.
+
+- Layers and chunks are weighted by the durations of their tests and
+  setup costs of their layers and handed to the least loaded shard,
+  heaviest first.
+
+Every machine has to come to the same partition, so it only depends on
+the ids of the tests found and, if given, a timings file passed to all
+machines with ``--shard-timings=FILE``. Timings recorded in the cache
+dir of a machine are never used, as they differ between machines.
+Without a timings file, all tests count the same. `save_shard_timings`
+writes a timings file from the timings recorded in a cache dir.
+
+The tests are partitioned in the order of their ids, not in the order
+they are run in, which might differ between machines as well. The
+testrunner reports a fingerprint of the partition with the shard
+selected. If all machines report the same fingerprint, they agree on
+the partition.
+"""
+import hashlib
+import json
+import unittest
+from contextlib import contextmanager
+from z3c.testsetup.ordering import (
+    UNIT_LAYER_NAME, allows_teardown, load_layer_costs)
+from z3c.testsetup.parallel import testrunner_runner
+from z3c.testsetup.scheduler import DEFAULT_LAYER_COST, DEFAULT_TEST_DURATION
+from z3c.testsetup.timings import get_timing_db
+
+
+def parse_shard(value):
+    """Get ``(index, count)`` from a shard spec like ``'2/5'``.
+
+    The `index` returned counts from zero. Raises `ValueError` for
+    invalid specs.
+    """
+    try:
+        index, count = [int(x) for x in value.split('/')]
+    except (AttributeError, ValueError):
+        raise ValueError("Invalid shard %r, expected 'i/N'" % (value, ))
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(
+            "Invalid shard %r, expected 1 <= i <= N" % (value, ))
+    return index - 1, count
+
+
+def load_shard_timings(path):
+    """Get ``(durations, layer_costs)`` from the timings file `path`.
+
+    The file holds a JSON object with test ids mapped to durations
+    under ``"tests"`` and layer names mapped to setup costs under
+    ``"layers"``. Raises `ValueError` if the file cannot be read, as
+    machines falling back to other timings would disagree.
+    """
+    try:
+        with open(path) as fd:
+            timings = json.load(fd)
+    except (IOError, OSError, ValueError) as err:
+        raise ValueError("Cannot read shard timings %r: %s" % (path, err))
+    if not isinstance(timings, dict):
+        raise ValueError("Invalid shard timings %r" % (path, ))
+    return timings.get('tests') or {}, timings.get('layers') or {}
+
+
+def save_shard_timings(path, cache_dir=None):
+    """Write the timings recorded in `cache_dir` to the timings file
+    `path`, see `load_shard_timings`.
+    """
+    durations = {}
+    db = get_timing_db(cache_dir)
+    if db is not None:
+        durations = db.getDurations()
+    timings = dict(tests=durations, layers=load_layer_costs(cache_dir))
+    with open(path, 'w') as fd:
+        json.dump(timings, fd, indent=1, sort_keys=True)
+
+
+class Chunk(object):
+    """Tests of a layer going to one shard.
+
+    `indexes` point into the list of tests of the layer.
+    """
+
+    def __init__(self, layer_name, indexes, cost):
+        self.layer_name = layer_name
+        self.indexes = indexes
+        self.cost = cost
+
+    def __repr__(self):
+        return '<Chunk %s (%s tests)>' % (self.layer_name, len(self.indexes))
+
+
+def make_shards(layer_tests, count, durations=None, layer_costs=None):
+    """Partition the tests of layers into `count` shards.
+
+    `layer_tests` is a list of ``(layer_name, tests, splittable)``.
+    `durations` maps test ids to recorded durations, `layer_costs`
+    layer names to setup costs, both in seconds. Layers are cut into
+    chunks only if `splittable` and heavier than a shard. Returns a
+    list of `count` lists of chunks.
+    """
+    durations = durations or {}
+    layer_costs = layer_costs or {}
+    estimates = []
+    total = 0.0
+    for layer_name, tests, splittable in layer_tests:
+        setup_cost = layer_costs.get(layer_name)
+        if setup_cost is None:
+            setup_cost = DEFAULT_LAYER_COST
+            if layer_name == UNIT_LAYER_NAME:
+                setup_cost = 0.0
+        times = [durations.get(test.id(), DEFAULT_TEST_DURATION)
+                 for test in tests]
+        estimates.append((layer_name, times, setup_cost, splittable))
+        total += setup_cost + sum(times)
+    target = total / count
+    chunks = []
+    for layer_name, times, setup_cost, splittable in estimates:
+        num_chunks = 1
+        if splittable and target > 0:
+            num_chunks = int((setup_cost + sum(times)) / target)
+        num_chunks = max(1, min(num_chunks, count, len(times)))
+        chunk_size = sum(times) / num_chunks
+        layer_chunks = []
+        indexes = []
+        cost = 0.0
+        for index, seconds in enumerate(times):
+            indexes.append(index)
+            cost += seconds
+            if cost >= chunk_size and len(layer_chunks) < num_chunks - 1:
+                layer_chunks.append((indexes, cost))
+                indexes = []
+                cost = 0.0
+        if indexes:
+            layer_chunks.append((indexes, cost))
+        for indexes, cost in layer_chunks:
+            chunks.append(Chunk(layer_name, indexes, cost + setup_cost))
+    # Ties are broken by name and position, never by chance.
+    chunks.sort(key=lambda x: (-x.cost, x.layer_name, x.indexes[0]))
+    shards = [[] for num in range(count)]
+    loads = [0.0] * count
+    for chunk in chunks:
+        num = loads.index(min(loads))
+        shards[num].append(chunk)
+        loads[num] += chunk.cost
+    return shards
+
+
+def get_fingerprint(shards, layer_tests):
+    """Get a short hash of the partition `shards` of `layer_tests`, as
+    got from `make_shards`.
+    """
+    tests = dict([(name, tests) for name, tests, splittable in layer_tests])
+    partition = [
+        sorted([[chunk.layer_name, tests[chunk.layer_name][x].id()]
+                for chunk in shard for x in chunk.indexes])
+        for shard in shards]
+    data = json.dumps(partition, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()[:12]
+
+
+def select_shard(runner, index, count, durations=None, layer_costs=None):
+    """Drop all tests registered with testrunner `runner` not in shard
+    `index` (counting from zero) of `count`.
+    """
+    options = runner.options
+    # Layers run in a subprocess are run as a whole.
+    in_subprocess = (options.processes or 1) > 1
+    layers = {}
+    layer_tests = []
+    for layer_name, layer, tests in runner.ordered_layers():
+        if layer_name not in runner.tests_by_layer_name:
+            continue
+        tests = list(tests)
+        layers[layer_name] = tests
+        splittable = not in_subprocess and allows_teardown(layer)
+        # Tests might be run in another order on other machines.
+        layer_tests.append(
+            (layer_name, sorted(tests, key=lambda x: x.id()), splittable))
+    layer_tests.sort(key=lambda x: x[0])
+    shards = make_shards(layer_tests, count, durations, layer_costs)
+    sorted_tests = dict([(x[0], x[1]) for x in layer_tests])
+    selected = {}
+    for chunk in shards[index]:
+        selected.setdefault(chunk.layer_name, set()).update(
+            [id(sorted_tests[chunk.layer_name][x]) for x in chunk.indexes])
+    total = sum([len(x) for x in layers.values()])
+    for layer_name, tests in layers.items():
+        suite = runner.tests_by_layer_name.pop(layer_name)
+        chosen = selected.get(layer_name)
+        if not chosen:
+            continue
+        if len(chosen) < len(tests):
+            suite = unittest.TestSuite(
+                [x for x in tests if id(x) in chosen])
+        runner.tests_by_layer_name[layer_name] = suite
+    options.output.info(
+        "Running shard %s of %s: %s of %s tests (partition %s)" % (
+            index + 1, count, sum([len(x) for x in selected.values()]),
+            total, get_fingerprint(shards, layer_tests)))
+
+
+@contextmanager
+def sharded_layers(shard, timings=None):
+    """Make the testrunner run only the tests of `shard` while in
+    context.
+
+    `shard` is a spec like ``'2/5'`` (see `parse_shard`) or ``None``
+    to run all tests. `timings` is the path of a timings file (see
+    `load_shard_timings`) weighing the tests or ``None``.
+    """
+    if testrunner_runner is None or not shard:
+        yield
+        return
+    index, count = parse_shard(shard)
+    durations, layer_costs = None, None
+    if timings:
+        durations, layer_costs = load_shard_timings(timings)
+    orig_run_tests = testrunner_runner.Runner.run_tests
+
+    def run_tests(runner):
+        # Subprocesses run what their parent chose for them.
+        if not runner.options.resume_layer:
+            select_shard(runner, index, count, durations, layer_costs)
+        return orig_run_tests(runner)
+    testrunner_runner.Runner.run_tests = run_tests
+    try:
+        yield
+    finally:
+        testrunner_runner.Runner.run_tests = orig_run_tests
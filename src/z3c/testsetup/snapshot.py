@@ -0,0 +1,453 @@
+##############################################################################
+#
+# Copyright (c) 2008-2009 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Snapshots of component registrations made by ZCML.
+
+Executing big ZCML configurations can take a long time. Most of their
+effect is a bunch of registrations in the global component registry
+(and, where `zope.security` is around, security checkers). A snapshot
+records the registrations a ZCML layer setup added, so that later runs
+can restore them instead of executing the ZCML again. Interfaces
+declared for classes (like ``<class><implements /></class>`` does) are
+recorded and declared again as well.
+
+Snapshots are stored in a cache dir, keyed by a hash of the ZCML file,
+all files it includes, the installed package versions and the Python
+version. Registered components are pickled. If any of them cannot be
+pickled (lambdas, closures, ...), no snapshot is taken and the ZCML is
+executed on every run as before.
+
+Packages installed for development keep their version while their
+code changes. A snapshot therefore also keeps the state of the modules
+defining the objects it holds, as found by their `__module__`. If any
+of these changed, or the snapshot cannot be restored at all (like when
+a class was renamed), the snapshot is dropped, the ZCML is executed
+and a new snapshot is taken. Other modules, like the ones defining
+base classes or code called by the registered objects, are not looked
+at. Remove the cache dir after changing these.
+
+Restored components are copies of the original ones. Configurations
+relying on the identity of registered objects, or doing other things
+than registering components and checkers and declaring interfaces
+implemented by classes, must not use snapshots. Interfaces declared
+for objects (like ``<interface type="..." />`` does) are not restored.
+"""
+import gc
+import glob
+import hashlib
+import importlib
+import os
+import sys
+import tempfile
+from xml.etree import ElementTree
+from six import string_types, text_type
+from six.moves import cPickle as pickle
+from zope.component import getGlobalSiteManager
+from zope.interface import classImplements, implementedBy
+from zope.interface.declarations import Implements
+from z3c.testsetup.impact import get_module_file
+from z3c.testsetup.results import get_file_state, is_unchanged
+from z3c.testsetup.util import get_cache_dir
+try:
+    from zope.security import checker as security_checker
+except ImportError:
+    security_checker = None
+
+SNAPSHOT_DIRNAME = 'zcml-snapshots'
+
+# Bump this if the format of snapshots changes.
+SNAPSHOT_VERSION = 3
+
+# ZCML directives including other ZCML files.
+_INCLUDE_DIRECTIVES = ('include', 'includeOverrides')
+
+
+def _local_name(tag):
+    # Strip the namespace of an ElementTree tag.
+    return tag.rsplit('}', 1)[-1]
+
+
+def _get_package_dir(dotted_name, context_package=None):
+    """Get the directory of package `dotted_name` or ``None``.
+
+    Relative names are resolved against `context_package`.
+    """
+    if dotted_name.startswith('.'):
+        if context_package is None:
+            return None
+        dotted_name = context_package + dotted_name
+        if dotted_name.endswith('.'):
+            dotted_name = dotted_name[:-1]
+    try:
+        module = importlib.import_module(dotted_name)
+    except ImportError:
+        return None
+    filepath = getattr(module, '__file__', None)
+    if filepath is None:
+        return None
+    return os.path.dirname(os.path.abspath(filepath))
+
+
+def iter_zcml_files(filepath, seen=None):
+    """Iterate over ZCML file `filepath` and all files it includes.
+
+    Includes are followed recursively, each file is delivered once.
+    Files that cannot be read or parsed are delivered, but not looked
+    into. Conditions on directives are ignored, so we might deliver
+    more files than the ZCML machinery would load.
+    """
+    if seen is None:
+        seen = set()
+    filepath = os.path.realpath(filepath)
+    if filepath in seen:
+        return
+    seen.add(filepath)
+    yield filepath
+    try:
+        tree = ElementTree.parse(filepath)
+    except (IOError, OSError, ElementTree.ParseError):
+        return
+    stack = [(tree.getroot(), os.path.dirname(filepath), None)]
+    while stack:
+        element, basedir, package = stack.pop()
+        name = _local_name(element.tag)
+        if name == 'configure' and element.get('package'):
+            package_dir = _get_package_dir(element.get('package'), package)
+            if package_dir is not None:
+                basedir = package_dir
+                package = element.get('package')
+        if name in _INCLUDE_DIRECTIVES:
+            include_dir = basedir
+            if element.get('package'):
+                include_dir = _get_package_dir(element.get('package'),
+                                               package)
+                if include_dir is None:
+                    continue
+            pattern = element.get('files')
+            if pattern is not None:
+                paths = sorted(glob.glob(os.path.join(include_dir, pattern)))
+            else:
+                paths = [os.path.join(
+                    include_dir, element.get('file', 'configure.zcml'))]
+            for path in paths:
+                if os.path.isfile(path):
+                    for sub in iter_zcml_files(path, seen):
+                        yield sub
+            continue
+        for child in reversed(list(element)):
+            stack.append((child, basedir, package))
+
+
+def get_installed_versions():
+    """Get a sorted list of ``(name, version)`` of installed
+    distributions.
+    """
+    try:
+        from importlib import metadata
+    except ImportError:
+        import pkg_resources
+        return sorted([(dist.project_name.lower(), dist.version)
+                       for dist in pkg_resources.working_set])
+    return sorted([((dist.metadata['Name'] or '').lower(), dist.version)
+                   for dist in metadata.distributions()])
+
+
+def get_snapshot_key(filepath):
+    """Get the snapshot key of ZCML file `filepath`.
+    """
+    digest = hashlib.sha1()
+    digest.update(repr((SNAPSHOT_VERSION, sys.version,
+                        get_installed_versions())).encode('utf-8'))
+    for path in iter_zcml_files(filepath):
+        digest.update(path.encode('utf-8', 'backslashreplace') + b'\0')
+        try:
+            with open(path, 'rb') as fd:
+                digest.update(fd.read())
+        except (IOError, OSError):
+            digest.update(b'\0missing')
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _get_info(registration):
+    # Infos are mostly `ParserInfo` objects we do not want to pickle.
+    info = registration.info
+    if isinstance(info, text_type):
+        return info
+    try:
+        return text_type(info)
+    except Exception:
+        return u''
+
+
+def get_registrations(registry=None):
+    """Get the registrations in `registry` as a list of tuples.
+
+    The first item of each tuple tells the kind of registration, the
+    rest are the arguments to register it again.
+    """
+    if registry is None:
+        registry = getGlobalSiteManager()
+    result = []
+    for reg in registry.registeredUtilities():
+        result.append(('utility', reg.component, reg.provided, reg.name,
+                       _get_info(reg)))
+    for reg in registry.registeredAdapters():
+        result.append(('adapter', reg.factory, reg.required, reg.provided,
+                       reg.name, _get_info(reg)))
+    for reg in registry.registeredSubscriptionAdapters():
+        result.append(('subscriber', reg.factory, reg.required,
+                       reg.provided, reg.name, _get_info(reg)))
+    for reg in registry.registeredHandlers():
+        result.append(('handler', reg.factory, reg.required, reg.name,
+                       _get_info(reg)))
+    return result
+
+
+def _get_identity(registration):
+    # Tell registrations apart without comparing (or hashing) the
+    # registered objects themselves.
+    return (registration[0], id(registration[1])) + tuple(
+        registration[2:-1])
+
+
+def get_checkers():
+    """Get the security checkers defined, if `zope.security` is there.
+    """
+    if security_checker is None:
+        return {}
+    return dict(security_checker._checkers)
+
+
+def get_class_declarations():
+    """Get the interfaces declared for classes, by class.
+
+    There is no registry of classes with interfaces declared, so we
+    look at all objects.
+    """
+    result = {}
+    for obj in gc.get_objects():
+        # Not `isinstance`, which might ask proxies for their class.
+        if not issubclass(type(obj), Implements):
+            continue
+        cls = getattr(obj, 'inherit', None)
+        if (isinstance(cls, type) and
+                cls.__dict__.get('__implemented__') is obj):
+            result[cls] = tuple(obj.declared)
+    return result
+
+
+class SnapshotRecorder(object):
+    """Record the registrations made and the interfaces declared for
+    classes between `start` and `take`.
+    """
+
+    def __init__(self, registry=None):
+        self.registry = registry
+
+    def start(self):
+        self.before = set([_get_identity(x)
+                           for x in get_registrations(self.registry)])
+        self.checkers_before = get_checkers()
+        self.declarations_before = get_class_declarations()
+
+    def take(self):
+        """Get a pickle of the registrations made since `start`.
+
+        Returns ``None`` if they cannot be pickled.
+        """
+        registrations = [x for x in get_registrations(self.registry)
+                         if _get_identity(x) not in self.before]
+        checkers = []
+        for cls, checker in get_checkers().items():
+            if self.checkers_before.get(cls) is not checker:
+                checkers.append((cls, checker))
+        declarations = []
+        for cls, declared in get_class_declarations().items():
+            before = self.declarations_before.get(cls, ())
+            added = [x for x in declared if x not in before]
+            if added:
+                declarations.append((cls, added))
+        payload = (registrations, checkers, declarations)
+        try:
+            files = {}
+            for path in get_source_files(payload):
+                state = get_file_state(path)
+                if state is not None:
+                    files[path] = state
+            # The file states come first, so they can be checked
+            # without importing anything.
+            return pickle.dumps((files, pickle.dumps(payload, 2)), 2)
+        except Exception:
+            # Pickling may fail with about any exception.
+            return None
+
+
+def _iter_objects(value):
+    # Registered objects, interfaces and the items of tuples of them.
+    if isinstance(value, (tuple, list)):
+        for item in value:
+            for obj in _iter_objects(item):
+                yield obj
+    elif value is not None and not isinstance(value, string_types):
+        yield value
+
+
+def get_source_files(payload):
+    """Get the files of the modules defining the objects in snapshot
+    `payload`.
+
+    Modules are looked up by the `__module__` of the objects, which
+    instances get from their class.
+    """
+    paths = set()
+    for obj in _iter_objects(payload):
+        name = getattr(obj, '__module__', None)
+        if not isinstance(name, string_types):
+            continue
+        path = get_module_file(sys.modules.get(name))
+        if path is not None:
+            paths.add(path)
+    return paths
+
+
+def _unregister(registry, registration):
+    kind, args = registration[0], registration[1:]
+    if kind == 'utility':
+        component, provided, name, info = args
+        registry.unregisterUtility(component, provided, name)
+    elif kind == 'adapter':
+        factory, required, provided, name, info = args
+        registry.unregisterAdapter(factory, required, provided, name)
+    elif kind == 'subscriber':
+        factory, required, provided, name, info = args
+        registry.unregisterSubscriptionAdapter(
+            factory, required, provided, name)
+    elif kind == 'handler':
+        factory, required, name, info = args
+        registry.unregisterHandler(factory, required, name)
+
+
+def _register(registry, registration):
+    kind, args = registration[0], registration[1:]
+    if kind == 'utility':
+        component, provided, name, info = args
+        registry.registerUtility(
+            component, provided, name, info=info, event=False)
+    elif kind == 'adapter':
+        factory, required, provided, name, info = args
+        registry.registerAdapter(
+            factory, required, provided, name, info=info, event=False)
+    elif kind == 'subscriber':
+        factory, required, provided, name, info = args
+        registry.registerSubscriptionAdapter(
+            factory, required, provided, name, info=info, event=False)
+    elif kind == 'handler':
+        factory, required, name, info = args
+        registry.registerHandler(
+            factory, required, name, info=info, event=False)
+
+
+def restore_snapshot(data, registry=None):
+    """Register everything recorded in snapshot `data` again and
+    declare the interfaces recorded for classes.
+
+    Returns ``False`` if the snapshot is stale, as a module defining a
+    recorded object changed, or cannot be restored. Whatever was
+    registered already is unregistered again then.
+    """
+    if registry is None:
+        registry = getGlobalSiteManager()
+    registered = []
+    old_checkers = {}
+    try:
+        files, payload = pickle.loads(data)
+        for path, state in files.items():
+            if not is_unchanged(path, state):
+                return False
+        registrations, checkers, declarations = pickle.loads(payload)
+        for registration in registrations:
+            _register(registry, registration)
+            registered.append(registration)
+        if checkers and security_checker is not None:
+            for cls, checker in checkers:
+                old_checkers[cls] = security_checker._checkers.get(cls)
+                security_checker._checkers[cls] = checker
+        for cls, interfaces in declarations:
+            declared = implementedBy(cls).declared
+            missing = [x for x in interfaces if x not in declared]
+            if missing:
+                classImplements(cls, *missing)
+    except Exception:
+        # Unpickling may fail with about any exception, for instance
+        # if a class was renamed. Interfaces declared for classes are
+        # left alone, executing the ZCML declares them again.
+        for registration in reversed(registered):
+            _unregister(registry, registration)
+        for cls, checker in old_checkers.items():
+            if checker is None:
+                del security_checker._checkers[cls]
+            else:
+                security_checker._checkers[cls] = checker
+        return False
+    return True
+
+
+def get_snapshot_dir(cache_dir=None):
+    """Get the directory snapshots are kept in or ``None``.
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is None:
+        return None
+    return os.path.abspath(os.path.join(cache_dir, SNAPSHOT_DIRNAME))
+
+
+def remove_snapshot(snapshot_dir, key):
+    """Remove the snapshot stored under `key`, if there is one.
+    """
+    try:
+        os.unlink(os.path.join(snapshot_dir, key))
+    except OSError:
+        pass
+
+
+def load_snapshot(snapshot_dir, key):
+    """Get the snapshot stored under `key` or ``None``.
+    """
+    try:
+        with open(os.path.join(snapshot_dir, key), 'rb') as fd:
+            return fd.read()
+    except (IOError, OSError):
+        return None
+
+
+def save_snapshot(snapshot_dir, key, data):
+    """Store snapshot `data` under `key`.
+
+    Other processes see either the complete snapshot or none.
+    """
+    if not os.path.isdir(snapshot_dir):
+        try:
+            os.makedirs(snapshot_dir)
+        except OSError:
+            if not os.path.isdir(snapshot_dir):
+                raise
+    fd, tmp_path = tempfile.mkstemp(dir=snapshot_dir, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+        getattr(os, 'replace', os.rename)(
+            tmp_path, os.path.join(snapshot_dir, key))
+    except (IOError, OSError):
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
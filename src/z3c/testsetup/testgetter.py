@@ -19,9 +19,15 @@ functions in test setup modules of projects.
 
 See testgetter.txt to learn more about this stuff.
 """
+import os
 import unittest
 from z3c.testsetup.doctesting import UnitDocTestSetup, SimpleDocTestSetup
+from z3c.testsetup.impact import select_affected_tests
+from z3c.testsetup.ordering import (
+    RunPriority, load_layer_costs, order_by_layer)
+from z3c.testsetup.scan import PackageScan
 from z3c.testsetup.testing import UnitTestSetup
+from z3c.testsetup.timings import get_timing_db
 from z3c.testsetup.util import get_package, get_keyword_params
 
 
@@ -35,6 +41,7 @@ class BasicTestGetter(object):
     defaults = {}
     settings = {}
     args = ()
+    scan = None
 
     def __init__(self, pkg_or_dotted_name, *args, **kw):
         self.args = args
@@ -65,10 +72,11 @@ class BasicTestGetter(object):
         suite = unittest.TestSuite()
         if self.package is None:
             return suite
-        suite.addTest(
-            self.wrapped_class(
-                self.package, **self.settings).getTestSuite()
-            )
+        setup = self.wrapped_class(self.package, **self.settings)
+        if self.scan is not None:
+            # Share the package scan of our collector.
+            setup.scan = self.scan
+        suite.addTest(setup.getTestSuite())
         return suite
 
     def filterKeywords(self):
@@ -129,20 +137,67 @@ class BasicTestCollector(BasicTestGetter):
     """
     handled_getters = []
 
+    # Group the collected tests by layer. See `z3c.testsetup.ordering`.
+    order_layers = False
+
+    # Run tests that failed last time or whose files changed since
+    # they were last run first in their layer. Needs timings recorded
+    # in the cache dir, see `z3c.testsetup.timings`.
+    failed_first = False
+    changed_first = False
+
+    # Collect only tests touching changed files: a list of paths,
+    # ``'git'`` or ``'mtime'``. Needs the impact of tests recorded in
+    # the cache dir, see `z3c.testsetup.impact`.
+    changed_files = None
+
+    def __init__(self, pkg_or_dotted_name, *args, **kw):
+        for name in ('order_layers', 'failed_first', 'changed_first',
+                     'changed_files'):
+            if name in kw.keys():
+                setattr(self, name, kw[name])
+                del kw[name]
+        BasicTestGetter.__init__(self, pkg_or_dotted_name, *args, **kw)
+
+    def getPriority(self):
+        """Get a function ranking tests for running them, if wanted.
+        """
+        if not (self.failed_first or self.changed_first):
+            return None
+        db = get_timing_db(self.settings.get('cache_dir'))
+        if db is None:
+            return None
+        return RunPriority(db.getOutcomes(), db.getLastRuns(),
+                           failed_first=self.failed_first,
+                           changed_first=self.changed_first)
+
     def __call__(self):
         """Return a test suite.
+
+        All handled getters share one package scan, so the package is
+        walked and its files are read only once.
         """
         suite = unittest.TestSuite()
+        scan = PackageScan()
         for getter_cls in self.handled_getters:
             if self.package is None:
                 continue
             getter = getter_cls(self.package, **self.settings)
+            getter.scan = scan
             # Merge our defaults with target defaults...
             target_defaults = getattr(getter, 'defaults', {})
             self_defaults = getattr(self, 'defaults', {})
             getter.defaults = target_defaults.copy()
             getter.defaults.update(self_defaults)
             suite.addTest(getter.getTestSuite())
+        if self.changed_files is not None and self.package is not None:
+            suite = select_affected_tests(
+                suite, self.changed_files, self.settings.get('cache_dir'),
+                os.path.dirname(self.package.__file__))
+        priority = self.getPriority()
+        if self.order_layers or priority is not None:
+            costs = load_layer_costs(self.settings.get('cache_dir'))
+            suite = order_by_layer(suite, costs, priority)
         return suite
 
 
@@ -15,10 +15,12 @@
 """
 import unittest
 import re
+from tokenize import TokenError
 from martian.scan import module_info_from_dotted_name
 from z3c.testsetup.base import BasicTestSetup
+from z3c.testsetup.lazy import LazyModuleSuite
 from z3c.testsetup.util import (get_package, get_marker_from_string,
-                                get_marker_from_file)
+                                get_module_docstring)
 
 
 class UnitTestSetup(BasicTestSetup):
@@ -41,10 +43,26 @@ class UnitTestSetup(BasicTestSetup):
         r'^\.{0,2}\s*:(T|t)est-(L|l)ayer:\s*(python)\s*',
         ]
 
-    def __init__(self, package, pfilter_func=None, regexp_list=None):
-        BasicTestSetup.__init__(self, package, regexp_list=regexp_list)
+    # Read module docstrings from the sources instead of importing
+    # modules to check whether they are test modules.
+    static_docstrings = False
+
+    # Import test modules and load their tests only when needed.
+    lazy = False
+
+    def __init__(self, package, pfilter_func=None, regexp_list=None,
+                 cache_dir=None, header_lines=None, header_bytes=None,
+                 static_docstrings=None, lazy=None):
+        BasicTestSetup.__init__(self, package, regexp_list=regexp_list,
+                                cache_dir=cache_dir,
+                                header_lines=header_lines,
+                                header_bytes=header_bytes)
         self.pfilter_func = pfilter_func or self.isTestModule
         self.filter_func = self.pfilter_func
+        if static_docstrings is not None:
+            self.static_docstrings = static_docstrings
+        if lazy is not None:
+            self.lazy = lazy
 
     def docstrContains(self, docstr):
         """Does a docstring contain lines matching every of the regular
@@ -64,42 +82,104 @@ class UnitTestSetup(BasicTestSetup):
         This is the case if it got a module docstring which matches
         each of our regular expressions.
         """
+        if self.index is None:
+            result, import_error = self.checkTestModule(module_info)
+        else:
+            # Remember negative results as well. Import errors might
+            # come from other modules, so they are checked every time.
+            result, import_error = self.index.getResult(
+                module_info.path, self.getIndexKey(
+                    self.static_docstrings and 'isTestModule static' or
+                    'isTestModule'),
+                lambda path: self.checkTestModule(module_info),
+                keep=lambda result: not result[1])
+        if import_error:
+            # Broken module that is probably a test.  We absolutely have to
+            # warn about this!
+            print("Import error in %s" % module_info.path)
+        return result
+
+    def checkTestModule(self, module_info):
+        """Check whether a module is a test module.
+
+        Returns a tuple ``(result, import_error)``, where `import_error`
+        tells whether the module could not be imported.
+        """
         # Do not even try to load modules, that have no marker string.
         if not self.fileContains(module_info.path):
             # No ":test-layer: python" marker, so check for :unittest:.
-            if get_marker_from_file('unittest', module_info.path) is None:
+            if self.getMarker('unittest', module_info.path) is None:
                 # Neither the old nor the new marker: this is no test module.
-                return False
+                return False, False
+        if self.static_docstrings:
+            try:
+                docstr = get_module_docstring(module_info.path)
+            except (SyntaxError, TokenError):
+                # Let the import tell what is wrong.
+                pass
+            else:
+                return self.docstrContains(docstr), False
         module = None
+        import_error = False
         try:
             module = module_info.getModule()
         except ImportError:
-            # Broken module that is probably a test.  We absolutely have to
-            # warn about this!
-            print("Import error in %s" % module_info.path)
+            import_error = True
         docstr = getattr(module, '__doc__', '')
         if not self.docstrContains(docstr):
-            return False
-        return True
+            return False, import_error
+        return True, import_error
 
-    def getModules(self, package=None):
-        result = []
+    def getModuleInfos(self, package=None):
+        """Get martian `ModuleInfo` objects of the test modules in
+        `package`.
+
+        Subpackages are found by their filesystem layout. They are not
+        imported, unless one of their modules is a test module.
+        """
         if package is None:
             package = self.package
         info = module_info_from_dotted_name(package.__name__)
+        result = self.getModuleInfosFromInfo(info)
+        if self.index is not None:
+            self.index.flush()
+        return result
+
+    def getModuleInfosFromInfo(self, info):
+        """Get `ModuleInfo` objects of test modules below the package
+        of a martian `ModuleInfo`.
+        """
+        result = []
         for submod_info in info.getSubModuleInfos():
             if submod_info.isPackage():
-                result.extend(self.getModules(submod_info.getModule()))
+                result.extend(self.getModuleInfosFromInfo(submod_info))
                 continue
-            if not self.pfilter_func(submod_info):
+            if self.pfilter_func(submod_info):
+                result.append(submod_info)
+        return result
+
+    def getModules(self, package=None):
+        result = []
+        for submod_info in self.getModuleInfos(package):
+            try:
+                module = submod_info.getModule()
+            except ImportError:
+                if not self.static_docstrings:
+                    raise
+                # Not imported before, so this is the first time we
+                # see it broken.
+                print("Import error in %s" % submod_info.path)
                 continue
-            module = submod_info.getModule()
             result.append(module)
         return result
 
     def getTestSuite(self):
-        modules = self.getModules(package=self.package)
         suite = unittest.TestSuite()
+        if self.lazy:
+            for module_info in self.getModuleInfos(package=self.package):
+                suite.addTest(LazyModuleSuite(module_info))
+            return suite
+        modules = self.getModules(package=self.package)
         for module in modules:
             tests = unittest.defaultTestLoader.loadTestsFromModule(module)
             suite.addTest(tests)
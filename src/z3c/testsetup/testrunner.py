@@ -13,17 +13,160 @@
 ##############################################################################
 """Testrunner convenience stuff.
 """
+import sys
+from contextlib import contextmanager
+from z3c.testsetup.impact import recorded_impact
+from z3c.testsetup.ordering import load_layer_costs, ordered_layers
+from z3c.testsetup.parallel import forked_layers
+from z3c.testsetup.scheduler import scheduled_layers
+from z3c.testsetup.sharding import sharded_layers
+from z3c.testsetup.timings import get_timing_db, recorded_timings
+from z3c.testsetup.workqueue import queued_layers
 try:
     from zope import testrunner
-    from zope.testrunner import run
 except ImportError:
     # BBB: for backward compatibility
     from zope.testing import testrunner
-    from zope.testing.testrunner import run
 
-# Convenience mapping to have run_internal() and run() always
-# available and refering to the same function from zope.testing. See
-# `testrunner.txt` (bottom) for details.
-if hasattr(testrunner, 'run_internal'):
-    run = testrunner.run_internal
+# The testrunner function `run` and `run_internal` below wrap:
+# `run_internal` of zope.testing if it exists, as it does not exit, or
+# `run` otherwise. See `testrunner.txt` (bottom) for details.
+testrunner_run = getattr(testrunner, 'run_internal', testrunner.run)
+
+# Options we understand on top of the ones of the testrunner.
+OPTIONS = ('--fork-workers', '--workers', '--max-worker-memory', '--shard',
+           '--shard-timings', '--queue-dir', '--join-queue')
+
+# Options without a value.
+FLAGS = ('--record-timings', '--record-impact', '--order-layers')
+
+
+def pop_options(args, names=OPTIONS, flags=FLAGS):
+    """Take the options in `names` and `flags` out of command line
+    `args`.
+
+    Options can be given as ``--name=value`` or ``--name value``,
+    flags have no value. Returns the remaining args and a dict of the
+    options found, flags found map to ``True``.
+    """
+    remaining = []
+    found = {}
+    args = iter(args)
+    for arg in args:
+        if arg in flags:
+            found[arg] = True
+            continue
+        name, sep, value = arg.partition('=')
+        if name not in names:
+            remaining.append(arg)
+            continue
+        if not sep:
+            value = next(args, None)
+        found[name] = value
+    return remaining, found
+
+
+def get_option(options, name, value=None, convert=int):
+    """Get the value of option `name` found by `pop_options`.
+
+    A `value` given explicitly wins.
+    """
+    if value is None and options.get(name):
+        value = convert(options[name])
+    return value
+
+
+@contextmanager
+def maybe(flag, context_manager, *args):
+    """Enter `context_manager` called with `args` if `flag` is set.
+    """
+    if not flag:
+        yield None
+        return
+    with context_manager(*args) as result:
+        yield result
+
+
+def run(defaults=None, args=None, fork_workers=None, workers=None,
+        max_worker_memory=None, record_timings=False, record_impact=False,
+        order_layers=False,
+        shard=None, shard_timings=None, queue_dir=None, join_queue=None,
+        queue_timeout=None, cache_dir=None, **kw):
+    """Run the testrunner.
+
+    If `order_layers` is true (or ``--order-layers`` is given), layers
+    are run in the order of `z3c.testsetup.ordering`: unit tests first,
+    layers that cannot be torn down last. Otherwise the testrunner
+    orders them as usual.
+
+    If `fork_workers` (or ``--fork-workers`` on the command line) is
+    more than one, the tests of each layer are run in that many worker
+    processes forked after the layer was set up. See
+    `z3c.testsetup.parallel`.
+
+    If `workers` (or ``--workers``) is more than one, all layers are
+    run by a pool of that many worker processes. Workers using more
+    than `max_worker_memory` (or ``--max-worker-memory``) megabytes are
+    replaced. See `z3c.testsetup.scheduler`.
+
+    If `record_timings` is true (or ``--record-timings`` is given),
+    timings of tests and layers are recorded in the cache dir. See
+    `z3c.testsetup.timings`. Recorded timings are used to schedule
+    tests between `workers`.
+
+    If `record_impact` is true (or ``--record-impact`` is given), the
+    files touched by tests are recorded in the cache dir. See
+    `z3c.testsetup.impact`.
+
+    If `shard` (or ``--shard``) is given like ``'2/5'``, only the tests
+    of the second of five shards of all tests are run. Tests are
+    weighted by the timings file `shard_timings` (or
+    ``--shard-timings``), if given. Pass the same file to all shards.
+    See `z3c.testsetup.sharding`.
+
+    If `queue_dir` (or ``--queue-dir``) is given, the tests are put in a
+    queue in that directory and run by this and all testrunners
+    started with `join_queue` (or ``--join-queue``) set to the same
+    directory. Outcomes of all tests are reported here. Each testrunner
+    runs tests in `workers` processes. Tests taken but not worked on
+    for `queue_timeout` seconds are put back into the queue. See
+    `z3c.testsetup.workqueue`.
+    """
+    if args is None:
+        args = sys.argv[:]
+    defaults, options = pop_options(defaults or [])
+    args, arg_options = pop_options(args)
+    options.update(arg_options)
+    fork_workers = get_option(options, '--fork-workers', fork_workers)
+    workers = get_option(options, '--workers', workers)
+    max_worker_memory = get_option(
+        options, '--max-worker-memory', max_worker_memory)
+    max_memory = None
+    if max_worker_memory:
+        max_memory = max_worker_memory * 1024 * 1024
+    record_timings = record_timings or options.get('--record-timings')
+    record_impact = record_impact or options.get('--record-impact')
+    order_layers = order_layers or options.get('--order-layers')
+    shard = get_option(options, '--shard', shard, convert=str)
+    shard_timings = get_option(
+        options, '--shard-timings', shard_timings, convert=str)
+    queue_dir = get_option(options, '--queue-dir', queue_dir, convert=str)
+    join_queue = get_option(options, '--join-queue', join_queue, convert=str)
+    durations = None
+    db = get_timing_db(cache_dir)
+    if db is not None:
+        durations = db.getDurations()
+    layer_costs = load_layer_costs(cache_dir)
+    with maybe(order_layers, ordered_layers, layer_costs), scheduled_layers(
+            workers, durations=durations, layer_costs=layer_costs,
+            max_memory=max_memory):
+        with queued_layers(queue_dir, join_queue, workers,
+                           durations=durations, layer_costs=layer_costs,
+                           max_memory=max_memory, timeout=queue_timeout):
+            with sharded_layers(shard, timings=shard_timings):
+                with forked_layers(fork_workers):
+                    with maybe(record_timings, recorded_timings, cache_dir):
+                        with maybe(record_impact, recorded_impact,
+                                   cache_dir):
+                            return testrunner_run(defaults, args, **kw)
 run_internal = run
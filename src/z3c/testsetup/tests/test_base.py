@@ -40,3 +40,24 @@ class TestBasicTestSetup(unittest.TestCase):
         mysetup = BasicTestSetup(cave, regexp_list=["MARKER", ])
         path = self.create_file(b"Line 1\n \xff\xfeW[ \nMARKER\n\n")
         assert mysetup.fileContains(path) is True
+
+    def test_get_doctest_files_exclude(self):
+        # we can exclude files and directories by glob patterns
+        mysetup = BasicTestSetup(cave)
+        basenames = [os.path.basename(x) for x in mysetup.getDocTestFiles()]
+        assert 'subdirfile.txt' in basenames
+        mysetup = BasicTestSetup(cave, exclude=['subdir', 'file2.*'])
+        basenames = [os.path.basename(x) for x in mysetup.getDocTestFiles()]
+        assert 'subdirfile.txt' not in basenames
+        assert 'file2.TXT' not in basenames
+        assert 'file1.txt' in basenames
+
+    def test_file_contains_header_only(self):
+        # we can search the beginning of files only
+        path = self.create_file(b"Line 1\nLine 2\nMARKER in file\n\n")
+        mysetup = BasicTestSetup(cave, regexp_list=["MARKER", ],
+                                 header_lines=2)
+        assert mysetup.fileContains(path) is False
+        mysetup = BasicTestSetup(cave, regexp_list=["MARKER", ],
+                                 header_lines=3)
+        assert mysetup.fileContains(path) is True
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+""" Tests for `z3c.testsetup.impact`.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import z3c.testsetup
+from six.moves import builtins
+from z3c.testsetup import testrunner, util
+from z3c.testsetup.impact import (
+    FileTracer, ImpactDB, get_module_file, impact_dbs, select_affected_tests,
+    sqlite3)
+from z3c.testsetup.tests import cave
+from z3c.testsetup.tests.test_samples import Capture
+from z3c.testsetup.tests.test_testsetup import get_basenames_from_suite
+
+SAMPLE_FILES = {
+    '__init__.py': '',
+    'apples.py': 'def count():\n    return 1\n',
+    'consts.py': 'LIMIT = 30\n',
+    'pears.py': 'def count():\n    return 2\n',
+    'tests_apples.py': (
+        'import unittest\n'
+        'from impactsample import apples\n\n\n'
+        'class AppleTests(unittest.TestCase):\n\n'
+        '    def test_count(self):\n'
+        '        self.assertEqual(apples.count(), 1)\n'),
+    'tests_pears.py': (
+        'import unittest\n'
+        'from impactsample import pears\n\n\n'
+        'class PearTests(unittest.TestCase):\n\n'
+        '    def test_count(self):\n'
+        '        self.assertEqual(pears.count(), 2)\n'),
+    'tests_limits.py': (
+        'import unittest\n'
+        'from impactsample.consts import LIMIT\n\n\n'
+        'class LimitTests(unittest.TestCase):\n\n'
+        '    def test_limit(self):\n'
+        '        self.assertEqual(LIMIT, 30)\n'),
+}
+
+
+class TestFileTracer(unittest.TestCase):
+
+    def test_tracer(self):
+        # files of functions called are seen
+        tracer = FileTracer()
+        tracer.start()
+        try:
+            util.get_cache_dir('/tmp')
+        finally:
+            files = tracer.stop()
+        assert files == set([util.get_cache_dir.__code__.co_filename])
+        # nothing is seen afterwards
+        util.get_cache_dir('/tmp')
+        assert len(tracer.files) == 1
+
+    def test_imports(self):
+        # modules imported are seen, even if only data is used
+        orig_import = builtins.__import__
+        tracer = FileTracer()
+        tracer.start()
+        try:
+            from z3c.testsetup.util import warn
+            from z3c.testsetup import index
+            import z3c.testsetup.ordering
+        finally:
+            files = tracer.stop()
+        assert warn and index
+        assert set([get_module_file(util), get_module_file(index),
+                    get_module_file(z3c.testsetup.ordering)]) <= files
+        # imports are not seen afterwards
+        assert builtins.__import__ is orig_import
+
+
+@unittest.skipIf(sqlite3 is None, "No sqlite3 available")
+class TestImpactDB(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.db = ImpactDB(os.path.join(self.workdir, 'impact.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def touch(self, name, mtime=None):
+        path = os.path.join(self.workdir, name)
+        open(path, 'w').close()
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return os.path.realpath(path)
+
+    def test_affected(self):
+        # keys touching changed files are affected
+        test_a, test_b = self.touch('test_a.txt'), self.touch('test_b.txt')
+        lib_a, lib_b = self.touch('a.py'), self.touch('b.py')
+        self.db.add(test_a, [lib_a, '<doctest test_a.txt[0]>'])
+        self.db.add(test_b, [lib_b])
+        self.db.flush()
+        impacts, recorded = self.db.load()
+        assert impacts[test_a] == set([test_a, lib_a])
+        assert sorted(recorded) == [test_a, test_b]
+        assert self.db.getAffected([lib_a]) == (
+            set([test_a]), set([test_a, test_b]))
+        assert self.db.getAffected([test_b])[0] == set([test_b])
+        assert self.db.getAffected([])[0] == set()
+        # recorded files are added to
+        self.db.add(test_a, [lib_b])
+        self.db.flush()
+        assert self.db.getAffected([lib_b])[0] == set([test_a, test_b])
+
+    def test_affected_by_mtime(self):
+        # without changed files given, modification times count
+        test_a, test_b = self.touch('test_a.txt'), self.touch('test_b.txt')
+        lib_a, lib_b = self.touch('a.py'), self.touch('b.py')
+        self.db.add(test_a, [lib_a])
+        self.db.add(test_b, [lib_b])
+        self.db.flush()
+        assert self.db.getAffected()[0] == set()
+        self.touch('b.py', time.time() + 10)
+        assert self.db.getAffected()[0] == set([test_b])
+
+
+@unittest.skipIf(sqlite3 is None, "No sqlite3 available")
+class TestSelectAffected(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.workdir, 'cache')
+        self.pkgdir = os.path.join(self.workdir, 'impactsample')
+        os.mkdir(self.pkgdir)
+        for name, content in SAMPLE_FILES.items():
+            with open(os.path.join(self.pkgdir, name), 'w') as fd:
+                fd.write(content)
+        self._sys_argv_old = sys.argv[:]
+        sys.argv = ['test', '--no-color']
+
+    def tearDown(self):
+        sys.argv[:] = self._sys_argv_old
+        for name in list(sys.modules):
+            if name.startswith('impactsample'):
+                del sys.modules[name]
+        impact_dbs.clear()
+        shutil.rmtree(self.workdir)
+
+    def get_suite(self):
+        sys.path.insert(0, self.workdir)
+        try:
+            from impactsample import tests_apples, tests_pears, tests_limits
+        finally:
+            sys.path.remove(self.workdir)
+        loader = unittest.defaultTestLoader
+        return unittest.TestSuite([
+            loader.loadTestsFromModule(tests_apples),
+            loader.loadTestsFromModule(tests_pears),
+            loader.loadTestsFromModule(tests_limits)])
+
+    def get_ids(self, suite):
+        ids = []
+        for test in suite:
+            if isinstance(test, unittest.TestSuite):
+                ids.extend(self.get_ids(test))
+            else:
+                ids.append(test.id())
+        return ids
+
+    def test_select_affected(self):
+        # only tests touching changed files are selected
+        with Capture() as cap:
+            testrunner.run(
+                ['--path', self.workdir, '--tests-pattern', '^tests_'],
+                record_impact=True, cache_dir=self.cache_dir)
+        assert "Ran 3 tests" in cap.out
+        suite = self.get_suite()
+        assert len(self.get_ids(suite)) == 3
+        changed = [os.path.join(self.pkgdir, 'pears.py')]
+        assert self.get_ids(select_affected_tests(
+            suite, changed, self.cache_dir)) == [
+            'impactsample.tests_pears.PearTests.test_count']
+        assert self.get_ids(select_affected_tests(
+            suite, [], self.cache_dir)) == []
+        # modules only read from count as well
+        changed = [os.path.join(self.pkgdir, 'consts.py')]
+        assert self.get_ids(select_affected_tests(
+            suite, changed, self.cache_dir)) == [
+            'impactsample.tests_limits.LimitTests.test_limit']
+
+    def test_nothing_recorded(self):
+        # without recorded impact all tests are kept
+        suite = self.get_suite()
+        assert select_affected_tests(suite, [], self.cache_dir) is suite
+
+    def test_collector_changed_files(self):
+        # collectors select tests by changed files
+        expected = get_basenames_from_suite(z3c.testsetup.TestCollector(
+            cave)())
+        collector = z3c.testsetup.TestCollector(
+            cave, changed_files=[], cache_dir=self.cache_dir)
+        assert collector.changed_files == []
+        assert 'changed_files' not in collector.settings
+        assert get_basenames_from_suite(collector()) == expected
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+""" Tests for `z3c.testsetup.index`.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from six import StringIO
+from z3c.testsetup.doctesting import SimpleDocTestSetup
+from z3c.testsetup.index import DiscoveryIndex, get_index, indexes
+from z3c.testsetup.testing import UnitTestSetup
+from z3c.testsetup.util import FileMarkers
+from z3c.testsetup.tests import importerrorcave, othercave
+
+
+class TestDiscoveryIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.workdir, "cache", "index.sqlite")
+        self.path = os.path.join(self.workdir, "myfile")
+        with open(self.path, "w") as fd:
+            fd.write(":doctest:\n:layer: foo\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_results_persist(self):
+        # stored results survive the index
+        index = DiscoveryIndex(self.index_path)
+        assert index.getResult(self.path, "key", lambda x: [True, 1]) == [
+            True, 1]
+        index.flush()
+        index = DiscoveryIndex(self.index_path)
+        assert index.getResult(self.path, "key", lambda x: 1 / 0) == [True, 1]
+
+    def test_results_not_kept(self):
+        # results not to be kept are computed every time
+        index = DiscoveryIndex(self.index_path)
+        assert index.getResult(self.path, "key", lambda x: 1,
+                               keep=lambda result: False) == 1
+        assert index.getResult(self.path, "key", lambda x: 2) == 2
+        assert index.getResult(self.path, "key", lambda x: 3) == 2
+
+    def test_markers_persist(self):
+        # stored markers survive the index
+        index = DiscoveryIndex(self.index_path)
+        markers = index.getMarkers(
+            self.path, lambda x: FileMarkers(x, {"layer": "foo"}))
+        assert markers.get("layer") == "foo"
+        index.flush()
+        index = DiscoveryIndex(self.index_path)
+        markers = index.getMarkers(self.path, lambda x: 1 / 0)
+        assert markers.get("layer") == "foo"
+
+    def test_changed_files_invalidate(self):
+        # results for changed files are computed again
+        index = DiscoveryIndex(self.index_path)
+        index.getResult(self.path, "key", lambda x: False)
+        index.flush()
+        with open(self.path, "w") as fd:
+            fd.write("changed content\n")
+        index = DiscoveryIndex(self.index_path)
+        assert index.getResult(self.path, "key", lambda x: True) is True
+
+    def test_get_index(self):
+        # indexes are shared per cache dir
+        cache_dir = os.path.join(self.workdir, "cache")
+        try:
+            assert get_index(cache_dir) is get_index(cache_dir)
+        finally:
+            indexes.clear()
+
+    def test_get_index_no_cache_dir(self):
+        # without a cache dir, there is no index
+        old_env = os.environ.pop("Z3C_TESTSETUP_CACHE_DIR", None)
+        try:
+            assert get_index() is None
+        finally:
+            if old_env is not None:
+                os.environ["Z3C_TESTSETUP_CACHE_DIR"] = old_env
+
+
+class TestSetupsWithIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        indexes.clear()
+        shutil.rmtree(self.cache_dir)
+
+    def test_doctest_files_from_index(self):
+        # warm runs find the same files without reading them
+        expected = SimpleDocTestSetup(othercave).getDocTestFiles()
+        assert len(expected) == 9
+        setup = SimpleDocTestSetup(othercave, cache_dir=self.cache_dir)
+        assert setup.getDocTestFiles() == expected
+        indexes.clear()
+        setup = SimpleDocTestSetup(othercave, cache_dir=self.cache_dir)
+
+        def read(filepath):
+            raise AssertionError("%s was read" % filepath)
+
+        setup.readFile = setup.readBytes = read
+        assert setup.getDocTestFiles() == expected
+
+    def test_import_errors_from_index(self):
+        # import errors are reported again
+        for num in range(2):
+            indexes.clear()
+            setup = UnitTestSetup(importerrorcave, cache_dir=self.cache_dir)
+            stdout, sys.stdout = sys.stdout, StringIO()
+            try:
+                assert setup.getModules() == []
+            finally:
+                output, sys.stdout = sys.stdout.getvalue(), stdout
+            assert "Import error in" in output
+            assert "broken_test_mod.py" in output
+            assert "broken_test_mod2.py" in output
+
+    def test_fixed_import_errors(self):
+        # import errors are not remembered, they might be fixed elsewhere
+        workdir = tempfile.mkdtemp()
+        pkgdir = os.path.join(workdir, 'fixsample')
+        os.mkdir(pkgdir)
+        open(os.path.join(pkgdir, '__init__.py'), 'w').close()
+        with open(os.path.join(pkgdir, 'test_mod.py'), 'w') as fd:
+            fd.write('"""\n:unittest:\n"""\nimport fixsample.helper\n')
+        with open(os.path.join(pkgdir, 'helper.py'), 'w') as fd:
+            fd.write('import non_existing_package\n')
+        sys.path.insert(0, workdir)
+        stdout = sys.stdout
+        try:
+            import fixsample
+            sys.stdout = StringIO()
+            setup = UnitTestSetup(fixsample, cache_dir=self.cache_dir)
+            assert setup.getModules() == []
+            assert "Import error in" in sys.stdout.getvalue()
+            with open(os.path.join(pkgdir, 'helper.py'), 'w') as fd:
+                fd.write('# fixed\n')
+            indexes.clear()
+            sys.stdout = StringIO()
+            setup = UnitTestSetup(fixsample, cache_dir=self.cache_dir)
+            assert [x.__name__ for x in setup.getModules()] == [
+                'fixsample.test_mod']
+            assert "Import error in" not in sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            sys.path.remove(workdir)
+            for name in list(sys.modules):
+                if name.startswith('fixsample'):
+                    del sys.modules[name]
+            shutil.rmtree(workdir)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+""" Tests for `z3c.testsetup.functional.layer`.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from z3c.testsetup.util import got_working_zope_app_testing
+
+ZCML = b"""<configure xmlns="http://namespaces.zope.org/zope" />
+"""
+
+ZCML_RELATIVE = b"""<configure xmlns="http://namespaces.zope.org/zope">
+  <include file="other.zcml" />
+</configure>
+"""
+
+
+class DummyLayer(object):
+    # a layer factory not doing anything
+
+    def __init__(self, filepath, modname, layername, allow_teardown=False):
+        self.config_file = filepath
+        self.__name__ = layername
+        self.allow_teardown = allow_teardown
+
+
+@unittest.skipUnless(got_working_zope_app_testing(),
+                     "zope.app.testing is not available")
+class TestZCMLLayerRegistry(unittest.TestCase):
+
+    def setUp(self):
+        from z3c.testsetup.functional import layer
+        self.workdir = tempfile.mkdtemp()
+        self.old_layers = layer.zcml_layers.copy()
+        layer.zcml_layers.clear()
+
+    def tearDown(self):
+        from z3c.testsetup.functional import layer
+        layer.zcml_layers.clear()
+        layer.zcml_layers.update(self.old_layers)
+        shutil.rmtree(self.workdir)
+
+    def create_file(self, content, *path_parts):
+        path = os.path.join(self.workdir, *path_parts)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as fd:
+            fd.write(content)
+        return path
+
+    def get_layer(self, path, kind='zcml-layer', **kw):
+        from z3c.testsetup.functional.layer import get_zcml_layer
+        return get_zcml_layer(path, __name__, 'Layer [%s]' % path, kind,
+                              factory=DummyLayer, **kw)
+
+    def test_same_file(self):
+        # the same file gives the same layer
+        path = self.create_file(ZCML, "ftesting.zcml")
+        layer = self.get_layer(path)
+        assert self.get_layer(os.path.join(
+            self.workdir, ".", "ftesting.zcml")) is layer
+        assert self.get_layer(path, allow_teardown=True) is not layer
+        assert self.get_layer(path, kind='functional-zcml-layer') is not layer
+
+    def test_same_content(self):
+        # copies of files share layers
+        path1 = self.create_file(ZCML, "a", "ftesting.zcml")
+        path2 = self.create_file(ZCML, "b", "ftesting.zcml")
+        assert self.get_layer(path1) is self.get_layer(path2)
+        assert self.get_layer(path1, dedupe_content=False) is not (
+            self.get_layer(path2, dedupe_content=False))
+
+    def test_same_content_relative(self):
+        # copies of files with relative references do not share layers
+        path1 = self.create_file(ZCML_RELATIVE, "a", "ftesting.zcml")
+        path2 = self.create_file(ZCML_RELATIVE, "b", "ftesting.zcml")
+        assert self.get_layer(path1) is not self.get_layer(path2)
+
+
+@unittest.skipUnless(got_working_zope_app_testing(),
+                     "zope.app.testing is not available")
+class TestSnapshotZCMLLayer(unittest.TestCase):
+
+    def setUp(self):
+        from zope.app.debug import debug
+        from z3c.testsetup.functional.layer import DefaultZCMLLayer
+        self.workdir = tempfile.mkdtemp()
+        self.zcml_path = os.path.join(self.workdir, 'ftesting.zcml')
+        with open(self.zcml_path, 'wb') as fd:
+            fd.write(ZCML)
+        self.executed = []
+        self.orig_config = debug.config
+        self.orig_setup = DefaultZCMLLayer.setUp
+
+        def config(*args, **kw):
+            # Executing the ZCML registers a greeter.
+            from zope.component import provideUtility
+            from z3c.testsetup.tests.test_snapshot import Greeter, IGreeter
+            self.executed.append(args)
+            provideUtility(Greeter(), IGreeter, 'snapshot-test')
+        debug.config = config
+        DefaultZCMLLayer.setUp = lambda layer: debug.config(layer.config_file)
+
+    def tearDown(self):
+        from zope.app.debug import debug
+        from zope.component import getGlobalSiteManager
+        from z3c.testsetup.functional.layer import DefaultZCMLLayer
+        from z3c.testsetup.tests.test_snapshot import IGreeter
+        debug.config = self.orig_config
+        DefaultZCMLLayer.setUp = self.orig_setup
+        getGlobalSiteManager().unregisterUtility(
+            provided=IGreeter, name='snapshot-test')
+        shutil.rmtree(self.workdir)
+
+    def test_broken_snapshot(self):
+        # broken snapshots are replaced by executing the ZCML
+        from z3c.testsetup.functional.layer import SnapshotZCMLLayer
+        from z3c.testsetup.snapshot import (
+            get_snapshot_key, load_snapshot, save_snapshot)
+        layer = SnapshotZCMLLayer(self.zcml_path, __name__, 'Layer',
+                                  cache_dir=self.workdir)
+        key = get_snapshot_key(self.zcml_path)
+        save_snapshot(layer.snapshot_dir, key, b'garbage')
+        layer.setUp()
+        assert len(self.executed) == 1
+        data = load_snapshot(layer.snapshot_dir, key)
+        assert data not in (None, b'garbage')
+        # the new snapshot is used next time
+        layer.setUp()
+        assert len(self.executed) == 1
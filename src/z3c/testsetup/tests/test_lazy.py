@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+""" Tests for `z3c.testsetup.lazy`.
+"""
+import doctest
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from martian.scan import ModuleInfo
+from z3c.testsetup.doctesting import SimpleDocTestSetup, UnitDocTestSetup
+from z3c.testsetup.lazy import (
+    LazyDocFileSuite, LazyModuleSuite, LazySuite, LazyTest,
+    get_static_test_names, iter_tests)
+from z3c.testsetup.testing import UnitTestSetup
+from z3c.testsetup.tests import cave, layered_cave, othercave
+
+TEST_MODULE = '''"""
+:Test-Layer: python
+"""
+import unittest
+from unittest import TestCase
+
+
+class Mixin(object):
+
+    def test_mixed_in(self):
+        pass
+
+
+class ZTests(unittest.TestCase):
+
+    def test_b(self):
+        pass
+
+    def test_a(self):
+        pass
+
+    def helper(self):
+        pass
+
+
+class ATests(Mixin, TestCase):
+
+    def test_c(self):
+        pass
+
+
+class MoreATests(ATests):
+
+    def test_fail(self):
+        self.fail("failing")
+'''
+
+
+class TestStaticTestNames(unittest.TestCase):
+
+    def test_get_static_test_names(self):
+        # we get the tests in the order the loader delivers them
+        assert get_static_test_names(TEST_MODULE) == [
+            ('ATests', ['test_c', 'test_mixed_in']),
+            ('MoreATests', ['test_c', 'test_fail', 'test_mixed_in']),
+            ('ZTests', ['test_a', 'test_b'])]
+
+    def test_get_static_test_names_safe_names(self):
+        # constants and classes of unittest do not make us unsure
+        source = ("from unittest import TestCase, TestSuite, mock\n"
+                  "from foo import helper\nLIMIT = 30\nNAMES = ('a', )\n")
+        assert get_static_test_names(source) == []
+
+    def test_get_static_test_names_unsure(self):
+        # if we cannot be sure about the tests, we get `None`
+        for source in (
+                "from foo import BaseTests\n",
+                "from foo.base import SharedChecks\n",
+                "from foo import SharedChecks as _Checks\n",
+                "from unittest import FunctionTestCase\n",
+                "import foo\nChecks = foo.SharedChecks\n",
+                "from foo import *\n",
+                "import foo\nclass ATests(foo.Base):\n    pass\n",
+                "def load_tests(loader, tests, pattern):\n    pass\n",
+                "import unittest\nclass ATests(unittest.TestCase):\n"
+                "    layer = 'foo'\n",
+                "import unittest\nclass ATests(unittest.TestCase):\n"
+                "    test_a = lambda self: None\n",
+                "import unittest\nif True:\n"
+                "    class ATests(unittest.TestCase):\n        pass\n",
+                "def broken(:\n"):
+            assert get_static_test_names(source) is None, source
+
+
+class TestLazySuite(unittest.TestCase):
+
+    def test_load_tests(self):
+        # tests are loaded by the callable given, once and when needed
+        calls = []
+
+        class SampleTests(unittest.TestCase):
+
+            def test_b(self):
+                pass
+
+            def test_a(self):
+                pass
+
+        def load_tests():
+            calls.append(True)
+            return unittest.defaultTestLoader.loadTestsFromTestCase(
+                SampleTests)
+        suite = LazySuite(load_tests)
+        assert not suite.isIterable()
+        assert calls == []
+        assert suite.countTestCases() == 2
+        assert suite.isIterable()
+        assert [x.id().split('.')[-1] for x in iter_tests(suite)] == [
+            'test_a', 'test_b']
+        assert calls == [True]
+
+
+class TestLazyModuleSuite(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        sys.path.insert(0, self.workdir)
+        os.mkdir(os.path.join(self.workdir, "lazytestpkg"))
+        self.create_file("", "__init__.py")
+        self.create_file(TEST_MODULE, "test_mod.py")
+
+    def tearDown(self):
+        sys.path.remove(self.workdir)
+        for name in list(sys.modules):
+            if name.startswith("lazytestpkg"):
+                del sys.modules[name]
+        shutil.rmtree(self.workdir)
+
+    def create_file(self, content, filename):
+        with open(os.path.join(self.workdir, "lazytestpkg", filename),
+                  "w") as fd:
+            fd.write(content)
+
+    def get_suite(self, name="lazytestpkg.test_mod"):
+        path = os.path.join(
+            self.workdir, "lazytestpkg", name.split(".")[-1] + ".py")
+        return LazyModuleSuite(ModuleInfo(path, name))
+
+    def test_iterate_without_import(self):
+        # we get tests with the real ids without importing the module
+        suite = self.get_suite()
+        tests = list(suite)
+        assert suite.countTestCases() == 7
+        # testrunners look for layers
+        assert getattr(tests[0], "layer", None) is None
+        assert "lazytestpkg.test_mod" not in sys.modules
+        assert [x.id() for x in tests] == [
+            x.id() for x in iter_tests(unittest.defaultTestLoader
+                                       .loadTestsFromName(
+                                           "lazytestpkg.test_mod"))]
+        sys.modules.pop("lazytestpkg.test_mod")
+        real = list(iter_tests(unittest.defaultTestLoader.loadTestsFromName(
+            "lazytestpkg.test_mod")))
+        assert [str(x) for x in tests] == [str(x) for x in real]
+
+    def test_run_lazy_tests(self):
+        # running a placeholder runs the real test
+        tests = list(self.get_suite())
+        assert isinstance(tests[0], LazyTest)
+        result = unittest.TestResult()
+        for test in tests:
+            test(result)
+        assert result.testsRun == 7
+        assert len(result.failures) == 1
+        assert "test_fail" in str(result.failures[0][0])
+
+    def test_run_suite(self):
+        # running the suite itself works as well
+        result = unittest.TestResult()
+        self.get_suite().run(result)
+        assert result.testsRun == 7
+        assert len(result.failures) == 1
+
+    def test_import_error(self):
+        # import errors are reported as test errors
+        self.create_file(TEST_MODULE + "import not_existing_module\n",
+                         "test_broken.py")
+        tests = list(self.get_suite("lazytestpkg.test_broken"))
+        result = unittest.TestResult()
+        tests[0](result)
+        assert len(result.errors) == 1
+        assert "not_existing_module" in result.errors[0][1]
+
+    def test_unknown_tests(self):
+        # modules with unknown tests are imported when iterated
+        self.create_file(
+            "from lazytestpkg.test_mod import ZTests\n", "test_import.py")
+        suite = self.get_suite("lazytestpkg.test_import")
+        assert "lazytestpkg.test_import" not in sys.modules
+        assert len(list(iter_tests(suite))) == 2
+        assert "lazytestpkg.test_import" in sys.modules
+
+    def test_imported_test_classes(self):
+        # test classes imported from elsewhere are not lost
+        self.create_file(
+            "import unittest\n\n\nclass SharedChecks(unittest.TestCase):"
+            "\n\n    def test_shared(self):\n        pass\n", "base.py")
+        self.create_file(
+            "import unittest\nfrom lazytestpkg.base import SharedChecks\n"
+            "\n\nclass OwnTests(unittest.TestCase):\n\n"
+            "    def test_own(self):\n        pass\n", "test_shared.py")
+        suite = self.get_suite("lazytestpkg.test_shared")
+        eager = unittest.defaultTestLoader.loadTestsFromName(
+            "lazytestpkg.test_shared")
+        assert [x.id() for x in iter_tests(suite)] == [
+            x.id() for x in iter_tests(eager)]
+        assert len(list(iter_tests(suite))) == 2
+
+    def test_unit_test_setup_lazy(self):
+        # lazy setups deliver the same tests
+        expected = [x.id() for x in iter_tests(
+            UnitTestSetup(cave).getTestSuite())]
+        assert expected
+        suite = UnitTestSetup(cave, lazy=True).getTestSuite()
+        assert [x.id() for x in iter_tests(suite)] == expected
+
+
+class TestLazyDocFileSuite(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, "my.test.txt")
+        with open(self.path, "w") as fd:
+            fd.write("A doctest::\n\n  >>> 1 + 1\n  3\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_lazy_doc_file_suite(self):
+        # doctest files are parsed when run only
+        created = []
+
+        def suite_creator(*args, **kw):
+            created.append(args)
+            return doctest.DocFileSuite(*args, **kw)
+
+        suite = LazyDocFileSuite(
+            suite_creator, self.path, module_relative=False)
+        tests = list(suite)
+        assert created == []
+        real = list(iter_tests(doctest.DocFileSuite(
+            self.path, module_relative=False)))
+        assert [(x.id(), str(x)) for x in tests] == [
+            (x.id(), str(x)) for x in real]
+        result = unittest.TestResult()
+        tests[0](result)
+        assert created == [(self.path, )]
+        assert len(result.failures) == 1
+
+    def test_doc_test_setup_lazy(self):
+        # lazy setups deliver the same tests with the same layers
+        def get_tests(suite):
+            return [(x.id(), str(x), getattr(y, "layer", None))
+                    for y in suite for x in iter_tests(y)]
+
+        def simple_setup(**kw):
+            # doctests not needing zope.app.testing
+            setup = SimpleDocTestSetup(othercave, **kw)
+            setup.filter_func = lambda path: setup.isTestFile(path) and (
+                os.path.basename(path) in ("doctest01.txt", "doctest08.py"))
+            return setup
+
+        expected = get_tests(simple_setup().getTestSuite())
+        assert len(expected) == 2
+        lazy_suite = simple_setup(lazy=True).getTestSuite()
+        assert isinstance(list(lazy_suite)[0], LazyDocFileSuite)
+        assert get_tests(lazy_suite) == expected
+        expected = get_tests(UnitDocTestSetup(layered_cave).getTestSuite())
+        assert expected
+        assert get_tests(UnitDocTestSetup(
+            layered_cave, lazy=True).getTestSuite()) == expected
+
+
+class TestLazyAttributes(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        sys.path.insert(0, self.workdir)
+        pkg_dir = os.path.join(self.workdir, "lazyattrpkg")
+        os.mkdir(pkg_dir)
+        open(os.path.join(pkg_dir, "__init__.py"), "w").close()
+        with open(os.path.join(pkg_dir, "testing.py"), "w") as fd:
+            fd.write("class Layer(object):\n    pass\n\n"
+                     "def setUp(test):\n    test.globs['x'] = 42\n")
+        with open(os.path.join(pkg_dir, "test.txt"), "w") as fd:
+            fd.write(":doctest:\n:layer: lazyattrpkg.testing.Layer\n"
+                     ":setup: lazyattrpkg.testing.setUp\n\n"
+                     "  >>> x\n  42\n")
+
+    def tearDown(self):
+        sys.path.remove(self.workdir)
+        for name in list(sys.modules):
+            if name.startswith("lazyattrpkg"):
+                del sys.modules[name]
+        shutil.rmtree(self.workdir)
+
+    def test_lazy_layer_and_setup(self):
+        # layers and setup functions are imported when needed
+        import lazyattrpkg
+        suite = SimpleDocTestSetup(lazyattrpkg, lazy=True).getTestSuite()
+        tests = list(suite)
+        assert len(tests) == 1
+        assert "lazyattrpkg.testing" not in sys.modules
+        assert tests[0].layer.__name__ == "Layer"
+        result = unittest.TestResult()
+        tests[0].run(result)
+        assert result.wasSuccessful()
+        assert result.testsRun == 1
+        assert tests[0].layer == sys.modules["lazyattrpkg.testing"].Layer
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+""" Tests for `z3c.testsetup.ordering`.
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import z3c.testsetup
+from martian.scan import ModuleInfo
+from z3c.testsetup.lazy import LazyModuleSuite
+from z3c.testsetup import testrunner
+from z3c.testsetup.ordering import (
+    allows_teardown, get_layer_name, get_test_path, load_layer_costs,
+    order_by_layer, order_runner_layers, iter_layered_tests,
+    LAYER_COSTS_FILENAME, RunPriority)
+from z3c.testsetup.util import LazyAttribute
+from z3c.testsetup.tests import cave
+from z3c.testsetup.tests.test_samples import Capture
+from z3c.testsetup.tests.test_testsetup import get_basenames_from_suite
+from z3c.testsetup.timings import get_timing_db, sqlite3, timing_dbs
+
+
+class BaseLayer(object):
+    pass
+
+
+class SubLayer1(BaseLayer):
+    pass
+
+
+class SubLayer2(BaseLayer):
+    pass
+
+
+class OtherLayer(object):
+    pass
+
+
+class NoTeardownLayer(object):
+    allow_teardown = False
+
+
+class InstanceLayer(object):
+    # A layer made of an instance, like a ZCML layer.
+
+    def __init__(self, name, bases=(), allow_teardown=True):
+        self.__name__ = name
+        self.__bases__ = bases
+        self.allow_teardown = allow_teardown
+
+
+ZCMLBaseLayer = InstanceLayer('ZCMLBaseLayer', allow_teardown=False)
+DerivedLayer = InstanceLayer('DerivedLayer', bases=(ZCMLBaseLayer, ))
+
+
+class DummyTest(unittest.TestCase):
+
+    def __init__(self, name):
+        unittest.TestCase.__init__(self, 'runTest')
+        self.name = name
+
+    def runTest(self):
+        pass
+
+    def __str__(self):
+        return self.name
+
+
+def make_suite(layer, *names):
+    suite = unittest.TestSuite([DummyTest(x) for x in names])
+    if layer is not None:
+        suite.layer = layer
+    return suite
+
+
+def get_names(suite):
+    return [(get_layer_name(layer), str(test))
+            for test, layer, level in iter_layered_tests(suite)]
+
+
+class TestOrderByLayer(unittest.TestCase):
+
+    def get_suite(self):
+        return unittest.TestSuite([
+            make_suite(NoTeardownLayer, 'n1'),
+            make_suite(SubLayer2, 's2a'),
+            make_suite(OtherLayer, 'o1'),
+            make_suite(None, 'u1'),
+            make_suite(SubLayer1, 's1a'),
+            make_suite(SubLayer2, 's2b'),
+            make_suite(BaseLayer, 'b1'),
+            make_suite(None, 'u2'),
+        ])
+
+    def test_order_by_layer(self):
+        # unit tests first, families together, no teardown last
+        names = [x[1] for x in get_names(order_by_layer(self.get_suite()))]
+        assert names[:2] == ['u1', 'u2']
+        assert names[-1] == 'n1'
+        # the base layer family is kept together, bases first
+        assert names[2:] == ['b1', 's1a', 's2a', 's2b', 'o1', 'n1']
+
+    def test_order_by_cost(self):
+        # cheap layer families come first
+        costs = {get_layer_name(SubLayer1): 10.0}
+        names = [x[1] for x in get_names(
+            order_by_layer(self.get_suite(), costs))]
+        assert names[2:] == ['o1', 'b1', 's1a', 's2a', 's2b', 'n1']
+
+    def test_lazy_layers_and_suites(self):
+        # lazy layers and suites are not loaded for ordering
+        layer = LazyAttribute('not.existing.Layer')
+        suite = LazyModuleSuite(
+            ModuleInfo('/not/existing.py', 'not.existing'))
+        suite.layer = layer
+        ordered = order_by_layer(unittest.TestSuite([
+            suite, make_suite(None, 'u1')]))
+        assert [(x[0], x[1] if x[1] == 'u1' else None)
+                for x in get_names(ordered)] == [
+            (get_layer_name(None), 'u1'), ('not.existing.Layer', None)]
+
+    def test_load_layer_costs(self):
+        # costs are read from the cache dir
+        cache_dir = tempfile.mkdtemp()
+        try:
+            assert load_layer_costs(cache_dir) == {}
+            with open(os.path.join(cache_dir, LAYER_COSTS_FILENAME),
+                      'w') as fd:
+                json.dump({'foo.Layer': 2.5}, fd)
+            assert load_layer_costs(cache_dir) == {'foo.Layer': 2.5}
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_collector_order_layers(self):
+        # collectors can order their tests by layer
+        expected = get_basenames_from_suite(z3c.testsetup.TestCollector(
+            cave)())
+        collector = z3c.testsetup.TestCollector(cave, order_layers=True)
+        assert collector.order_layers
+        assert 'order_layers' not in collector.settings
+        assert sorted(get_basenames_from_suite(collector())) == sorted(
+            expected)
+
+    def test_order_by_priority(self):
+        # tests are ordered by priority within their layer
+        ranks = {'s2b': 0, 'u2': 0, 'n1': 0}
+        names = [x[1] for x in get_names(order_by_layer(
+            self.get_suite(), priority=lambda x: ranks.get(str(x), 1)))]
+        assert names == ['u2', 'u1', 'b1', 's1a', 's2b', 's2a', 'o1', 'n1']
+
+
+RUNNER_SAMPLE_TESTS = '''
+import unittest
+
+
+class ALayer(object):
+    allow_teardown = False
+
+    @classmethod
+    def setUp(cls):
+        print("Setting up ALayer")
+
+    @classmethod
+    def tearDown(cls):
+        raise NotImplementedError
+
+
+class BLayer(object):
+
+    @classmethod
+    def setUp(cls):
+        print("Setting up BLayer")
+
+
+class ATests(unittest.TestCase):
+
+    layer = ALayer
+
+    def test_a(self):
+        pass
+
+
+class BTests(unittest.TestCase):
+
+    layer = BLayer
+
+    def test_b(self):
+        pass
+'''
+
+
+class TestRunnerLayers(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.pkgdir = os.path.join(self.workdir, 'orderedsample')
+        os.mkdir(self.pkgdir)
+        open(os.path.join(self.pkgdir, '__init__.py'), 'w').close()
+        with open(os.path.join(self.pkgdir, 'tests.py'), 'w') as fd:
+            fd.write(RUNNER_SAMPLE_TESTS)
+        self._sys_argv_old = sys.argv[:]
+        sys.argv = ['test', '--no-color']
+
+    def tearDown(self):
+        sys.argv[:] = self._sys_argv_old
+        for name in list(sys.modules):
+            if name.startswith('orderedsample'):
+                del sys.modules[name]
+        shutil.rmtree(self.workdir)
+
+    def test_order_runner_layers(self):
+        # the order of the testrunner is kept within families
+        layers = [(get_layer_name(x), x, None) for x in (
+            None, NoTeardownLayer, BaseLayer, SubLayer1, OtherLayer)]
+        assert [x[1] for x in order_runner_layers(layers)] == [
+            None, BaseLayer, SubLayer1, OtherLayer, NoTeardownLayer]
+        costs = {get_layer_name(SubLayer1): 10.0}
+        assert [x[1] for x in order_runner_layers(layers, costs)] == [
+            None, OtherLayer, BaseLayer, SubLayer1, NoTeardownLayer]
+
+    def test_derived_layers(self):
+        # layers based on layers that cannot be torn down cannot either
+        assert not allows_teardown(DerivedLayer)
+        assert allows_teardown(InstanceLayer('Layer', bases=(BaseLayer, )))
+        layers = [(get_layer_name(x), x, None) for x in (
+            ZCMLBaseLayer, DerivedLayer, OtherLayer)]
+        assert [x[1] for x in order_runner_layers(layers)] == [
+            OtherLayer, ZCMLBaseLayer, DerivedLayer]
+
+    def run_tests(self, *args):
+        with Capture() as cap:
+            testrunner.run(['--path', self.workdir,
+                            '--tests-pattern', '^tests$'] + list(args))
+        return cap.out
+
+    def test_no_teardown_last(self):
+        # the testrunner runs layers that cannot be torn down last
+        output = self.run_tests('--order-layers')
+        assert (output.index("Setting up BLayer") <
+                output.index("Setting up ALayer"))
+        assert "subprocess" not in output
+        assert "Total: 2 tests, 0 failures, 0 errors" in output
+
+    def test_no_ordering(self):
+        # without asking for it, the order of the testrunner is kept
+        output = self.run_tests()
+        assert (output.index("Setting up ALayer") <
+                output.index("Setting up BLayer"))
+
+
+class TestRunPriority(unittest.TestCase):
+
+    def setUp(self):
+        self.test = DummyTest('dummy')
+        self.mtime = os.stat(get_test_path(self.test)).st_mtime
+
+    def test_test_path(self):
+        # tests are found in the files defining them
+        assert get_test_path(self.test).endswith('test_ordering.py')
+        suite = LazyModuleSuite(
+            ModuleInfo('/not/existing.py', 'not.existing'))
+        assert get_test_path(suite) == '/not/existing.py'
+
+    def test_failed_first(self):
+        # tests that failed last time come first
+        outcomes = {self.test.id(): 'failure'}
+        last_runs = {self.test.id(): self.mtime + 1}
+        assert RunPriority(outcomes, last_runs)(self.test) == 0
+        outcomes = {self.test.id(): 'success'}
+        assert RunPriority(outcomes, last_runs)(self.test) == 2
+        outcomes = {self.test.id(): 'error'}
+        assert RunPriority(
+            outcomes, last_runs, failed_first=False)(self.test) == 2
+
+    def test_changed_first(self):
+        # tests changed since their last run come next
+        last_runs = {self.test.id(): self.mtime - 1}
+        assert RunPriority({}, last_runs)(self.test) == 1
+        assert RunPriority(
+            {}, last_runs, changed_first=False)(self.test) == 2
+        # tests never run count as changed
+        assert RunPriority({}, {'other': self.mtime + 1})(self.test) == 1
+        # unless nothing was recorded at all
+        assert RunPriority({}, {})(self.test) == 2
+
+    def test_lazy_suites(self):
+        # suites not loaded yet match the recorded ids of their module
+        info = ModuleInfo(__file__, __name__)
+        suite = LazyModuleSuite(info)
+        suite._lazy_tests = None
+        test_id = __name__ + '.DummyTest.runTest'
+        priority = RunPriority(
+            {test_id: 'failure'}, {test_id: time.time() + 1})
+        assert priority.getTestIds(suite) == [test_id]
+        assert priority(suite) == 0
+
+    @unittest.skipIf(sqlite3 is None, "No sqlite3 available")
+    def test_collector_failed_first(self):
+        # collectors run tests that failed last time first
+        cache_dir = tempfile.mkdtemp()
+        try:
+            test_id = 'z3c.testsetup.tests.cave.file1.TestTest.testFoo'
+            db = get_timing_db(cache_dir)
+            db.add('test', test_id, 0.1, outcome='failure')
+            db.flush()
+            collector = z3c.testsetup.TestCollector(
+                cave, failed_first=True, cache_dir=cache_dir)
+            assert 'failed_first' not in collector.settings
+            tests = [x[0] for x in iter_layered_tests(collector())]
+            assert tests[0].id() == test_id
+            assert len(tests) == 2
+        finally:
+            timing_dbs.clear()
+            shutil.rmtree(cache_dir)
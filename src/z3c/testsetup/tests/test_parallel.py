@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+""" Tests for `z3c.testsetup.parallel`.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from z3c.testsetup import testrunner
+from z3c.testsetup.tests.test_samples import Capture
+
+SAMPLE_TESTS = '''
+import os
+import time
+import unittest
+
+PIDS_PATH = os.path.join(os.path.dirname(__file__), "pids")
+
+
+class SampleLayer(object):
+
+    @classmethod
+    def setUp(cls):
+        print("Setting up SampleLayer")
+
+
+def record_pid():
+    with open(PIDS_PATH, "a") as fd:
+        fd.write("%s\\n" % os.getpid())
+    time.sleep(0.05)
+
+
+class SampleTests(unittest.TestCase):
+
+    layer = SampleLayer
+
+    def test_one(self):
+        record_pid()
+
+    def test_two(self):
+        record_pid()
+
+    def test_three(self):
+        record_pid()
+
+    def test_four(self):
+        record_pid()
+        self.fail("Failing on purpose")
+
+    def test_five(self):
+        record_pid()
+        raise unittest.SkipTest("Skipping on purpose")
+'''
+
+
+class TestForkedLayers(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.pkgdir = os.path.join(self.workdir, 'forkedsample')
+        os.mkdir(self.pkgdir)
+        open(os.path.join(self.pkgdir, '__init__.py'), 'w').close()
+        with open(os.path.join(self.pkgdir, 'tests.py'), 'w') as fd:
+            fd.write(SAMPLE_TESTS)
+        self._sys_argv_old = sys.argv[:]
+        sys.argv = ['test', '--no-color']
+
+    def tearDown(self):
+        sys.argv[:] = self._sys_argv_old
+        for name in list(sys.modules):
+            if name.startswith('forkedsample'):
+                del sys.modules[name]
+        shutil.rmtree(self.workdir)
+
+    def run_tests(self, *args, **kw):
+        defaults = ['--path', self.workdir, '--tests-pattern', '^tests$']
+        defaults.extend(args)
+        with Capture() as cap:
+            failed = testrunner.run(defaults, **kw)
+        with open(os.path.join(self.pkgdir, 'pids')) as fd:
+            pids = set(fd.read().split())
+        return failed, cap.out, pids
+
+    if hasattr(os, 'fork'):
+
+        def test_forked_workers(self):
+            # tests of a layer run in workers forked after layer setup
+            failed, output, pids = self.run_tests(fork_workers=3)
+            assert failed
+            assert output.count("Setting up SampleLayer") == 1
+            assert str(os.getpid()) not in pids
+            assert len(pids) > 1
+            assert (
+                "Ran 5 tests with 1 failures, 0 errors and 1 skipped"
+                in output)
+            assert "Failure in test test_four" in output
+            assert "Failing on purpose" in output
+
+        def test_forked_workers_option(self):
+            # the number of workers can be given on the command line
+            failed, output, pids = self.run_tests('--fork-workers=2')
+            assert len(pids) == 2
+            assert (
+                "Ran 5 tests with 1 failures, 0 errors and 1 skipped"
+                in output)
+
+    def test_no_workers(self):
+        # without workers, tests run in the main process
+        failed, output, pids = self.run_tests()
+        assert pids == set([str(os.getpid())])
+        assert (
+            "Ran 5 tests with 1 failures, 0 errors and 1 skipped"
+            in output)
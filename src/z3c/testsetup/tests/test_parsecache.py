@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+""" Tests for `z3c.testsetup.parsecache`.
+"""
+import doctest
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from z3c.testsetup.doctesting import UnitDocTestSetup
+from z3c.testsetup.lazy import iter_tests
+from z3c.testsetup.parsecache import (
+    CachingDocTestParser, DocTestParseCache, get_parse_cache, parse_caches)
+from z3c.testsetup.tests import layered_cave
+
+DOCTEST = u"""A doctest::
+
+  >>> print(u"\\u00e4")  # doctest: +ELLIPSIS, -NORMALIZE_WHITESPACE
+  ...
+  >>> raise ValueError("foo")
+  Traceback (most recent call last):
+  ValueError: foo
+"""
+
+
+class CountingParser(CachingDocTestParser):
+
+    parsed = 0
+
+    def parse(self, string, name='<string>'):
+        self.parsed += 1
+        return CachingDocTestParser.parse(self, string, name)
+
+
+def get_example_data(examples):
+    return [(x.source, x.want, x.exc_msg, x.lineno, x.indent, x.options)
+            for x in examples]
+
+
+class TestParseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        parse_caches.clear()
+        shutil.rmtree(self.cache_dir)
+
+    def test_cached_examples(self):
+        # examples are parsed once and are the same when cached
+        expected = get_example_data(
+            doctest.DocTestParser().get_examples(DOCTEST))
+        assert expected[0][5]
+        cache = DocTestParseCache(self.cache_dir)
+        parser = CountingParser(cache)
+        assert get_example_data(parser.get_examples(DOCTEST)) == expected
+        parser = CountingParser(DocTestParseCache(self.cache_dir))
+        assert get_example_data(parser.get_examples(DOCTEST)) == expected
+        assert parser.parsed == 0
+        # changed texts are parsed again
+        parser.get_examples(DOCTEST + u"  >>> 1\n  1\n")
+        assert parser.parsed == 1
+
+    def test_eviction(self):
+        # least recently used entries are removed first
+        cache = DocTestParseCache(self.cache_dir, max_bytes=350)
+        for num, key in enumerate(("a", "b", "c")):
+            cache.set(key, "x" * 100)
+            past = time.time() - 100 + num
+            os.utime(os.path.join(self.cache_dir, key), (past, past))
+        assert cache.get("a") is not None
+        cache.set("d", "x" * 100)
+        assert sorted(os.listdir(self.cache_dir)) == ["a", "c", "d"]
+
+    def test_broken_entries(self):
+        # broken entries are ignored
+        cache = DocTestParseCache(self.cache_dir)
+        with open(os.path.join(self.cache_dir, "a"), "wb") as fd:
+            fd.write(b"\xff\x00garbage")
+        assert cache.get("a") is None
+
+    def test_setup_with_cache_dir(self):
+        # doctest setups use the cache if they get a cache dir
+        def get_examples(setup):
+            return [get_example_data(x._dt_test.examples)
+                    for x in iter_tests(setup.getTestSuite())]
+
+        expected = get_examples(UnitDocTestSetup(layered_cave))
+        assert expected
+        setup = UnitDocTestSetup(layered_cave, cache_dir=self.cache_dir)
+        assert setup.parse_cache is get_parse_cache(self.cache_dir)
+        assert get_examples(setup) == expected
+        assert os.listdir(setup.parse_cache.path)
+        assert get_examples(setup) == expected
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+""" Tests for `z3c.testsetup.results`.
+"""
+import doctest
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from z3c.testsetup import testrunner
+from z3c.testsetup.results import (
+    get_file_state, get_result_key, is_unchanged, result_caches, sqlite3)
+from z3c.testsetup.tests.test_samples import Capture
+
+SAMPLE_FILES = {
+    '__init__.py': '',
+    'helper.py': 'def answer():\n    return 42\n',
+    'consts.py': 'LIMIT = 30\n',
+    'layers.py': (
+        'class SampleLayer(object):\n\n'
+        '    @classmethod\n'
+        '    def setUp(cls):\n'
+        '        import cachedsample.consts\n'
+        '        print("Setting up SampleLayer")\n'),
+    'answer.txt': (
+        ':doctest:\n'
+        ':layer: cachedsample.layers.SampleLayer\n\n'
+        '  >>> from cachedsample.helper import answer\n'
+        '  >>> answer()\n'
+        '  42\n'),
+    'limit.txt': (
+        ':doctest:\n'
+        ':layer: cachedsample.layers.SampleLayer\n\n'
+        '  >>> from cachedsample.consts import LIMIT\n'
+        '  >>> LIMIT\n'
+        '  30\n'),
+    'failing.txt': (
+        ':doctest:\n\n'
+        '  >>> 1 + 1\n'
+        '  3\n'),
+    'tests.py': (
+        'import z3c.testsetup\n'
+        'test_suite = z3c.testsetup.register_doctests(\n'
+        '    "cachedsample", cache_results=True)\n'),
+}
+
+
+class TestFileStates(unittest.TestCase):
+
+    def test_file_state(self):
+        # files with equal contents count as unchanged
+        workdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(workdir, 'file.txt')
+            assert get_file_state(path) is None
+            with open(path, 'w') as fd:
+                fd.write('contents')
+            state = get_file_state(path)
+            assert is_unchanged(path, state)
+            os.utime(path, (0, 0))
+            assert is_unchanged(path, state)
+            with open(path, 'w') as fd:
+                fd.write('changed')
+            assert not is_unchanged(path, state)
+            os.unlink(path)
+            assert not is_unchanged(path, state)
+        finally:
+            shutil.rmtree(workdir)
+
+    def test_result_key(self):
+        # option flags, checker and globs are part of the key
+        path = __file__.replace('.pyc', '.py')
+        targets = (None, None, None, None)
+        key = get_result_key(path, targets)
+        assert key == get_result_key(path, targets, 0, {})
+        assert key != get_result_key(path, targets, doctest.ELLIPSIS)
+        assert key != get_result_key(
+            path, (None, None, None, doctest.OutputChecker))
+        globs = {'answer': 42, 'func': get_file_state, 'obj': object()}
+        assert key != get_result_key(path, targets, globs=globs)
+        # but only what stays the same from run to run
+        assert get_result_key(path, targets, globs=globs) == get_result_key(
+            path, targets, globs=dict(globs, obj=object()))
+        assert get_result_key(path, targets, globs=globs) != get_result_key(
+            path, targets, globs=dict(globs, answer=43))
+
+
+@unittest.skipIf(sqlite3 is None, "No sqlite3 available")
+class TestCachedResults(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.pkgdir = os.path.join(self.workdir, 'cachedsample')
+        os.mkdir(self.pkgdir)
+        for name, content in SAMPLE_FILES.items():
+            self.write(name, content)
+        self._sys_argv_old = sys.argv[:]
+        sys.argv = ['test', '--no-color']
+        self._cache_dir_old = os.environ.get('Z3C_TESTSETUP_CACHE_DIR')
+        os.environ['Z3C_TESTSETUP_CACHE_DIR'] = os.path.join(
+            self.workdir, 'cache')
+
+    def tearDown(self):
+        sys.argv[:] = self._sys_argv_old
+        if self._cache_dir_old is None:
+            del os.environ['Z3C_TESTSETUP_CACHE_DIR']
+        else:
+            os.environ['Z3C_TESTSETUP_CACHE_DIR'] = self._cache_dir_old
+        self.forget_modules()
+        result_caches.clear()
+        shutil.rmtree(self.workdir)
+
+    def write(self, name, content):
+        with open(os.path.join(self.pkgdir, name), 'w') as fd:
+            fd.write(content)
+
+    def forget_modules(self):
+        for name in list(sys.modules):
+            if name.startswith('cachedsample'):
+                del sys.modules[name]
+
+    def run_tests(self):
+        self.forget_modules()
+        with Capture() as cap:
+            testrunner.run(
+                ['--path', self.workdir, '--tests-pattern', '^tests$',
+                 '-vv'])
+        return cap.out
+
+    def test_cached_results(self):
+        # passing doctests are not run again
+        output = self.run_tests()
+        assert "Setting up SampleLayer" in output
+        assert "Total: 3 tests, 1 failures" in output
+        output = self.run_tests()
+        # the layer is not set up, as nothing is left to run in it
+        assert "Setting up SampleLayer" not in output
+        assert "answer.txt (cached)" in output
+        assert "limit.txt (cached)" in output
+        assert "Ran 3 tests with 1 failures" in output
+        # changing code run by the test makes it run again
+        self.write('helper.py', '# changed\ndef answer():\n    return 42\n')
+        output = self.run_tests()
+        assert "Setting up SampleLayer" in output
+        assert "answer.txt (cached)" not in output
+        # as does changing the layer
+        self.run_tests()
+        self.write('layers.py', SAMPLE_FILES['layers.py'] + '\n')
+        output = self.run_tests()
+        assert "Setting up SampleLayer" in output
+
+    def test_imported_modules(self):
+        # modules only read from count, even if imported before
+        self.run_tests()
+        output = self.run_tests()
+        assert "limit.txt (cached)" in output
+        self.write('consts.py', 'LIMIT = 60\n')
+        output = self.run_tests()
+        assert "limit.txt (cached)" not in output
+        assert "Total: 3 tests, 2 failures" in output
+
+    def test_failures_not_cached(self):
+        # tests failing after passing are run again
+        self.run_tests()
+        self.write('answer.txt', SAMPLE_FILES['answer.txt'] + '  >>> 0\n')
+        output = self.run_tests()
+        assert "Total: 3 tests, 2 failures" in output
+        output = self.run_tests()
+        assert "Total: 3 tests, 2 failures" in output
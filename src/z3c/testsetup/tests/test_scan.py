@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+""" Tests for `z3c.testsetup.scan`.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from z3c.testsetup.base import BasicTestSetup
+from z3c.testsetup.doctesting import SimpleDocTestSetup
+from z3c.testsetup.scan import (
+    PackageScan, filter_files, list_entries, walk_files)
+from z3c.testsetup.tests import cave, othercave
+
+
+class CountingScan(PackageScan):
+    # a package scan that counts real directory listings and reads
+
+    def __init__(self):
+        super(CountingScan, self).__init__()
+        self.listed = []
+        self.read_files = []
+
+    def listdir(self, dirpath):
+        if dirpath not in self._listings:
+            self.listed.append(dirpath)
+        return super(CountingScan, self).listdir(dirpath)
+
+    def readBytes(self, filepath, max_bytes=None, max_lines=None):
+        if (filepath, max_bytes, max_lines) not in self._bytes:
+            self.read_files.append(filepath)
+        return super(CountingScan, self).readBytes(
+            filepath, max_bytes, max_lines)
+
+
+class TestPackageScan(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_read_is_cached(self):
+        # file contents are read only once
+        path = os.path.join(self.workdir, "myfile")
+        with open(path, "wb") as fd:
+            fd.write(b"Line 1\n \xff\xfeW[ \nMARKER\n")
+        scan = PackageScan()
+        assert scan.read(path) == u"Line 1\n W[ \nMARKER\n"
+        os.unlink(path)
+        assert scan.read(path) == u"Line 1\n W[ \nMARKER\n"
+
+    def test_listdir(self):
+        # we get absolute paths and whether they denote directories
+        os.mkdir(os.path.join(self.workdir, "subdir"))
+        open(os.path.join(self.workdir, "myfile"), "w").close()
+        entries = sorted(PackageScan().listdir(self.workdir))
+        assert entries == [
+            (os.path.join(self.workdir, "myfile"), False),
+            (os.path.join(self.workdir, "subdir"), True)]
+
+    def test_setups_share_scan(self):
+        # setups sharing a scan walk and read the package only once
+        scan = CountingScan()
+        found = []
+        for regexp_list in (["MARKER"], [":(T|t)est-(L|l)ayer:"]):
+            setup = BasicTestSetup(cave, regexp_list=regexp_list)
+            setup.scan = scan
+            found.append(setup.getDocTestFiles())
+        assert len(scan.read_files) == len(set(scan.read_files))
+        assert len(scan.listed) == len(set(scan.listed))
+        # the results are the same as without a scan
+        for files, regexp_list in zip(
+                found, (["MARKER"], [":(T|t)est-(L|l)ayer:"])):
+            setup = BasicTestSetup(cave, regexp_list=regexp_list)
+            assert files == setup.getDocTestFiles()
+
+
+class TestWalkFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def create_file(self, *path_parts):
+        path = os.path.join(self.workdir, *path_parts)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, "w").close()
+        return path
+
+    def walk(self, **kw):
+        return sorted(walk_files(
+            self.workdir, lambda x: True, lambda x: True, **kw))
+
+    def test_walk_files(self):
+        # we find files in subdirectories
+        path1 = self.create_file("a.txt")
+        path2 = self.create_file("sub", "b.txt")
+        assert self.walk() == [path1, path2]
+
+    def test_walk_files_depth_first(self):
+        # files of a subdirectory come in place of the subdirectory
+        os.mkdir(os.path.join(self.workdir, "sub"))
+        self.create_file("sub", "b.txt")
+        self.create_file("sub", "deeper", "c.txt")
+
+        def listdir(dirpath):
+            # deliver entries in a fixed order
+            return sorted(list_entries(dirpath))
+
+        self.create_file("a.txt")
+        self.create_file("z.txt")
+        result = list(walk_files(
+            self.workdir, lambda x: True, lambda x: True, listdir=listdir))
+        assert [x[len(self.workdir):] for x in result] == [
+            os.sep + "a.txt",
+            os.sep + os.path.join("sub", "b.txt"),
+            os.sep + os.path.join("sub", "deeper", "c.txt"),
+            os.sep + "z.txt"]
+
+    def test_walk_files_exclude(self):
+        # we can exclude files and directories by glob patterns
+        path1 = self.create_file("a.txt")
+        self.create_file("foo.egg-info", "SOURCES.txt")
+        self.create_file("node_modules", "b.txt")
+        self.create_file("c.log")
+        assert self.walk(
+            exclude=["*.egg-info", "node_modules", "*.log"]) == [path1]
+
+    def test_walk_files_excluded_not_filtered(self):
+        # excluded entries are not passed to filters
+        self.create_file("build", "a.txt")
+        self.create_file("b.txt")
+        seen = []
+
+        def dir_filter(path):
+            seen.append(path)
+            return True
+
+        def file_filter(path):
+            seen.append(path)
+            return True
+
+        list(walk_files(self.workdir, dir_filter, file_filter,
+                        exclude=["build"]))
+        assert seen == [os.path.join(self.workdir, "b.txt")]
+
+    def test_walk_files_dir_filter(self):
+        # directories not accepted by the dir filter are skipped
+        path1 = self.create_file("a.txt")
+        self.create_file(".hidden", "b.txt")
+        result = list(walk_files(
+            self.workdir, lambda x: not os.path.basename(x).startswith('.'),
+            lambda x: True))
+        assert result == [path1]
+
+    if hasattr(os, "symlink"):
+
+        def test_walk_files_symlink_loop(self):
+            # symlink loops do not lead us astray
+            path1 = self.create_file("sub", "a.txt")
+            os.symlink(self.workdir, os.path.join(self.workdir, "sub", "loop"))
+            assert self.walk() == [path1]
+
+        def test_walk_files_symlinked_tree(self):
+            # trees reachable via several symlinks are walked only once
+            path1 = self.create_file("sub", "a.txt")
+            os.symlink(os.path.join(self.workdir, "sub"),
+                       os.path.join(self.workdir, "sublink1"))
+            os.symlink(os.path.join(self.workdir, "sub"),
+                       os.path.join(self.workdir, "sublink2"))
+
+            def listdir(dirpath):
+                # deliver the real directory first
+                return sorted(list_entries(dirpath))
+            assert self.walk(listdir=listdir) == [path1]
+
+
+class TestFilterFiles(unittest.TestCase):
+
+    def test_filter_files_keeps_order(self):
+        # paths come out in the order they went in
+        import time
+
+        def slow_filter(path):
+            # later paths are done earlier
+            time.sleep((100 - path) * 0.0001)
+            return path % 3 != 0
+
+        result = list(filter_files(range(100), slow_filter, 8))
+        assert result == [x for x in range(100) if x % 3 != 0]
+
+    def test_filter_files_bounded(self):
+        # there are never more than `max_pending` paths in flight
+        seen = []
+
+        def paths():
+            for num in range(20):
+                seen.append(num)
+                yield num
+
+        result = filter_files(paths(), lambda x: True, 2, max_pending=3)
+        assert next(result) == 0
+        assert len(seen) == 3
+        assert list(result) == list(range(1, 20))
+
+    def test_setup_scan_workers(self):
+        # concurrent checking gives the same files as serial checking
+        serial = SimpleDocTestSetup(othercave).getDocTestFiles()
+        assert len(serial) == 9
+        concurrent = SimpleDocTestSetup(
+            othercave, scan_workers=4).getDocTestFiles()
+        assert serial == concurrent
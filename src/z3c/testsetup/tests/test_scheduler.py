@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+""" Tests for `z3c.testsetup.scheduler`.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from z3c.testsetup import testrunner
+from z3c.testsetup.scheduler import make_units
+from z3c.testsetup.tests.test_parallel import SAMPLE_TESTS
+from z3c.testsetup.tests.test_samples import Capture
+
+MORE_SAMPLE_TESTS = '''
+import unittest
+from forkedsample.tests import record_pid
+
+
+class StickyLayer(object):
+
+    @classmethod
+    def setUp(cls):
+        print("Setting up StickyLayer")
+
+    @classmethod
+    def tearDown(cls):
+        raise NotImplementedError
+
+
+class StickyTests(unittest.TestCase):
+
+    layer = StickyLayer
+
+    def test_sticky(self):
+        record_pid()
+
+
+class PlainTests(unittest.TestCase):
+
+    def test_plain(self):
+        record_pid()
+
+    def test_broken(self):
+        record_pid()
+        raise ValueError("Broken on purpose")
+'''
+
+
+class FakeTest(object):
+
+    def __init__(self, test_id):
+        self.test_id = test_id
+
+    def id(self):
+        return self.test_id
+
+
+class TestMakeUnits(unittest.TestCase):
+
+    def test_longest_first(self):
+        # units come longest first
+        units = make_units([
+            ('short', [FakeTest('a')]),
+            ('long', [FakeTest('b')])],
+            2, durations={'a': 1.0, 'b': 10.0},
+            layer_costs={'short': 0, 'long': 0})
+        assert [x.layer_name for x in units] == ['long', 'short']
+
+    def test_long_layers_are_cut(self):
+        # layers taking long compared to their setup are cut in chunks
+        tests = [FakeTest(str(x)) for x in range(8)]
+        durations = dict([(str(x), 1.0) for x in range(8)])
+        units = make_units([('layer', tests)], 4, durations=durations,
+                           layer_costs={'layer': 0.5})
+        assert len(units) == 4
+        assert sorted(sum([x.indexes for x in units], [])) == list(range(8))
+        assert [x.cost for x in units] == [2.5] * 4
+
+    def test_expensive_layers_are_not_cut(self):
+        # layers expensive to set up stay in one unit
+        tests = [FakeTest(str(x)) for x in range(8)]
+        durations = dict([(str(x), 1.0) for x in range(8)])
+        units = make_units([('layer', tests)], 4, durations=durations,
+                           layer_costs={'layer': 60.0})
+        assert len(units) == 1
+        assert units[0].indexes == list(range(8))
+
+
+class TestScheduledLayers(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.pkgdir = os.path.join(self.workdir, 'forkedsample')
+        os.mkdir(self.pkgdir)
+        open(os.path.join(self.pkgdir, '__init__.py'), 'w').close()
+        with open(os.path.join(self.pkgdir, 'tests.py'), 'w') as fd:
+            fd.write(SAMPLE_TESTS)
+        with open(os.path.join(self.pkgdir, 'tests2.py'), 'w') as fd:
+            fd.write(MORE_SAMPLE_TESTS)
+        self._sys_argv_old = sys.argv[:]
+        sys.argv = ['test', '--no-color']
+
+    def tearDown(self):
+        sys.argv[:] = self._sys_argv_old
+        for name in list(sys.modules):
+            if name.startswith('forkedsample'):
+                del sys.modules[name]
+        shutil.rmtree(self.workdir)
+
+    if hasattr(os, 'fork'):
+
+        def test_workers(self):
+            # all layers are run by a pool of workers
+            defaults = ['--path', self.workdir, '--tests-pattern', '^tests',
+                        '--workers', '2']
+            with Capture() as cap:
+                failed = testrunner.run(defaults)
+            with open(os.path.join(self.pkgdir, 'pids')) as fd:
+                pids = set(fd.read().split())
+            assert failed
+            assert str(os.getpid()) not in pids
+            assert "Setting up StickyLayer" in cap.out
+            assert "Broken on purpose" in cap.out
+            assert "Failing on purpose" in cap.out
+            assert (
+                "Total: 8 tests, 1 failures, 1 errors and 1 skipped"
+                in cap.out)
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+""" Tests for `z3c.testsetup.sharding`.
+"""
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+from z3c.testsetup import testrunner
+from z3c.testsetup.ordering import UNIT_LAYER_NAME
+from z3c.testsetup.sharding import (
+    load_shard_timings, make_shards, parse_shard, save_shard_timings,
+    select_shard)
+from z3c.testsetup.tests.test_parallel import SAMPLE_TESTS
+from z3c.testsetup.tests.test_samples import Capture
+from z3c.testsetup.tests.test_scheduler import FakeTest, MORE_SAMPLE_TESTS
+
+
+def get_shard_tests(shard):
+    return sorted([(x.layer_name, index) for x in shard
+                   for index in x.indexes])
+
+
+class CallableTest(FakeTest):
+
+    def __call__(self, result):
+        pass
+
+
+class FakeOutput(object):
+
+    def __init__(self):
+        self.lines = []
+
+    def info(self, line):
+        self.lines.append(line)
+
+
+class FakeOptions(object):
+
+    processes = 1
+
+    def __init__(self):
+        self.output = FakeOutput()
+
+
+class FakeRunner(object):
+    """Just enough of a testrunner for `select_shard`.
+    """
+
+    def __init__(self, layer_tests):
+        self.options = FakeOptions()
+        self.layer_tests = layer_tests
+        self.tests_by_layer_name = dict(layer_tests)
+
+    def ordered_layers(self):
+        for name, tests in self.layer_tests:
+            yield name, None, tests
+
+
+class TestMakeShards(unittest.TestCase):
+
+    def test_parse_shard(self):
+        # shards count from one
+        assert parse_shard('1/3') == (0, 3)
+        assert parse_shard('3/3') == (2, 3)
+        for value in ('0/3', '4/3', '1/0', '1', 'a/b', None):
+            self.assertRaises(ValueError, parse_shard, value)
+
+    def test_all_tests_once(self):
+        # every test is in exactly one shard
+        layer_tests = [
+            ('layer%s' % num, [FakeTest('%s.%s' % (num, x))
+                               for x in range(num + 1)], True)
+            for num in range(5)]
+        shards = make_shards(layer_tests, 3)
+        assert len(shards) == 3
+        found = sum([get_shard_tests(x) for x in shards], [])
+        assert sorted(found) == sorted(
+            [(name, index) for name, tests, splittable in layer_tests
+             for index in range(len(tests))])
+        # and the partition is the same every time
+        assert [get_shard_tests(x) for x in shards] == [
+            get_shard_tests(x) for x in make_shards(layer_tests, 3)]
+
+    def test_layers_kept_together(self):
+        # layers are not cut if they fit into a shard
+        layer_tests = [
+            ('a', [FakeTest('a1'), FakeTest('a2')], True),
+            ('b', [FakeTest('b1'), FakeTest('b2')], True)]
+        shards = make_shards(layer_tests, 2)
+        assert [[x.layer_name for x in shard] for shard in shards] == [
+            ['a'], ['b']]
+
+    def test_weighted(self):
+        # recorded durations weigh
+        layer_tests = [
+            ('a', [FakeTest('a1')], True),
+            ('b', [FakeTest('b1')], True),
+            ('c', [FakeTest('c1')], True)]
+        shards = make_shards(
+            layer_tests, 2, durations={'a1': 10.0, 'b1': 4.0, 'c1': 5.0},
+            layer_costs={'a': 0.0, 'b': 0.0, 'c': 0.0})
+        assert [[x.layer_name for x in shard] for shard in shards] == [
+            ['a'], ['c', 'b']]
+
+    def test_long_layers_are_cut(self):
+        # layers taking longer than a shard are cut, if possible
+        tests = [FakeTest(str(x)) for x in range(8)]
+        durations = dict([(str(x), 1.0) for x in range(8)])
+        shards = make_shards([('layer', tests, True)], 4,
+                             durations=durations, layer_costs={'layer': 0.5})
+        assert [get_shard_tests(x) for x in shards] == [
+            [('layer', x), ('layer', x + 1)] for x in range(0, 8, 2)]
+        shards = make_shards([('layer', tests, False)], 4,
+                             durations=durations, layer_costs={'layer': 0.5})
+        assert [len(x) for x in shards] == [1, 0, 0, 0]
+
+    def select(self, layer_tests, index):
+        runner = FakeRunner(layer_tests)
+        select_shard(runner, index, 2)
+        selected = dict([(name, sorted([x.id() for x in tests]))
+                         for name, tests in
+                         runner.tests_by_layer_name.items()])
+        return selected, runner.options.output.lines[0]
+
+    def test_order_independent(self):
+        # the order tests are run in does not change the partition
+        tests = [CallableTest('a%s' % x) for x in range(4)]
+        first, line = self.select([(UNIT_LAYER_NAME, tests)], 0)
+        assert re.match(
+            r'Running shard 1 of 2: 2 of 4 tests \(partition \w{12}\)$',
+            line)
+        assert self.select([(UNIT_LAYER_NAME, tests[::-1])], 0) == (
+            first, line)
+        # all shards report the same partition
+        second, other_line = self.select([(UNIT_LAYER_NAME, tests)], 1)
+        assert line.split()[-1] == other_line.split()[-1]
+        assert sorted(first[UNIT_LAYER_NAME] + second[UNIT_LAYER_NAME]) == [
+            'a0', 'a1', 'a2', 'a3']
+
+
+class TestShardTimings(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_timings_file(self):
+        # timings files are written from the cache dir and read back
+        path = os.path.join(self.workdir, 'timings.json')
+        save_shard_timings(path, os.path.join(self.workdir, 'cache'))
+        assert load_shard_timings(path) == ({}, {})
+        with open(path, 'w') as fd:
+            json.dump({'tests': {'a1': 1.0}, 'layers': {'a': 2.0}}, fd)
+        assert load_shard_timings(path) == ({'a1': 1.0}, {'a': 2.0})
+
+    def test_bad_timings_file(self):
+        # machines must not fall back to other timings
+        path = os.path.join(self.workdir, 'timings.json')
+        self.assertRaises(ValueError, load_shard_timings, path)
+        with open(path, 'w') as fd:
+            fd.write('[]')
+        self.assertRaises(ValueError, load_shard_timings, path)
+
+
+class TestShardedLayers(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.pkgdir = os.path.join(self.workdir, 'forkedsample')
+        os.mkdir(self.pkgdir)
+        open(os.path.join(self.pkgdir, '__init__.py'), 'w').close()
+        with open(os.path.join(self.pkgdir, 'tests.py'), 'w') as fd:
+            fd.write(SAMPLE_TESTS)
+        with open(os.path.join(self.pkgdir, 'tests2.py'), 'w') as fd:
+            fd.write(MORE_SAMPLE_TESTS)
+        self._sys_argv_old = sys.argv[:]
+        sys.argv = ['test', '--no-color']
+
+    def tearDown(self):
+        sys.argv[:] = self._sys_argv_old
+        for name in list(sys.modules):
+            if name.startswith('forkedsample'):
+                del sys.modules[name]
+        shutil.rmtree(self.workdir)
+
+    def run_shard(self, shard, *args, **kw):
+        defaults = ['--path', self.workdir, '--tests-pattern', '^tests',
+                    '--shard', shard]
+        defaults.extend(args)
+        with Capture() as cap:
+            testrunner.run(defaults, **kw)
+        return cap.out
+
+    def get_partition(self, output):
+        return re.search(r'\(partition (\w+)\)', output).group(1)
+
+    def test_shards(self):
+        # each shard runs its own layers
+        output = self.run_shard('1/2')
+        assert "Running shard 1 of 2: 5 of 8 tests" in output
+        assert "Setting up SampleLayer" in output
+        assert "Setting up StickyLayer" not in output
+        assert "Ran 5 tests with 1 failures, 0 errors and 1 skipped" in output
+        output = self.run_shard('2/2')
+        assert "Running shard 2 of 2: 3 of 8 tests" in output
+        assert "Setting up SampleLayer" not in output
+        assert "Setting up StickyLayer" in output
+        assert "Total: 3 tests, 0 failures, 1 errors" in output
+
+    def test_recorded_timings_ignored(self):
+        # timings recorded on a machine do not change its partition
+        partition = self.get_partition(self.run_shard('1/2'))
+        cache_dir = os.path.join(self.workdir, 'cache')
+        self.run_shard('1/2', '--record-timings', cache_dir=cache_dir)
+        output = self.run_shard('1/2', cache_dir=cache_dir)
+        assert self.get_partition(output) == partition
+        # unless they are passed as a timings file
+        path = os.path.join(self.workdir, 'timings.json')
+        with open(path, 'w') as fd:
+            json.dump({'tests': {
+                'forkedsample.tests2.PlainTests.test_plain': 100.0,
+                'forkedsample.tests2.PlainTests.test_broken': 100.0},
+                'layers': {}}, fd)
+        output = self.run_shard('1/2', '--shard-timings', path)
+        assert self.get_partition(output) != partition
+        assert self.get_partition(
+            self.run_shard('2/2', '--shard-timings', path)) == (
+            self.get_partition(output))
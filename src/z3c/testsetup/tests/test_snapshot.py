@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+""" Tests for `z3c.testsetup.snapshot`.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from six.moves import cPickle as pickle
+from zope.interface import (
+    Interface, classImplements, implementedBy, implementer)
+from zope.interface.registry import Components
+from z3c.testsetup.snapshot import (
+    SnapshotRecorder, get_snapshot_dir, get_snapshot_key, iter_zcml_files,
+    load_snapshot, restore_snapshot, save_snapshot)
+
+
+class IGreeter(Interface):
+    pass
+
+
+class IContext(Interface):
+    pass
+
+
+@implementer(IGreeter)
+class Greeter(object):
+
+    def __init__(self, context=None):
+        self.context = context
+
+
+class IMarker(Interface):
+    pass
+
+
+class Plain(object):
+    pass
+
+
+def handle_context(context):
+    pass
+
+
+class TestZCMLFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def write(self, filename, content):
+        path = os.path.join(self.workdir, filename)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fd:
+            fd.write(content)
+        return os.path.realpath(path)
+
+    def test_iter_zcml_files(self):
+        # included files are found, also with globs and in subdirs
+        main = self.write('ftesting.zcml', (
+            '<configure xmlns="http://namespaces.zope.org/zope">\n'
+            '  <include file="a.zcml" />\n'
+            '  <include files="sub/*.zcml" />\n'
+            '  <include file="missing.zcml" />\n'
+            '</configure>\n'))
+        a_zcml = self.write('a.zcml', (
+            '<configure xmlns="http://namespaces.zope.org/zope">\n'
+            '  <include file="ftesting.zcml" />\n'
+            '</configure>\n'))
+        b_zcml = self.write(os.path.join('sub', 'b.zcml'), '<configure />')
+        c_zcml = self.write(os.path.join('sub', 'c.zcml'), '<configure />')
+        assert list(iter_zcml_files(main)) == [main, a_zcml, b_zcml, c_zcml]
+
+    def test_iter_zcml_files_packages(self):
+        # includes of packages are looked up in the package
+        main = self.write('ftesting.zcml', (
+            '<configure xmlns="http://namespaces.zope.org/zope">\n'
+            '  <include package="z3c.testsetup.tests.othercave"\n'
+            '           file="ftesting2.zcml" />\n'
+            '</configure>\n'))
+        result = list(iter_zcml_files(main))
+        from z3c.testsetup.tests import othercave
+        assert result == [main, os.path.realpath(os.path.join(
+            os.path.dirname(othercave.__file__), 'ftesting2.zcml'))]
+
+    def test_snapshot_key(self):
+        # keys change with included files
+        main = self.write('ftesting.zcml', (
+            '<configure xmlns="http://namespaces.zope.org/zope">\n'
+            '  <include file="a.zcml" />\n'
+            '</configure>\n'))
+        self.write('a.zcml', '<configure />')
+        key = get_snapshot_key(main)
+        assert get_snapshot_key(main) == key
+        self.write('a.zcml', '<configure><!-- changed --></configure>')
+        assert get_snapshot_key(main) != key
+
+
+class TestSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_restore_snapshot(self):
+        # registrations made after start are restored
+        registry = Components()
+        registry.registerUtility(Greeter(), IGreeter, name='before')
+        recorder = SnapshotRecorder(registry)
+        recorder.start()
+        registry.registerUtility(Greeter(), IGreeter, name='after')
+        registry.registerAdapter(Greeter, (IContext, ), IGreeter)
+        registry.registerSubscriptionAdapter(Greeter, (IContext, ), IGreeter)
+        registry.registerHandler(handle_context, (IContext, ))
+        data = recorder.take()
+        assert data is not None
+
+        new_registry = Components()
+        restore_snapshot(data, new_registry)
+        names = [x.name for x in new_registry.registeredUtilities()]
+        assert names == ['after']
+        assert isinstance(
+            new_registry.getUtility(IGreeter, name='after'), Greeter)
+        assert [x.factory for x in new_registry.registeredAdapters()] == [
+            Greeter]
+        assert [x.factory for x in
+                new_registry.registeredSubscriptionAdapters()] == [Greeter]
+        assert [x.factory for x in new_registry.registeredHandlers()] == [
+            handle_context]
+
+    def test_restore_class_declarations(self):
+        # interfaces declared for classes are declared again
+        recorder = SnapshotRecorder(Components())
+        recorder.start()
+        classImplements(Plain, IMarker)
+        data = recorder.take()
+        try:
+            # Forget the declaration, as a new process would.
+            del Plain.__implemented__
+            assert not IMarker.implementedBy(Plain)
+            restore_snapshot(data, Components())
+            assert IMarker.implementedBy(Plain)
+            # restoring again declares nothing twice
+            restore_snapshot(data, Components())
+            assert list(implementedBy(Plain)) == [IMarker]
+        finally:
+            del Plain.__implemented__
+
+    def test_unchanged_classes(self):
+        # classes without interfaces added are not recorded
+        recorder = SnapshotRecorder(Components())
+        recorder.start()
+        implementedBy(Plain)
+        data = recorder.take()
+        try:
+            files, payload = pickle.loads(data)
+            assert pickle.loads(payload)[2] == []
+        finally:
+            del Plain.__implemented__
+
+    def test_broken_snapshot(self):
+        # snapshots that cannot be loaded are not restored
+        registry = Components()
+        assert not restore_snapshot(b'garbage', registry)
+        recorder = SnapshotRecorder(Components())
+        recorder.start()
+        recorder.registry.registerUtility(Greeter(), IGreeter)
+        data = recorder.take()
+        # a class got renamed
+        data = data.replace(b'Greeter', b'Greetex')
+        assert not restore_snapshot(data, registry)
+        assert list(registry.registeredUtilities()) == []
+
+    def test_partly_restored(self):
+        # registrations are rolled back if restoring fails on the way
+        payload = ([('utility', Greeter(), IGreeter, u'', u''),
+                    ('adapter', Greeter, None, IGreeter, u'', u'')], [], [])
+        data = pickle.dumps(({}, pickle.dumps(payload, 2)), 2)
+        registry = Components()
+        assert not restore_snapshot(data, registry)
+        assert list(registry.registeredUtilities()) == []
+
+    def test_stale_snapshot(self):
+        # snapshots are not restored if a module of theirs changed
+        pkgdir = os.path.join(self.workdir, 'snapsample')
+        os.mkdir(pkgdir)
+        open(os.path.join(pkgdir, '__init__.py'), 'w').close()
+        module_path = os.path.join(pkgdir, 'things.py')
+        with open(module_path, 'w') as fd:
+            fd.write('class Thing(object):\n    pass\n')
+        sys.path.insert(0, self.workdir)
+        try:
+            from snapsample.things import Thing
+            recorder = SnapshotRecorder(Components())
+            recorder.start()
+            recorder.registry.registerUtility(Thing(), IGreeter)
+            data = recorder.take()
+            files = pickle.loads(data)[0]
+            assert os.path.realpath(module_path) in [
+                os.path.realpath(x) for x in files]
+            assert restore_snapshot(data, Components())
+            with open(module_path, 'w') as fd:
+                fd.write('class Thing(object):\n    changed = True\n')
+            registry = Components()
+            assert not restore_snapshot(data, registry)
+            assert list(registry.registeredUtilities()) == []
+        finally:
+            sys.path.remove(self.workdir)
+            for name in list(sys.modules):
+                if name.startswith('snapsample'):
+                    del sys.modules[name]
+
+    def test_unpicklable(self):
+        # registrations that cannot be pickled give no snapshot
+        registry = Components()
+        recorder = SnapshotRecorder(registry)
+        recorder.start()
+        registry.registerAdapter(lambda x: x, (IContext, ), IGreeter)
+        assert recorder.take() is None
+
+    def test_save_and_load(self):
+        # snapshots are stored in the cache dir
+        snapshot_dir = get_snapshot_dir(self.workdir)
+        assert load_snapshot(snapshot_dir, 'key') is None
+        save_snapshot(snapshot_dir, 'key', b'data')
+        assert load_snapshot(snapshot_dir, 'key') == b'data'
+        assert os.listdir(snapshot_dir) == ['key']
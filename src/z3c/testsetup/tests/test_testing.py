@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+""" Tests for `z3c.testsetup.testing`.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from six import StringIO
+from z3c.testsetup.testing import UnitTestSetup
+from z3c.testsetup.tests import cave, importerrorcave
+
+
+class TestUnitTestSetup(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        sys.path.insert(0, self.workdir)
+
+    def tearDown(self):
+        sys.path.remove(self.workdir)
+        for name in list(sys.modules):
+            if name.split('.')[0] in ("statictestpkg", "subtestpkg"):
+                del sys.modules[name]
+        shutil.rmtree(self.workdir)
+
+    def create_file(self, content, *path_parts):
+        path = os.path.join(self.workdir, *path_parts)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as fd:
+            fd.write(content)
+
+    def get_modules(self, setup):
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            modules = setup.getModules()
+        finally:
+            output, sys.stdout = sys.stdout.getvalue(), stdout
+        return [x.__name__ for x in modules], output
+
+    def test_static_docstrings(self):
+        # static docstrings find the same modules as imports
+        expected = self.get_modules(UnitTestSetup(cave))
+        assert self.get_modules(
+            UnitTestSetup(cave, static_docstrings=True)) == expected
+
+    def test_static_docstrings_import_errors(self):
+        # broken test modules are still reported
+        modules, output = self.get_modules(
+            UnitTestSetup(importerrorcave, static_docstrings=True))
+        assert modules == []
+        assert "Import error in" in output
+        assert "broken_test_mod.py" in output
+        assert "broken_test_mod2.py" in output
+
+    def test_static_docstrings_no_import(self):
+        # modules with markers outside of their docstring are not imported
+        self.create_file("", "statictestpkg", "__init__.py")
+        self.create_file(
+            '"""No test."""\nMARKER = """\n:Test-Layer: python\n"""\n',
+            "statictestpkg", "notatest.py")
+        import statictestpkg
+        setup = UnitTestSetup(statictestpkg)
+        assert not setup.static_docstrings
+        assert self.get_modules(setup)[0] == []
+        assert "statictestpkg.notatest" in sys.modules
+        del sys.modules["statictestpkg.notatest"]
+        setup = UnitTestSetup(statictestpkg, static_docstrings=True)
+        assert self.get_modules(setup)[0] == []
+        assert "statictestpkg.notatest" not in sys.modules
+
+    def test_subpackages_not_imported(self):
+        # subpackages are imported only if they contain test modules
+        self.create_file("", "subtestpkg", "__init__.py")
+        self.create_file("raise ImportError('heavy')\n",
+                         "subtestpkg", "notests", "__init__.py")
+        self.create_file("", "subtestpkg", "notests", "mod.py")
+        self.create_file("", "subtestpkg", "withtests", "__init__.py")
+        self.create_file('"""\n:Test-Layer: python\n"""\n',
+                         "subtestpkg", "withtests", "deeper", "__init__.py")
+        self.create_file('"""\n:Test-Layer: python\n"""\n',
+                         "subtestpkg", "withtests", "deeper", "test_mod.py")
+        import subtestpkg
+        modules, output = self.get_modules(UnitTestSetup(subtestpkg))
+        assert modules == ["subtestpkg.withtests.deeper.test_mod"]
+        assert "subtestpkg.notests" not in sys.modules
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+""" Tests for `z3c.testsetup.timings`.
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from z3c.testsetup import testrunner
+from z3c.testsetup.ordering import LAYER_COSTS_FILENAME
+from z3c.testsetup.tests.test_parallel import SAMPLE_TESTS
+from z3c.testsetup.tests.test_samples import Capture
+from z3c.testsetup.timings import TimingDB, sqlite3, timing_dbs
+
+
+@unittest.skipIf(sqlite3 is None, "No sqlite3 available")
+class TestTimingDB(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, 'cache', 'timings.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_empty(self):
+        # nothing recorded, nothing found
+        db = TimingDB(self.path)
+        assert db.getDurations() == {}
+        assert db.getOutcomes() == {}
+
+    def test_durations(self):
+        # durations are the median of recorded wall times
+        db = TimingDB(self.path)
+        for wall in (1.0, 3.0, 2.0, 10.0):
+            db.add('test', 'a', wall, 0.5, 'success')
+        db.add('test', 'b', 0.0, None, 'skipped')
+        db.add('setup', 'Layer', 4.0)
+        db.flush()
+        assert db.getDurations() == {'a': 2.5}
+        assert db.getDurations('setup') == {'Layer': 4.0}
+        assert db.getOutcomes() == {'a': 'success', 'b': 'skipped'}
+
+    def test_history(self):
+        # only the last records of a test are kept
+        db = TimingDB(self.path, history=3)
+        for num in range(5):
+            db.add('test', 'a', float(num), outcome='success')
+            db.flush()
+        db.add('test', 'a', 5.0, outcome='failure')
+        db.flush()
+        records = TimingDB(self.path).getRecords()['a']
+        assert [x[1] for x in records] == [5.0, 4.0, 3.0]
+        assert db.getOutcomes() == {'a': 'failure'}
+
+
+@unittest.skipIf(sqlite3 is None, "No sqlite3 available")
+class TestRecordedTimings(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.workdir, 'cache')
+        self.pkgdir = os.path.join(self.workdir, 'forkedsample')
+        os.mkdir(self.pkgdir)
+        open(os.path.join(self.pkgdir, '__init__.py'), 'w').close()
+        with open(os.path.join(self.pkgdir, 'tests.py'), 'w') as fd:
+            fd.write(SAMPLE_TESTS)
+        self._sys_argv_old = sys.argv[:]
+        sys.argv = ['test', '--no-color']
+
+    def tearDown(self):
+        sys.argv[:] = self._sys_argv_old
+        for name in list(sys.modules):
+            if name.startswith('forkedsample'):
+                del sys.modules[name]
+        timing_dbs.clear()
+        shutil.rmtree(self.workdir)
+
+    def run_tests(self, *args, **kw):
+        defaults = ['--path', self.workdir, '--tests-pattern', '^tests$']
+        defaults.extend(args)
+        with Capture() as cap:
+            testrunner.run(defaults, cache_dir=self.cache_dir, **kw)
+        return cap.out
+
+    def test_record_timings(self):
+        # tests and layer setups are recorded
+        output = self.run_tests(record_timings=True)
+        assert "Ran 5 tests with 1 failures, 0 errors and 1 skipped" in output
+        db = TimingDB(os.path.join(self.cache_dir, 'timings.sqlite'))
+        outcomes = db.getOutcomes()
+        prefix = 'forkedsample.tests.SampleTests.'
+        assert outcomes[prefix + 'test_one'] == 'success'
+        assert outcomes[prefix + 'test_four'] == 'failure'
+        assert outcomes[prefix + 'test_five'] == 'skipped'
+        durations = db.getDurations()
+        assert durations[prefix + 'test_one'] >= 0.05
+        assert prefix + 'test_five' not in durations
+        with open(os.path.join(self.cache_dir, LAYER_COSTS_FILENAME)) as fd:
+            costs = json.load(fd)
+        assert 'forkedsample.tests.SampleLayer' in costs
+
+    def test_record_timings_option(self):
+        # recording can be switched on on the command line
+        self.run_tests('--record-timings')
+        assert os.path.exists(os.path.join(self.cache_dir, 'timings.sqlite'))
+
+    def test_no_recording(self):
+        # by default nothing is recorded
+        self.run_tests()
+        assert not os.path.exists(
+            os.path.join(self.cache_dir, 'timings.sqlite'))
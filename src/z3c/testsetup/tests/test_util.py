@@ -7,11 +7,18 @@ doctesting is a hell to debug and (in times of Sphinx) even not very
 useful for documentation, we write down new tests in Python.
 """
 import os
+import re
 import shutil
+import sys
 import tempfile
 import unittest
 from z3c.testsetup.util import (
-    got_working_zope_app_testing, get_keyword_params, get_marker_from_file)
+    got_working_zope_app_testing, get_keyword_params, get_marker_from_file,
+    get_marker_from_string, get_markers_from_string, get_file_markers,
+    FileMarkers, read_header, LineMatcher, get_line_matcher,
+    get_regex_literal, get_markers_from_bytes, decode_text,
+    get_module_docstring, get_attribute, get_lazy_attribute,
+    resolved_attributes, lazy_attributes)
 
 
 class TestUtil(unittest.TestCase):
@@ -103,3 +110,240 @@ class TestUtil(unittest.TestCase):
             fd.write(content)
         result = get_marker_from_file("some-layer", path)
         self.assertEqual(result, "foo")
+
+    def test_get_markers_from_string(self):
+        # we can get all markers of a text at once
+        text = (
+            "Some text\n :Test-Layer: unit\n.. :doctest:\n"
+            ":layer: foo.bar\n:LAYER: other\ngarbage :setup: x\n"
+            "..:teardown: y\n:a:b: c\n")
+        markers = get_markers_from_string(text)
+        for tag in ("test-layer", "doctest", "layer", "setup", "teardown",
+                    "a", "a:b", "b", "not-there"):
+            self.assertEqual(markers.get(tag),
+                             get_marker_from_string(tag, text))
+        self.assertEqual(markers["test-layer"], "unit")
+        self.assertEqual(markers["layer"], "foo.bar")
+
+    def test_file_markers_immutable(self):
+        # FileMarkers records cannot be changed
+        markers = FileMarkers("myfile", {"layer": "foo"})
+        self.assertRaises(AttributeError, setattr, markers, "filepath", "x")
+        self.assertEqual(markers.get("LAYER"), "foo")
+        assert "Layer" in markers
+        self.assertEqual(list(markers), ["layer"])
+
+    def test_get_file_markers_cached(self):
+        # markers are parsed once as long as the file does not change
+        path = os.path.join(self.workdir, "myfile")
+        with open(path, "w") as fd:
+            fd.write(":doctest:\n:layer: foo\n")
+        reads = []
+
+        def read(filepath, max_bytes, max_lines):
+            reads.append(filepath)
+            with open(filepath, "rb") as fd:
+                return fd.read()
+
+        markers = get_file_markers(path, read=read)
+        self.assertEqual(markers.get("layer"), "foo")
+        assert get_file_markers(path, read=read) is markers
+        self.assertEqual(reads, [path])
+        # changed files are parsed again
+        with open(path, "w") as fd:
+            fd.write(":doctest:\n:layer: foobar\n")
+        os.utime(path, (0, 0))
+        self.assertEqual(
+            get_file_markers(path, read=read).get("layer"), "foobar")
+        self.assertEqual(reads, [path, path])
+
+    def test_read_header_lines(self):
+        # we can read only the first lines of a file
+        path = os.path.join(self.workdir, "myfile")
+        with open(path, "wb") as fd:
+            fd.write(b"line 1\nline 2\nline 3\n" * 10000)
+        self.assertEqual(read_header(path, max_lines=2), b"line 1\nline 2\n")
+        self.assertEqual(
+            read_header(path, max_lines=4, chunk_size=5),
+            b"line 1\nline 2\nline 3\nline 1\n")
+
+    def test_read_header_bytes(self):
+        # we can read only the first bytes of a file
+        path = os.path.join(self.workdir, "myfile")
+        with open(path, "wb") as fd:
+            fd.write(b"line 1\nline 2\nline 3\n")
+        self.assertEqual(read_header(path, max_bytes=3), b"lin")
+        self.assertEqual(read_header(path, max_bytes=3, max_lines=1), b"lin")
+        self.assertEqual(read_header(path, max_bytes=100, max_lines=1),
+                         b"line 1\n")
+        self.assertEqual(read_header(path, max_bytes=100),
+                         b"line 1\nline 2\nline 3\n")
+
+    def test_get_module_docstring(self):
+        # we can get module docstrings without importing modules
+        path = os.path.join(self.workdir, "mod.py")
+        for content, expected in (
+                (b'# comment\n"""Doc\n:unittest:\n"""\nimport foo\n',
+                 u"Doc\n:unittest:\n"),
+                (b'("Doc "\n "string")\n', u"Doc string"),
+                (b'# -*- coding: latin-1 -*-\n"\xe4"\n', u"\xe4"),
+                (b'import foo\n"""Not a docstring"""\n', None),
+                (b'"Doc" + foo\n', None),
+                (b'b"Bytes"\n', None),
+                (b'', None)):
+            with open(path, "wb") as fd:
+                fd.write(content)
+            self.assertEqual(get_module_docstring(path), expected)
+
+    def test_get_file_markers_header_only(self):
+        # markers can be searched in the beginning of files only
+        path = os.path.join(self.workdir, "myfile")
+        with open(path, "w") as fd:
+            fd.write(":doctest:\n" + "text\n" * 100 + ":layer: foo\n")
+        markers = get_file_markers(path, max_lines=10)
+        self.assertEqual(markers.get("doctest"), "")
+        self.assertEqual(markers.get("layer"), None)
+        self.assertEqual(get_file_markers(path).get("layer"), "foo")
+
+
+class TestLineMatcher(unittest.TestCase):
+
+    texts = [
+        u"",
+        u"MARKER",
+        u"Line 1\nLine 2\nMARKER in file\n\n",
+        u"  MARKER\nfoo",
+        u":Test-Layer: unit\n",
+        u"Text\n  :test-layer:   unit  \nmore text\n",
+        u"Text\n:test-layer:\nunit\n",
+        u"Text\n:test-layer: functional\n",
+        u"Text\r\n.. :Test-Layer: python\r\n",
+        u"a\nb\nab\n",
+        u"x\n\n\ny",
+        ]
+
+    regexp_lists = [
+        [],
+        ["MARKER"],
+        ["MARKER", "Line"],
+        [r"^\s*:(T|t)est-(L|l)ayer:\s*(unit)\s*"],
+        [r"^\s*:(T|t)est-(L|l)ayer:\s*(functional)\s*"],
+        [r"^\.{0,2}\s*:(T|t)est-(L|l)ayer:\s*(python)\s*"],
+        [r"(?i).*test-layer:\s*UNIT"],
+        [r"a$", r"^b"],
+        [r"a(?=b)"],
+        [r"x\s*y"],
+        [r".*\Z"],
+        [r"[^x]*y"],
+        ]
+
+    def test_same_as_matching_lines(self):
+        # matchers give the same results as matching line by line
+        for regexp_list in self.regexp_lists:
+            regexs = [re.compile(x) for x in regexp_list]
+            matcher = LineMatcher(regexp_list)
+            for text in self.texts:
+                lines = text.split('\n')
+                expected = all(
+                    [any([x.match(line) for line in lines]) for x in regexs])
+                self.assertEqual(
+                    matcher.matches(text), expected,
+                    "%r on %r" % (regexp_list, text))
+
+    def test_get_regex_literal(self):
+        # we can find literals contained in all matches
+        self.assertEqual(get_regex_literal(
+            re.compile(r"^\s*:(T|t)est-(L|l)ayer:\s*(unit)\s*")), u"ayer:")
+        self.assertEqual(get_regex_literal(re.compile(u"MARKER")), u"MARKER")
+        self.assertEqual(get_regex_literal(re.compile(u"a|b")), None)
+        self.assertEqual(get_regex_literal(re.compile(u"(?i)MARKER")), None)
+
+    def test_get_line_matcher_cached(self):
+        # matchers are created once per regex list
+        matcher = get_line_matcher(["MARKER"])
+        assert get_line_matcher(["MARKER"]) is matcher
+        assert get_line_matcher(["MARKER", "foo"]) is not matcher
+
+    def test_get_markers_from_bytes(self):
+        # texts without any marker candidate are rejected early
+        self.assertEqual(get_markers_from_bytes(b"no\nmarkers\n"), {})
+        self.assertEqual(
+            get_markers_from_bytes(b"x\n  :Layer: foo\n"), {"layer": "foo"})
+        self.assertEqual(
+            get_markers_from_bytes(b"x\n .. :Layer: foo\n"),
+            {"layer": "foo"})
+        # leading non-ASCII whitespace is stripped like before
+        self.assertEqual(
+            get_markers_from_bytes(u"\u00a0:Layer: foo\n".encode("utf-8")),
+            {"layer": "foo"})
+        self.assertEqual(
+            get_markers_from_bytes(b"\x1f:Layer: foo\n"), {"layer": "foo"})
+
+    def test_line_matcher_accepts_bytes(self):
+        # we can reject bytes lacking the literals of regexes
+        matcher = LineMatcher([r"^\s*:(T|t)est-(L|l)ayer:\s*(unit)\s*"])
+        assert matcher.acceptsBytes(b":test-layer: unit\n")
+        assert not matcher.acceptsBytes(b"nothing here\n")
+        # invalid UTF-8 might hide literals, so we cannot reject those
+        assert matcher.acceptsBytes(b":test-la\xffyer: unit\n")
+        assert matcher.matches(
+            decode_text(b":test-la\xffyer: unit\n"))
+
+
+class TestAttributes(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        sys.path.insert(0, self.workdir)
+
+    def tearDown(self):
+        sys.path.remove(self.workdir)
+        sys.modules.pop("attrtestmod", None)
+        for cache in (resolved_attributes, lazy_attributes):
+            for name in list(cache):
+                if name.startswith("attrtestmod."):
+                    del cache[name]
+        shutil.rmtree(self.workdir)
+
+    def create_module(self):
+        with open(os.path.join(self.workdir, "attrtestmod.py"), "w") as fd:
+            fd.write("class Layer(object):\n    pass\n\n"
+                     "def setUp(test):\n    return test\n")
+
+    def test_get_attribute_cached(self):
+        # failures are remembered
+        self.assertRaises(ImportError, get_attribute, "attrtestmod.Layer")
+        self.create_module()
+        self.assertRaises(ImportError, get_attribute, "attrtestmod.Layer")
+        del resolved_attributes["attrtestmod.Layer"]
+        layer = get_attribute("attrtestmod.Layer")
+        assert get_attribute("attrtestmod.Layer") is layer
+        self.assertRaises(AttributeError, get_attribute, "attrtestmod.Foo")
+
+    def test_get_attribute_new_errors(self):
+        # each failing lookup gets an exception of its own
+        errors = []
+        for num in range(2):
+            try:
+                get_attribute("attrtestmod.Layer")
+            except ImportError as exc:
+                errors.append(exc)
+        assert errors[0] is not errors[1]
+        assert str(errors[0]) == str(errors[1])
+
+    def test_lazy_attribute(self):
+        # lazy attributes are imported at first use
+        self.create_module()
+        layer = get_lazy_attribute("attrtestmod.Layer")
+        assert get_lazy_attribute("attrtestmod.Layer") is layer
+        assert layer.__module__ == "attrtestmod"
+        assert layer.__name__ == "Layer"
+        assert "attrtestmod" not in sys.modules
+        real = get_attribute("attrtestmod.Layer")
+        assert layer == real
+        assert real == layer
+        assert hash(layer) == hash(real)
+        assert layer.__bases__ == (object, )
+        assert real in {layer: 1}
+        setup = get_lazy_attribute("attrtestmod.setUp")
+        assert setup(42) == 42
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+""" Tests for `z3c.testsetup.workqueue`.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from z3c.testsetup import testrunner
+from z3c.testsetup.tests.test_parallel import SAMPLE_TESTS
+from z3c.testsetup.tests.test_samples import Capture
+from z3c.testsetup.tests.test_scheduler import FakeTest, MORE_SAMPLE_TESTS
+from z3c.testsetup.workqueue import QUEUE_NAME, WorkQueue, make_batches
+
+
+class FakeFileTest(FakeTest):
+
+    def __init__(self, test_id, path):
+        FakeTest.__init__(self, test_id)
+        self.test_path = path
+
+
+class TestMakeBatches(unittest.TestCase):
+
+    def test_batches(self):
+        # layers are cut into batches of files taking as long as a setup
+        tests = [FakeFileTest('a1', 'a.txt'), FakeFileTest('a2', 'a.txt'),
+                 FakeFileTest('b1', 'b.txt'), FakeFileTest('c1', 'c.txt')]
+        durations = {'a1': 1.0, 'a2': 1.0, 'b1': 1.0, 'c1': 1.0}
+        units = make_batches([('layer', tests, True)], durations,
+                             {'layer': 1.0})
+        assert [x.indexes for x in units] == [[0, 1], [2], [3]]
+        assert [x.cost for x in units] == [3.0, 2.0, 2.0]
+        units = make_batches([('layer', tests, True)], durations,
+                             {'layer': 2.0})
+        assert [x.indexes for x in units] == [[0, 1], [2, 3]]
+        units = make_batches([('layer', tests, False)], durations,
+                             {'layer': 1.0})
+        assert [x.indexes for x in units] == [[0, 1, 2, 3]]
+
+
+class TestWorkQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.queue = WorkQueue(os.path.join(self.workdir, QUEUE_NAME))
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_claim(self):
+        # units are claimed once
+        assert not self.queue.exists()
+        self.queue.publish([{'layer': 'a'}, {'layer': 'b'}])
+        assert self.queue.exists()
+        assert self.queue.load() == [{'layer': 'a'}, {'layer': 'b'}]
+        assert self.queue.getPending() == [0, 1]
+        assert self.queue.claim([1, 0]) == 1
+        assert self.queue.claim([1]) is None
+        assert self.queue.getPending() == [0]
+        # and can be put back
+        self.queue.release(1)
+        assert self.queue.getPending() == [0, 1]
+
+    def test_finish(self):
+        # outcomes are stored
+        self.queue.publish([{'layer': 'a'}, {'layer': 'b'}])
+        self.queue.claim([0])
+        self.queue.finish(0, 'done', [[0, 1.0, []]], 'output')
+        assert self.queue.getDone() == [0]
+        assert self.queue.getResults() == {
+            0: ('done', [[0, 1.0, []]], 'output')}
+        # publishing again starts a new queue
+        self.queue.publish([{'layer': 'c'}])
+        assert self.queue.getDone() == []
+        assert self.queue.getPending() == [0]
+
+    def test_requeue_stale(self):
+        # claims not worked on are put back
+        self.queue.publish([{'layer': 'a'}, {'layer': 'b'}])
+        self.queue.claim([0, 1])
+        self.queue.claim([0, 1])
+        self.queue.finish(1, 'done', [], '')
+        assert self.queue.requeueStale(60) == 0
+        os.utime(os.path.join(self.queue.claimed_dir, '000000'), (0, 0))
+        assert self.queue.requeueStale(60) == 1
+        assert self.queue.getPending() == [0]
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), "No os.fork available")
+class TestQueuedLayers(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.queue_dir = os.path.join(self.workdir, 'shared')
+        self.pkgdir = os.path.join(self.workdir, 'forkedsample')
+        os.mkdir(self.pkgdir)
+        open(os.path.join(self.pkgdir, '__init__.py'), 'w').close()
+        with open(os.path.join(self.pkgdir, 'tests.py'), 'w') as fd:
+            fd.write(SAMPLE_TESTS)
+        with open(os.path.join(self.pkgdir, 'tests2.py'), 'w') as fd:
+            fd.write(MORE_SAMPLE_TESTS)
+        self._sys_argv_old = sys.argv[:]
+        sys.argv = ['test', '--no-color']
+
+    def tearDown(self):
+        sys.argv[:] = self._sys_argv_old
+        for name in list(sys.modules):
+            if name.startswith('forkedsample'):
+                del sys.modules[name]
+        shutil.rmtree(self.workdir)
+
+    def run_tests(self, *args, **kw):
+        defaults = ['--path', self.workdir, '--tests-pattern', '^tests']
+        defaults.extend(args)
+        with Capture() as cap:
+            failed = testrunner.run(defaults, **kw)
+        return failed, cap.out
+
+    def get_pids(self):
+        with open(os.path.join(self.pkgdir, 'pids')) as fd:
+            return set(fd.read().split())
+
+    def test_coordinator(self):
+        # the coordinator runs and reports all units
+        failed, output = self.run_tests('--queue-dir', self.queue_dir)
+        assert failed
+        assert str(os.getpid()) not in self.get_pids()
+        assert "Setting up SampleLayer" in output
+        assert "Setting up StickyLayer" in output
+        assert "Total: 8 tests, 1 failures, 1 errors and 1 skipped" in output
+        queue = WorkQueue(os.path.join(self.queue_dir, QUEUE_NAME))
+        assert len(queue.getDone()) == len(queue.load())
+
+    def test_worker(self):
+        # workers run the units published by a coordinator
+        self.run_tests('--queue-dir', self.queue_dir)
+        queue = WorkQueue(os.path.join(self.queue_dir, QUEUE_NAME))
+        queue.publish(queue.load())
+        failed, output = self.run_tests('--join-queue', self.queue_dir)
+        assert failed
+        assert "Total: 8 tests, 1 failures, 1 errors and 1 skipped" in output
+        assert len(queue.getDone()) == len(queue.load())
+
+    def test_no_queue(self):
+        # workers give up waiting for a queue
+        failed, output = self.run_tests(
+            '--join-queue', self.queue_dir, queue_timeout=0.1)
+        assert failed
+        assert "No queue found" in output
+
+    def test_stale_claims(self):
+        # units claimed by others are run if they are not worked on
+        self.run_tests('--queue-dir', self.queue_dir)
+        queue = WorkQueue(os.path.join(self.queue_dir, QUEUE_NAME))
+        units = queue.load()
+        orig_publish = WorkQueue.publish
+
+        def publish(queue, units):
+            # Someone else claims the first unit right away.
+            orig_publish(queue, units)
+            queue.claim([0])
+        WorkQueue.publish = publish
+        try:
+            failed, output = self.run_tests(
+                '--queue-dir', self.queue_dir, queue_timeout=0.1)
+        finally:
+            WorkQueue.publish = orig_publish
+        assert "Total: 8 tests, 1 failures, 1 errors and 1 skipped" in output
+        assert len(queue.getDone()) == len(units)
@@ -0,0 +1,279 @@
+##############################################################################
+#
+# Copyright (c) 2009 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""A history of test and layer timings.
+
+A `TimingRecorder` wraps the output formatter of the testrunner. It
+passes everything on and records wall time, CPU time and outcome of
+every test, layer setup and layer teardown it is told about in a
+`TimingDB`, an SQLite database in the cache dir. Only the last few
+records of each test or layer are kept.
+
+Recorded timings are used to schedule tests (see
+`z3c.testsetup.scheduler`) and to order layers by setup cost (see
+`z3c.testsetup.ordering`).
+"""
+import os
+import time
+from contextlib import contextmanager
+try:
+    import sqlite3
+except ImportError:
+    # Some Python builds come without SQLite support.
+    sqlite3 = None
+from z3c.testsetup.ordering import save_layer_costs
+from z3c.testsetup.parallel import process_time, testrunner_runner
+from z3c.testsetup.results import CachedPassTest
+from z3c.testsetup.util import get_cache_dir, warn
+
+TIMINGS_FILENAME = 'timings.sqlite'
+
+# Number of records kept per test or layer.
+TIMINGS_HISTORY = 10
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class TimingDB(object):
+    """Recorded timings of tests and layers.
+
+    Records are kept in memory until written to disk by `flush()`.
+    `kind` of a record is ``'test'``, ``'setup'`` or ``'teardown'``.
+    Forked processes start without the records of their parent.
+    """
+
+    def __init__(self, path, history=TIMINGS_HISTORY):
+        self.path = path
+        self.history = history
+        self._records = []
+        self._pid = os.getpid()
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS timings ("
+            "kind TEXT, name TEXT, started REAL, wall REAL, cpu REAL, "
+            "outcome TEXT)")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS timings_name "
+            "ON timings (kind, name, started)")
+        return conn
+
+    def add(self, kind, name, wall, cpu=None, outcome=None):
+        """Record a timing of test or layer `name`.
+        """
+        if self._pid != os.getpid():
+            # The parent process writes its records itself.
+            self._records = []
+            self._pid = os.getpid()
+        self._records.append((kind, name, time.time(), wall, cpu, outcome))
+
+    def flush(self):
+        """Write new records to disk, dropping old ones.
+        """
+        if not self._records or self._pid != os.getpid():
+            return
+        records, self._records = self._records, []
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO timings VALUES (?, ?, ?, ?, ?, ?)", records)
+                for kind, name in set([x[:2] for x in records]):
+                    conn.execute(
+                        "DELETE FROM timings WHERE kind = ? AND name = ? "
+                        "AND rowid NOT IN (SELECT rowid FROM timings "
+                        "WHERE kind = ? AND name = ? "
+                        "ORDER BY started DESC LIMIT ?)",
+                        (kind, name, kind, name, self.history))
+        finally:
+            conn.close()
+
+    def getRecords(self, kind='test'):
+        """Get the records of `kind` by name, newest first.
+
+        Each record is a ``(started, wall, cpu, outcome)`` tuple.
+        """
+        result = {}
+        if not os.path.exists(self.path):
+            return result
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT name, started, wall, cpu, outcome FROM timings "
+                "WHERE kind = ? ORDER BY started DESC", (kind, )).fetchall()
+        finally:
+            conn.close()
+        for row in rows:
+            result.setdefault(row[0], []).append(tuple(row[1:]))
+        return result
+
+    def getDurations(self, kind='test'):
+        """Get the typical wall time of tests or layers by name.
+
+        That is the median of the recorded wall times. Skipped tests do
+        not count.
+        """
+        result = {}
+        for name, records in self.getRecords(kind).items():
+            walls = [x[1] for x in records if x[3] != 'skipped']
+            if walls:
+                result[name] = median(walls)
+        return result
+
+    def getLastRuns(self):
+        """Get the time tests were last run by test id.
+        """
+        return dict([(name, records[0][0])
+                     for name, records in self.getRecords('test').items()])
+
+    def getOutcomes(self):
+        """Get the last recorded outcome of tests by test id.
+        """
+        return dict([(name, records[0][3])
+                     for name, records in self.getRecords('test').items()])
+
+
+timing_dbs = {}
+
+
+def get_timing_db(cache_dir=None):
+    """Get the `TimingDB` stored in `cache_dir`.
+
+    If no `cache_dir` is given, the one set in the environment is
+    used. Returns ``None`` if there is no cache dir at all.
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is None or sqlite3 is None:
+        return None
+    path = os.path.abspath(os.path.join(cache_dir, TIMINGS_FILENAME))
+    if path not in timing_dbs:
+        timing_dbs[path] = TimingDB(path)
+    return timing_dbs[path]
+
+
+class TimingRecorder(object):
+    """An output formatter recording timings in `db`.
+
+    All output is done by the wrapped formatter `output`.
+    """
+
+    def __init__(self, output, db):
+        self.output = output
+        self.db = db
+        self._layer_name = None
+        self._cpu_start = None
+        self._cpu_time = None
+
+    def __getattr__(self, name):
+        return getattr(self.output, name)
+
+    def _start(self):
+        self._cpu_start = process_time()
+        self._cpu_time = None
+
+    def _record(self, kind, name, seconds, outcome):
+        cpu = self._cpu_time
+        if cpu is None and self._cpu_start is not None:
+            cpu = process_time() - self._cpu_start
+        self.db.add(kind, name, seconds, cpu, outcome)
+
+    def set_cpu_time(self, seconds):
+        """Set the CPU time of the current test, if it was run
+        somewhere else.
+        """
+        self._cpu_time = seconds
+
+    def flush_timings(self):
+        self.db.flush()
+
+    def start_test(self, test, *args, **kw):
+        self._start()
+        return self.output.start_test(test, *args, **kw)
+
+    def test_success(self, test, seconds, *args, **kw):
+        if not isinstance(test, CachedPassTest):
+            # Cached passes take no time.
+            self._record('test', test.id(), seconds, 'success')
+        return self.output.test_success(test, seconds, *args, **kw)
+
+    def test_failure(self, test, seconds, *args, **kw):
+        self._record('test', test.id(), seconds, 'failure')
+        return self.output.test_failure(test, seconds, *args, **kw)
+
+    def test_error(self, test, seconds, *args, **kw):
+        self._record('test', test.id(), seconds, 'error')
+        return self.output.test_error(test, seconds, *args, **kw)
+
+    def test_skipped(self, test, *args, **kw):
+        self._record('test', test.id(), 0.0, 'skipped')
+        return self.output.test_skipped(test, *args, **kw)
+
+    def start_set_up(self, layer_name):
+        self._layer_name = layer_name
+        self._start()
+        return self.output.start_set_up(layer_name)
+
+    def stop_set_up(self, seconds):
+        self._record('setup', self._layer_name, seconds, 'success')
+        return self.output.stop_set_up(seconds)
+
+    def start_tear_down(self, layer_name):
+        self._layer_name = layer_name
+        self._start()
+        return self.output.start_tear_down(layer_name)
+
+    def stop_tear_down(self, seconds):
+        self._record('teardown', self._layer_name, seconds, 'success')
+        return self.output.stop_tear_down(seconds)
+
+    def tear_down_not_supported(self):
+        self._record('teardown', self._layer_name, 0.0, 'not-supported')
+        return self.output.tear_down_not_supported()
+
+
+@contextmanager
+def recorded_timings(cache_dir=None):
+    """Record timings of testrunner runs while in context.
+
+    Afterwards, the recorded setup costs of layers are stored for
+    `z3c.testsetup.ordering` as well.
+    """
+    db = get_timing_db(cache_dir)
+    if db is None or testrunner_runner is None:
+        warn("No cache dir or no `sqlite3` available. "
+             "Timings are not recorded.")
+        yield None
+        return
+    orig_configure = testrunner_runner.Runner.configure
+
+    def configure(runner):
+        result = orig_configure(runner)
+        runner.options.output = TimingRecorder(runner.options.output, db)
+        return result
+    testrunner_runner.Runner.configure = configure
+    try:
+        yield db
+    finally:
+        testrunner_runner.Runner.configure = orig_configure
+        db.flush()
+        save_layer_costs(db.getDurations('setup'), cache_dir)
@@ -15,13 +15,22 @@
 """
 from __future__ import print_function
 
-import codecs
+import ast
+import os
 import sys
 import re
+import tokenize
 
 from inspect import getmro, ismethod, isfunction, getargspec
 from martian.scan import resolve
-from six import string_types
+from six import string_types, text_type, unichr as six_unichr
+try:
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:
+    # Python < 3.11
+    import sre_parse
+    import sre_constants
 
 
 def get_package(pkg_or_dotted_name):
@@ -92,6 +101,210 @@ def get_marker_from_string(marker, text):
     return None
 
 
+rest_comment_regex = re.compile(r'\.\.\s+')
+
+
+def get_markers_from_string(text):
+    """Get all markerstrings in a string.
+
+    Returns a dict mapping lower-cased tags to the first value found
+    for them. The text is looked through only once, but the result is
+    the same as if we asked `get_marker_from_string` for every tag.
+    """
+    markers = {}
+    for line in text.split('\n'):
+        line = line.strip()
+        if line.startswith(':'):
+            start = 1
+        elif line.startswith('..'):
+            comment = rest_comment_regex.match(line)
+            if comment is None or line[comment.end():][:1] != ':':
+                continue
+            start = comment.end() + 1
+        else:
+            continue
+        # Every colon may end a tag: ':a:b: c' has tag 'a' with value
+        # 'b: c' and tag 'a:b' with value 'c'.
+        end = line.find(':', start)
+        while end != -1:
+            tag = line[start:end].lower()
+            if tag not in markers:
+                markers[tag] = line[end + 1:].strip()
+            end = line.find(':', end + 1)
+    return markers
+
+
+class FileMarkers(object):
+    """The markerstrings of a file.
+
+    An immutable record of all markerstrings in a file. Tags are
+    looked up case insensitive.
+    """
+
+    __slots__ = ('filepath', '_markers')
+
+    def __init__(self, filepath, markers):
+        object.__setattr__(self, 'filepath', filepath)
+        object.__setattr__(self, '_markers', dict(markers))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FileMarkers are immutable")
+
+    def get(self, marker, default=None):
+        """Get the value of `marker` or `default` if it is not set.
+        """
+        return self._markers.get(marker.lower(), default)
+
+    def items(self):
+        """Get a list of all ``(tag, value)`` pairs.
+        """
+        return sorted(self._markers.items())
+
+    def __contains__(self, marker):
+        return marker.lower() in self._markers
+
+    def __len__(self):
+        return len(self._markers)
+
+    def __iter__(self):
+        return iter(sorted(self._markers))
+
+    def __repr__(self):
+        return "<FileMarkers for %r>" % (self.filepath,)
+
+
+def read_header(filepath, max_bytes=None, max_lines=None, chunk_size=8192):
+    """Read the beginning of a file as bytes.
+
+    Reading stops after `max_bytes` bytes or `max_lines` lines,
+    whatever comes first. The file is read in chunks of at most
+    `chunk_size` bytes, so of huge files we read only a little more
+    than we need.
+    """
+    chunks = []
+    size = 0
+    lines = 0
+    with open(filepath, 'rb') as fd:
+        while True:
+            wanted = chunk_size
+            if max_bytes is not None:
+                wanted = min(wanted, max_bytes - size)
+            if wanted <= 0:
+                break
+            chunk = fd.read(wanted)
+            if not chunk:
+                break
+            if max_lines is not None:
+                newlines = chunk.count(b'\n')
+                if lines + newlines >= max_lines:
+                    # Cut the chunk after the last line wanted.
+                    end = -1
+                    for num in range(max_lines - lines):
+                        end = chunk.index(b'\n', end + 1)
+                    chunks.append(chunk[:end + 1])
+                    break
+                lines += newlines
+            chunks.append(chunk)
+            size += len(chunk)
+    return b''.join(chunks)
+
+
+def read_bytes(filepath, max_bytes=None, max_lines=None):
+    """Read a file as bytes.
+
+    If `max_bytes` or `max_lines` is given, only the beginning of the
+    file is read (see `read_header`).
+    """
+    if max_bytes is None and max_lines is None:
+        with open(filepath, 'rb') as fd:
+            return fd.read()
+    return read_header(filepath, max_bytes, max_lines)
+
+
+def decode_text(raw):
+    """Decode bytes read from a file.
+
+    Files are assumed to be UTF-8 encoded. Incompatible characters are
+    ignored.
+    """
+    return raw.decode('utf-8', 'ignore')
+
+
+def read_text(filepath, max_bytes=None, max_lines=None):
+    """Read a file as text.
+
+    Files are assumed to be UTF-8 encoded. Incompatible characters are
+    ignored. If `max_bytes` or `max_lines` is given, only the
+    beginning of the file is read (see `read_header`).
+    """
+    return decode_text(read_bytes(filepath, max_bytes, max_lines))
+
+
+non_ascii_regex = re.compile(br'[\x80-\xff]')
+
+
+def is_ascii(raw):
+    """Tell whether the bytes `raw` are all ASCII characters.
+    """
+    return non_ascii_regex.search(raw) is None
+
+
+# Lines that could carry a markerstring once decoded and stripped:
+# lines starting with a colon or dot after whitespace, and lines
+# starting with non-ASCII bytes, which might be whitespace or be
+# dropped when decoding.
+marker_line_bytes_regex = re.compile(
+    br'^[\s\x1c-\x1f]*[.:\x80-\xff]', re.MULTILINE)
+
+
+def get_markers_from_bytes(raw):
+    """Get all markerstrings in bytes read from a file.
+
+    Like `get_markers_from_string`, but texts without any line that
+    might carry a marker are rejected without decoding them.
+    """
+    if marker_line_bytes_regex.search(raw) is None:
+        return {}
+    return get_markers_from_string(decode_text(raw))
+
+
+def get_stat_key(stat):
+    """Get a ``(size, mtime)`` tuple telling whether a file changed.
+
+    `stat` is the result of an `os.stat()` call. The modification time
+    is given in nanoseconds.
+    """
+    mtime = getattr(stat, 'st_mtime_ns', None)
+    if mtime is None:
+        mtime = int(stat.st_mtime * 1000000000)
+    return (stat.st_size, mtime)
+
+
+file_markers = {}
+
+
+def get_file_markers(filepath, read=read_bytes, max_bytes=None,
+                     max_lines=None):
+    """Get the markerstrings of a file as `FileMarkers` record.
+
+    Records are cached as long as the modification time and size of
+    the file do not change. `read` is a callable returning the bytes
+    of a file, called with the filepath, `max_bytes` and `max_lines`. If
+    `max_bytes` or `max_lines` is given, only markers in the beginning
+    of the file are found.
+    """
+    key = get_stat_key(os.stat(filepath))
+    cache_key = (filepath, max_bytes, max_lines)
+    cached = file_markers.get(cache_key)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    markers = FileMarkers(
+        filepath, get_markers_from_bytes(
+            read(filepath, max_bytes, max_lines)))
+    file_markers[cache_key] = (key, markers)
+    return markers
+
+
 def get_marker_from_file(marker, filepath):
     """Looks for a markerstring  in a file.
 
@@ -102,9 +315,236 @@ def get_marker_from_file(marker, filepath):
     Files are assumed to be UTF-8 encoded. Incompatible characters are
     ignored.
     """
-    with codecs.open(filepath, "rb", "utf-8", "ignore") as fd:
-        return get_marker_from_string(marker, fd.read())
-    return None
+    return get_file_markers(filepath).get(marker)
+
+
+def get_cache_dir(cache_dir=None):
+    """Get the directory to keep caches in.
+
+    That is `cache_dir` if given, else the value of the environment
+    variable ``Z3C_TESTSETUP_CACHE_DIR``. Returns ``None`` if there is
+    neither.
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get('Z3C_TESTSETUP_CACHE_DIR') or None
+    return cache_dir
+
+
+def iter_regex_ops(parsed):
+    """Iterate over all ``(op, av)`` pairs of a parsed regex.
+
+    Nested subpatterns are visited as well.
+    """
+    for op, av in parsed:
+        yield op, av
+        todo = [av]
+        while todo:
+            item = todo.pop()
+            if isinstance(item, sre_parse.SubPattern):
+                for result in iter_regex_ops(item):
+                    yield result
+            elif isinstance(item, (list, tuple)):
+                todo.extend(item)
+
+
+def get_regex_literal(regexp):
+    """Get the longest literal string every match of `regexp` contains.
+
+    `regexp` is a compiled regular expression. Returns ``None`` if
+    there is no such string or the regex is case insensitive.
+    """
+    if regexp.flags & re.IGNORECASE or not isinstance(
+            regexp.pattern, text_type):
+        return None
+    best, current = u'', u''
+    for op, av in sre_parse.parse(regexp.pattern):
+        if op == sre_constants.LITERAL:
+            current += six_unichr(av)
+            continue
+        best, current = max(best, current, key=len), u''
+    best = max(best, current, key=len)
+    return best or None
+
+
+def is_line_local(regexp):
+    """Tell whether `regexp` matches lines of a text the same way,
+    whether we feed them one by one or find them in the whole text in
+    multiline mode.
+
+    That is true unless the regex peeks at its surroundings with
+    lookahead/lookbehind assertions or anchors at the start or end of
+    the whole string.
+    """
+    for op, av in iter_regex_ops(sre_parse.parse(regexp.pattern)):
+        if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            return False
+        if op == sre_constants.AT and av in (
+                sre_constants.AT_BEGINNING_STRING,
+                sre_constants.AT_END_STRING):
+            return False
+    return True
+
+
+# Global inline flags like `(?i)` must stay at the start of a regex.
+inline_flags_regex = re.compile(r'\(\?[aiLmsux]+\)')
+
+
+class LineMatcher(object):
+    """Check whether each of a list of regular expressions matches a
+    line of a text.
+
+    The result is the same as splitting the text into lines and
+    matching every regular expression against every line. But instead
+    of doing that, we look only at lines containing the literal part
+    of a regex (if it has one), or let a regex in multiline mode find
+    candidate lines in the whole text. We stop at the first regex that
+    matches no line.
+    """
+
+    def __init__(self, regexp_list):
+        self.regexp_list = list(regexp_list)
+        self.regexs = [re.compile(regex) for regex in self.regexp_list]
+        self.searchers = [self._getSearcher(x) for x in self.regexs]
+        self.byte_literals = [
+            literal.encode('utf-8') for literal, multiline in self.searchers
+            if literal is not None]
+
+    def _getSearcher(self, regexp):
+        # Get a tuple (literal, multiline regex) for `regexp`. Any of
+        # them might be ``None``.
+        try:
+            literal = get_regex_literal(regexp)
+            if not is_line_local(regexp):
+                return literal, None
+            pattern = regexp.pattern
+            flags = inline_flags_regex.match(pattern)
+            flags = flags and flags.group() or ''
+            multiline = re.compile(
+                '%s^(?:%s)' % (flags, pattern[len(flags):]),
+                regexp.flags | re.MULTILINE)
+        except (re.error, TypeError, ValueError):
+            # Patterns we do not understand are matched line by line.
+            return None, None
+        return literal, multiline
+
+    def acceptsBytes(self, raw):
+        """Might the text decoded from bytes `raw` match?
+
+        Returns ``False`` only if it is sure that `matches()` would
+        return ``False`` as well. That is the case if the bytes lack
+        the literal part of any regex. Dropping invalid characters
+        while decoding could join the parts of a literal, so only pure
+        ASCII bytes are rejected.
+        """
+        ascii = None
+        for literal in self.byte_literals:
+            if literal in raw:
+                continue
+            if ascii is None:
+                ascii = is_ascii(raw)
+            if ascii:
+                return False
+        return True
+
+    def matches(self, text):
+        """Does every regex match at least one line of `text`?
+        """
+        lines = None
+        for regexp, (literal, multiline) in zip(
+                self.regexs, self.searchers):
+            if literal is not None:
+                if not self._searchLiteral(text, regexp, literal):
+                    return False
+            elif multiline is not None:
+                if not self._search(text, regexp, multiline):
+                    return False
+            else:
+                if lines is None:
+                    lines = text.split('\n')
+                if not any(regexp.match(line) for line in lines):
+                    return False
+        return True
+
+    def _searchLiteral(self, text, regexp, literal):
+        # Only lines containing the literal can match.
+        pos = text.find(literal)
+        while pos != -1:
+            start = text.rfind('\n', 0, pos) + 1
+            end = text.find('\n', pos)
+            if end == -1:
+                end = len(text)
+            if regexp.match(text[start:end]) is not None:
+                return True
+            pos = text.find(literal, end)
+        return False
+
+    def _search(self, text, regexp, multiline):
+        pos = 0
+        while True:
+            match = multiline.search(text, pos)
+            if match is None:
+                return False
+            start = match.start()
+            end = text.find('\n', start)
+            if end == -1:
+                end = len(text)
+            # The multiline match might span several lines. Make sure
+            # the line itself matches.
+            if regexp.match(text[start:end]) is not None:
+                return True
+            pos = end + 1
+
+
+line_matchers = {}
+
+
+def get_line_matcher(regexp_list):
+    """Get a (cached) `LineMatcher` for a list of regular expressions.
+    """
+    key = tuple(regexp_list)
+    matcher = line_matchers.get(key)
+    if matcher is None:
+        matcher = line_matchers[key] = LineMatcher(key)
+    return matcher
+
+
+def get_module_docstring(filepath):
+    """Get the docstring of a Python module without importing it.
+
+    Only the tokens of the first statement are looked at, so huge
+    modules are not parsed completely. Returns ``None`` if the module
+    has no docstring. Raises `SyntaxError` (or `tokenize.TokenError`)
+    for modules that cannot be tokenized.
+    """
+    if not hasattr(tokenize, 'tokenize'):
+        # Python 2 has no bytes based tokenizer.
+        with open(filepath, 'rb') as fd:
+            return ast.get_docstring(ast.parse(fd.read()), clean=False)
+    strings = []
+    with open(filepath, 'rb') as fd:
+        for token in tokenize.tokenize(fd.readline):
+            if token.type in (tokenize.ENCODING, tokenize.COMMENT,
+                              tokenize.NL):
+                continue
+            if token.type == tokenize.STRING:
+                strings.append(token.string)
+            elif token.type == tokenize.OP and token.string in '()':
+                strings.append(token.string)
+            elif token.type in (tokenize.NEWLINE, tokenize.ENDMARKER):
+                break
+            else:
+                # The first statement is not just a string.
+                return None
+    if not [x for x in strings if x not in '()']:
+        return None
+    try:
+        docstr = ast.literal_eval(' '.join(strings))
+    except (SyntaxError, ValueError):
+        return None
+    if not isinstance(docstr, text_type):
+        # Bytes or other constants are not taken as docstrings.
+        return None
+    return docstr
 
 
 def warn(text):
@@ -116,10 +556,84 @@ def import_name(name):
     return sys.modules[name]
 
 
+# Results of `get_attribute` by dotted name: ``(True, obj)`` or
+# ``(False, (exception class, args))``.
+resolved_attributes = {}
+
+
 def get_attribute(name):
-    name, attr = name.rsplit('.', 1)
-    obj = import_name(name)
-    return getattr(obj, attr)
+    """Get the object denoted by dotted `name`.
+
+    Names are resolved only once. Failures are remembered as well and
+    raise a new exception of the same kind again.
+    """
+    result = resolved_attributes.get(name)
+    if result is None:
+        modname, attr = name.rsplit('.', 1)
+        try:
+            result = (True, getattr(import_name(modname), attr))
+        except (ImportError, AttributeError) as exc:
+            # Not the exception itself, which would collect the
+            # tracebacks of all lookups.
+            result = (False, (exc.__class__, exc.args))
+        resolved_attributes[name] = result
+    found, obj = result
+    if not found:
+        exc_class, args = obj
+        raise exc_class(*args)
+    return obj
+
+
+class LazyAttribute(object):
+    """A proxy for the object denoted by dotted `name`.
+
+    The object is imported when it is first used. `__module__` and
+    `__name__` are taken from the dotted name, so testrunners can get
+    the name of a layer proxy without importing it. Proxies compare
+    equal to the objects they stand for.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self.__module__, self.__name__ = name.rsplit('.', 1)
+
+    def resolve(self):
+        return get_attribute(self._name)
+
+    def __call__(self, *args, **kw):
+        return self.resolve()(*args, **kw)
+
+    def __getattr__(self, name):
+        if name == '_name':
+            raise AttributeError(name)
+        return getattr(self.resolve(), name)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyAttribute):
+            other = other.resolve()
+        return self.resolve() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.resolve())
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self._name)
+
+
+lazy_attributes = {}
+
+
+def get_lazy_attribute(name):
+    """Get a `LazyAttribute` for dotted `name`.
+
+    All callers asking for the same name share one proxy.
+    """
+    if name not in lazy_attributes:
+        lazy_attributes[name] = LazyAttribute(name)
+    return lazy_attributes[name]
 
 
 def got_working_zope_app_testing():
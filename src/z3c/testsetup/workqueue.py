@@ -0,0 +1,426 @@
+##############################################################################
+#
+# Copyright (c) 2009 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Running tests from a queue shared by several machines.
+
+Static shards (see `z3c.testsetup.sharding`) leave some machines idle
+while others still run long layers. With `queued_layers` in effect,
+machines take their tests from a `WorkQueue` in a directory they all
+share instead:
+
+- The coordinator (started with ``--queue-dir DIR``) cuts all tests
+  into units, see `make_batches`, and publishes them in the queue.
+
+- Workers (started with ``--join-queue DIR``) wait for the queue to
+  appear. Like the coordinator, they claim units until none are left,
+  preferring units of a layer they have set up already. Each unit is
+  run in a forked process, as by `z3c.testsetup.scheduler`, and its
+  outcomes are stored in the queue.
+
+- When all units are done, the coordinator reports the outcomes of
+  all of them as if it had run them itself. Workers report the units
+  they ran.
+
+Publishing the queue, claiming units and storing outcomes are atomic
+renames, so no locks are needed. All machines must find the same tests.
+Units are claimed only by machines that find the tests the coordinator
+found. Units claimed by machines that stopped working on them for
+`timeout` seconds are put back into the queue by the coordinator.
+
+A queue left in `DIR` by an earlier run is replaced by the coordinator.
+Workers started before the coordinator of a new run may find such an
+old queue, so use a fresh directory for each run.
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from z3c.testsetup.ordering import (
+    UNIT_LAYER_NAME, allows_teardown, get_test_path)
+from z3c.testsetup.parallel import testrunner_runner
+from z3c.testsetup.scheduler import (
+    DEFAULT_LAYER_COST, DEFAULT_TEST_DURATION, Unit, WorkerPool,
+    can_schedule, report_unit)
+
+# Name of the queue in the directory given.
+QUEUE_NAME = 'queue'
+
+UNITS_FILENAME = 'units.json'
+
+# Seconds between looks at the queue.
+POLL_INTERVAL = 0.5
+
+# Seconds after which a claim not worked on is given up.
+QUEUE_TIMEOUT = 600.0
+
+
+class QueuedUnit(Unit):
+    """A unit with its number in the queue.
+    """
+
+    def __init__(self, number, layer_name, indexes, cost):
+        Unit.__init__(self, layer_name, indexes, cost)
+        self.number = number
+
+
+def make_batches(layer_tests, durations=None, layer_costs=None):
+    """Cut the tests of layers into units for a queue.
+
+    `layer_tests` is a list of ``(layer_name, tests, splittable)``.
+    `durations` maps test ids to recorded durations, `layer_costs`
+    layer names to setup costs, both in seconds. Layers that are
+    `splittable` are cut into batches of tests from the same files.
+    Batches are at least as long as setting up the layer. Returns the
+    units, longest first.
+    """
+    durations = durations or {}
+    layer_costs = layer_costs or {}
+    units = []
+    for layer_name, tests, splittable in layer_tests:
+        setup_cost = layer_costs.get(layer_name)
+        if setup_cost is None:
+            setup_cost = DEFAULT_LAYER_COST
+            if layer_name == UNIT_LAYER_NAME:
+                setup_cost = 0.0
+        batches = []
+        indexes = []
+        cost = 0.0
+        last_path = None
+        for index, test in enumerate(tests):
+            path = get_test_path(test)
+            if (splittable and indexes and path != last_path and
+                    cost >= setup_cost):
+                batches.append((indexes, cost))
+                indexes = []
+                cost = 0.0
+            indexes.append(index)
+            cost += durations.get(test.id(), DEFAULT_TEST_DURATION)
+            last_path = path
+        if indexes:
+            batches.append((indexes, cost))
+        for indexes, cost in batches:
+            units.append(Unit(layer_name, indexes, cost + setup_cost))
+    # Ties are broken by name and position, never by chance.
+    units.sort(key=lambda x: (-x.cost, x.layer_name, x.indexes[0]))
+    return units
+
+
+class WorkQueue(object):
+    """A queue of units stored in directory `path`.
+
+    ``units.json`` describes all units. For each unit there is a token
+    named by its number, which is moved from ``pending`` to
+    ``claimed`` by the participant running it. Outcomes are stored in
+    ``done``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pending_dir = os.path.join(path, 'pending')
+        self.claimed_dir = os.path.join(path, 'claimed')
+        self.done_dir = os.path.join(path, 'done')
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, UNITS_FILENAME))
+
+    def publish(self, units):
+        """Publish `units`, a list of dicts, replacing any old queue.
+        """
+        parent = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        tmp_path = tempfile.mkdtemp(dir=parent, prefix='.tmp')
+        with open(os.path.join(tmp_path, UNITS_FILENAME), 'w') as fd:
+            json.dump(units, fd)
+        for name in ('pending', 'claimed', 'done'):
+            os.mkdir(os.path.join(tmp_path, name))
+        for number in range(len(units)):
+            open(os.path.join(tmp_path, 'pending', '%06d' % number),
+                 'w').close()
+        if os.path.exists(self.path):
+            old_path = tempfile.mkdtemp(dir=parent, prefix='.old')
+            os.rename(self.path, os.path.join(old_path, QUEUE_NAME))
+            shutil.rmtree(old_path)
+        os.rename(tmp_path, self.path)
+
+    def load(self):
+        """Get the units published, a list of dicts.
+        """
+        with open(os.path.join(self.path, UNITS_FILENAME)) as fd:
+            return json.load(fd)
+
+    def _numbers(self, dirname):
+        try:
+            names = os.listdir(dirname)
+        except OSError:
+            return []
+        return sorted([int(x.split('.')[0]) for x in names
+                       if not x.startswith('.')])
+
+    def _token(self, dirname, number):
+        return os.path.join(dirname, '%06d' % number)
+
+    def getPending(self):
+        """Get the numbers of units not claimed yet.
+        """
+        return self._numbers(self.pending_dir)
+
+    def claim(self, numbers):
+        """Claim the first unit of `numbers` still pending.
+
+        Returns its number or ``None``.
+        """
+        for number in numbers:
+            try:
+                os.rename(self._token(self.pending_dir, number),
+                          self._token(self.claimed_dir, number))
+            except OSError:
+                # Claimed by someone else in the meantime.
+                continue
+            # Tokens keep their time when moved.
+            self.touch([number])
+            return number
+        return None
+
+    def release(self, number):
+        """Put claimed unit `number` back into the queue.
+        """
+        try:
+            os.rename(self._token(self.claimed_dir, number),
+                      self._token(self.pending_dir, number))
+        except OSError:
+            pass
+
+    def touch(self, numbers):
+        """Note that claimed units `numbers` are still worked on.
+        """
+        for number in numbers:
+            try:
+                os.utime(self._token(self.claimed_dir, number), None)
+            except OSError:
+                pass
+
+    def finish(self, number, kind, data, output):
+        """Store the outcomes of unit `number`.
+
+        `kind`, `data` and `output` are as reported by a
+        `z3c.testsetup.scheduler.WorkerPool`.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.done_dir, prefix='.tmp')
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump([kind, data, output], tmp_file)
+        getattr(os, 'replace', os.rename)(
+            tmp_path, self._token(self.done_dir, number) + '.json')
+        try:
+            os.unlink(self._token(self.claimed_dir, number))
+        except OSError:
+            pass
+
+    def getDone(self):
+        """Get the numbers of units done.
+        """
+        return self._numbers(self.done_dir)
+
+    def getResults(self):
+        """Get ``(kind, data, output)`` of units done by number.
+        """
+        results = {}
+        for number in self.getDone():
+            path = self._token(self.done_dir, number) + '.json'
+            with open(path) as fd:
+                results[number] = tuple(json.load(fd))
+        return results
+
+    def getTime(self):
+        """Get the current time as seen by the file system.
+
+        Machines sharing the queue might not agree on the time.
+        """
+        path = os.path.join(self.path, '.clock')
+        with open(path, 'w'):
+            pass
+        return os.stat(path).st_mtime
+
+    def requeueStale(self, timeout):
+        """Put back claimed units not worked on for `timeout` seconds.
+
+        Returns the number of units put back.
+        """
+        now = self.getTime()
+        done = set(self.getDone())
+        count = 0
+        for number in self._numbers(self.claimed_dir):
+            if number in done:
+                continue
+            path = self._token(self.claimed_dir, number)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            if now - mtime > timeout:
+                self.release(number)
+                count += 1
+        return count
+
+
+class QueuePool(WorkerPool):
+    """Up to `workers` processes running the `runnable` units claimed
+    from `queue`.
+    """
+    poll_interval = POLL_INTERVAL
+
+    def __init__(self, options, layers, units, workers, queue, runnable,
+                 max_memory=None):
+        WorkerPool.__init__(self, options, layers, units, workers,
+                            max_memory)
+        self.queue = queue
+        self.runnable = set(runnable)
+        self.stopped = False
+
+    def has_pending(self):
+        if self.stopped:
+            return False
+        self.pending = [x for x in self.queue.getPending()
+                        if x in self.runnable]
+        return bool(self.pending)
+
+    def next_unit(self, worker):
+        if not self.has_pending():
+            return None
+        preferred = [x for x in self.pending
+                     if self.units[x].layer_name == worker.layer_name]
+        return self.queue.claim(preferred + [
+            x for x in self.pending if x not in preferred])
+
+    def put_back(self, unit_no):
+        self.queue.release(unit_no)
+
+    def stop(self):
+        self.stopped = True
+
+    def idle(self):
+        self.queue.touch([x.unit_no for x in self.running.values()
+                          if x.unit_no is not None])
+
+
+def get_runnable(descriptions, layers):
+    """Get the numbers of units described by `descriptions` whose
+    tests are found in `layers`.
+    """
+    runnable = []
+    for number, desc in enumerate(descriptions):
+        if desc['layer'] not in layers:
+            continue
+        tests = layers[desc['layer']][1]
+        if max(desc['indexes']) >= len(tests):
+            continue
+        if [tests[x].id() for x in desc['indexes']] == desc['ids']:
+            runnable.append(number)
+    return runnable
+
+
+def run_queued(runner, queue, coordinate, workers=None, durations=None,
+               layer_costs=None, max_memory=None, timeout=None):
+    """Run the tests registered with testrunner `runner` from `queue`.
+
+    If `coordinate` is true, the queue is published first and the
+    outcomes of all units are reported when all are done. Used in
+    place of `Runner.run_tests`.
+    """
+    output = runner.options.output
+    timeout = timeout or QUEUE_TIMEOUT
+    runner._scheduled_layers = layers = {}
+    layer_tests = []
+    for layer_name, layer, tests in runner.ordered_layers():
+        tests = list(tests)
+        if layer_name not in runner.tests_by_layer_name or not tests:
+            continue
+        layers[layer_name] = (layer, tests)
+        layer_tests.append((layer_name, tests, allows_teardown(layer)))
+    if coordinate:
+        queue.publish([
+            {'layer': unit.layer_name, 'indexes': unit.indexes,
+             'ids': [layers[unit.layer_name][1][x].id()
+                     for x in unit.indexes],
+             'cost': unit.cost}
+            for unit in make_batches(layer_tests, durations, layer_costs)])
+    else:
+        start = time.time()
+        while not queue.exists() and time.time() - start < timeout:
+            time.sleep(POLL_INTERVAL)
+    if not queue.exists():
+        output.error("No queue found in %s" % queue.path)
+        runner.failed = True
+        return
+    descriptions = queue.load()
+    units = [QueuedUnit(number, x['layer'], x['indexes'], x['cost'])
+             for number, x in enumerate(descriptions)]
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pool = QueuePool(runner.options, layers, units, workers or 1, queue,
+                     get_runnable(descriptions, layers), max_memory)
+    while True:
+        for unit, kind, data, output_text in pool.results():
+            queue.finish(unit.number, kind, data, output_text)
+            if not coordinate:
+                report_unit(runner, unit, kind, data, output_text)
+        if not coordinate or len(queue.getDone()) >= len(units):
+            break
+        # Wait for units claimed by others.
+        if not queue.requeueStale(timeout):
+            time.sleep(POLL_INTERVAL)
+    if coordinate:
+        results = queue.getResults()
+        for unit in units:
+            kind, data, output_text = results[unit.number]
+            report_unit(runner, unit, kind, data, output_text)
+    del runner._scheduled_layers
+    runner.failed = bool(runner.import_errors or runner.failures or
+                         runner.errors)
+
+
+@contextmanager
+def queued_layers(queue_dir=None, join_queue=None, workers=None,
+                  durations=None, layer_costs=None, max_memory=None,
+                  timeout=None):
+    """Make the testrunner run tests from a queue in a shared directory
+    while in context.
+
+    With `queue_dir` the testrunner coordinates the queue in that
+    directory, with `join_queue` it works for the coordinator of the
+    queue in that directory. Units are run in up to `workers`
+    processes, see `z3c.testsetup.scheduler.scheduled_layers` for
+    `max_memory`. Claims not worked on for `timeout` seconds are given
+    up.
+    """
+    path = queue_dir or join_queue
+    if testrunner_runner is None or not path:
+        yield
+        return
+    queue = WorkQueue(os.path.join(path, QUEUE_NAME))
+    orig_run_tests = testrunner_runner.Runner.run_tests
+
+    def run_tests(runner):
+        # Units are run in forked processes, even by a single worker.
+        if not can_schedule(runner.options, 2):
+            return orig_run_tests(runner)
+        return run_queued(runner, queue, bool(queue_dir), workers,
+                          durations, layer_costs, max_memory, timeout)
+    testrunner_runner.Runner.run_tests = run_tests
+    try:
+        yield
+    finally:
+        testrunner_runner.Runner.run_tests = orig_run_tests